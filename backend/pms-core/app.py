@@ -6,6 +6,7 @@ import boto3
 import pandas as pd
 import numpy as np
 from io import StringIO
+from json import dumps
 from urllib.parse import quote
 
 from chalice import (
@@ -40,6 +41,8 @@ from chalicelib.config import (
     PANELS_BUCKET_NAME,
     GOOGLE_RECAPTCHA_SECRET_KEY,
     SES_EMAIL_ADDRESS,
+    DB_METRICS_ENABLED,
+    SORTED_CLUSTER_LEASE_SECONDS,
 )
 from chalicelib.constants import (
     REQUEST_CONTENT_TYPE_JSON,
@@ -58,11 +61,15 @@ from chalicelib.utils import (
     get_token_subject,
     create_token,
     get_s3_objects,
+    is_missing_s3_object,
+    get_tag_questions_file_name,
+    assign_late_tag_questions,
     generate_panel_id,
     generate_question_id,
     generate_user_id,
     generate_log_id,
     get_current_time_utc,
+    parse_uin,
     distribute_tag_questions,
     group_similar_questions,
     grading_script,
@@ -77,6 +84,13 @@ from chalicelib.database.db_provider import (
     get_panel_db,
     get_metric_db,
     get_log_db,
+    get_submission_db,
+    AlreadySubmittedError,
+)
+from chalicelib.database.identity_map import with_identity_map
+from chalicelib.database.instrumentation import (
+    start_request_metrics,
+    end_request_metrics,
 )
 
 app = Chalice(app_name=f"{ENV}-pms-core")
@@ -96,6 +110,9 @@ def dummy():
     dummy_db.scan()
     dummy_db.query()
     dummy_db.batch_write_item()
+    dummy_db.batch_get_item()
+    dummy_db.transact_write_items()
+    dummy_db.describe_table()
     # SES
     dummy_ses = boto3.client("ses")
     dummy_ses.send_email()
@@ -113,6 +130,37 @@ app.api.cors = CORSConfig(
 )
 
 
+# Middlewares run in the order they are registered, this one wraps the log flush below
+@app.middleware("all")
+def record_db_metrics(event, get_response):
+    """Print the DynamoDB calls made while handling the event as one JSON line."""
+    if not DB_METRICS_ENABLED:
+        return get_response(event)
+    if hasattr(event, "method"):
+        # Keyed by route, e.g. "GET /panel/{id}"
+        name = f"{event.method} {event.context.get('resourcePath', event.path)}"
+    else:
+        name = type(event).__name__
+    start_request_metrics(name)
+    try:
+        return get_response(event)
+    finally:
+        print(dumps({"db_metrics": end_request_metrics()}, default=str))
+
+
+@app.middleware("all")
+def flush_logs(event, get_response):
+    """Write the logs buffered while handling the event in a single batch."""
+    try:
+        return get_response(event)
+    finally:
+        try:
+            get_log_db().flush_logs()
+        except Exception as e:
+            # Losing audit logs must not turn a handled request into an error
+            app.log.error(f"Could not write logs: {str(e)}")
+
+
 @app.authorizer()
 def authorizers(auth_request):
     """
@@ -120,6 +168,7 @@ def authorizers(auth_request):
     """
     allowed_routes = []
     principal_id = "unspecified"
+    context = {}
     try:
         # Expects token in the "Authorization" header of incoming request
         # ---> Format: "{"Authorization": "Bearer <token>"}"
@@ -150,6 +199,9 @@ def authorizers(auth_request):
         elif user_role == PANELIST_ROLE:
             allowed_routes = PANELIST_ROLE_AUTHORIZE_ROUTES
 
+        # Handlers read it from the request context instead of querying the user again
+        context["role"] = user_role
+
         # At this point the token is valid and verified
         # Proceed to fetch user roles and match allowed routes
 
@@ -160,7 +212,19 @@ def authorizers(auth_request):
         # General catch statement for unexpected errors
         app.log.error(f"Unexpected Error: {str(e)}")
     # Single return for all cases
-    return AuthResponse(routes=allowed_routes, principal_id=principal_id)
+    return AuthResponse(
+        routes=allowed_routes, principal_id=principal_id, context=context
+    )
+
+
+def get_current_user_role():
+    """Role resolved by the authorizer for the current request."""
+    authorizer_context = app.current_request.context["authorizer"]
+    user_role = authorizer_context.get("role")
+    if user_role is None:
+        # Authorizer responses cached by API Gateway before the role was added to the context
+        user_role = get_user_db().get_user_role(authorizer_context["principalId"])
+    return user_role
 
 
 @app.route("/")
@@ -205,10 +269,10 @@ def post_login_google():
 
         user_email = valid_and_verified_token["email"]
 
-        users_found = get_user_db().get_user_by_email(user_email)
+        user = get_user_db().find_user_by_email(user_email)
 
         # Check if result was found
-        if not users_found:
+        if user is None:
             new_log = {
                 "LogID": generate_log_id(),
                 "EmailID": user_email,
@@ -221,8 +285,6 @@ def post_login_google():
             get_log_db().add_log(new_log)
             raise NotFoundError("User not found")
 
-        user = users_found[0]
-
         # Create a new token with the user id
         new_token = create_token(
             user_id=user["UserID"],
@@ -294,9 +356,9 @@ def post_login_panel():
         get_log_db().add_log(new_log)
         raise BadRequestError(response["error-codes"])
 
-    users = get_user_db().get_user_by_email(panelist_email)
+    user = get_user_db().find_user_by_email(panelist_email)
 
-    if not users:
+    if user is None:
         new_log = {
             "LogID": generate_log_id(),
             "EmailID": panelist_email,
@@ -309,8 +371,6 @@ def post_login_panel():
         get_log_db().add_log(new_log)
         raise NotFoundError("User not found")
 
-    user = users[0]
-
     if user["Role"] != PANELIST_ROLE:
         new_log = {
             "LogID": generate_log_id(),
@@ -412,16 +472,21 @@ def post_process_howdy_file():
         # Choosing relevant columns for adding records to the user_db
         records = df[["EmailID", "FName", "LName", "UIN"]].to_dict(orient="records")
         for record in records:
-            user_exists = get_user_db().get_user_by_uin(record["UIN"])
+            try:
+                uin = parse_uin(record["UIN"])
+            except ValueError:
+                # Rows without a UIN can not be matched to a user
+                continue
+            user_exists = get_user_db().find_user_by_uin(uin)
 
-            if not user_exists:
+            if user_exists is None:
                 # If the user does not exists, create a new one from scratch
                 new_user = dict()
                 new_user["UserID"] = generate_user_id()
                 new_user["EmailID"] = record["EmailID"]
                 new_user["FName"] = record["FName"]
                 new_user["LName"] = record["LName"]
-                new_user["UIN"] = record["UIN"]
+                new_user["UIN"] = uin
                 new_user["Role"] = STUDENT_ROLE
                 new_user["CreatedAt"] = get_current_time_utc()
                 new_user["UpdatedAt"] = get_current_time_utc()
@@ -429,7 +494,7 @@ def post_process_howdy_file():
                 get_user_db().add_user(new_user)
             else:
                 # The user already exists, should update some fields only
-                updated_user = user_exists[0]
+                updated_user = user_exists
                 updated_user["EmailID"] = record["EmailID"]
                 updated_user["FName"] = record["FName"]
                 updated_user["LName"] = record["LName"]
@@ -467,23 +532,24 @@ def post_process_canvas_file():
         df.rename(columns={"ID": "CanvasID", "SIS Login ID": "UIN"}, inplace=True)
         # Cleanup CanvasID NaN columns
         df["CanvasID"] = df["CanvasID"].replace("NaN", pd.NA).fillna(0).astype(int)
-        # Cleanup UIN NaN columns
-        df["UIN"] = df["UIN"].replace("NaN", pd.NA).fillna(0).astype(int)
         # Cleanup Section NaN columns
         df["Section"] = df["Section"].replace("NaN", "")
-        # Remove rows with UIN = 0
-        df = df[df["UIN"] != 0]
 
         # Choosing relevant columns for adding records to the user_db
         records = df[["CanvasID", "Section", "UIN"]].to_dict(orient="records")
         for record in records:
-            user_exists = get_user_db().get_user_by_uin(record["UIN"])
+            try:
+                uin = parse_uin(record["UIN"])
+            except ValueError:
+                # Rows without a UIN (e.g. the test student) can not be matched to a user
+                continue
+            user_exists = get_user_db().find_user_by_uin(uin)
 
-            if not user_exists:
+            if user_exists is None:
                 # If the user does not exists, create a new one from scratch
                 new_user = dict()
                 new_user["UserID"] = generate_user_id()
-                new_user["UIN"] = int(record["UIN"])
+                new_user["UIN"] = uin
                 new_user["Role"] = STUDENT_ROLE
                 new_user["Section"] = record["Section"]
                 new_user["CanvasID"] = int(record["CanvasID"])
@@ -493,7 +559,7 @@ def post_process_canvas_file():
                 get_user_db().add_user(new_user)
             else:
                 # The user already exists, should update some fields only
-                updated_user = user_exists[0]
+                updated_user = user_exists
                 updated_user["Section"] = record["Section"]
                 updated_user["CanvasID"] = int(record["CanvasID"])
                 updated_user["UpdatedAt"] = get_current_time_utc()
@@ -555,6 +621,11 @@ def post_user():
         if "Section" not in incoming_json:
             raise BadRequestError("Key 'Section' not found in incoming request")
 
+        try:
+            uin = parse_uin(incoming_json["UIN"])
+        except ValueError:
+            raise BadRequestError(f"Invalid UIN {incoming_json['UIN']}")
+
         new_id = generate_user_id()
         # Build User object for database
         new_user = {
@@ -564,7 +635,7 @@ def post_user():
             "LName": incoming_json["LName"],
             "EmailID": incoming_json["EmailID"],
             "Role": incoming_json["Role"],
-            "UIN": incoming_json["UIN"],
+            "UIN": uin,
             "CanvasID": incoming_json["CanvasID"],
             "Section": incoming_json["Section"],
         }
@@ -618,6 +689,11 @@ def patch_user(id):
         raise NotFoundError(f"User {id} not found")
 
     updated_user = app.current_request.json_body
+    if "UIN" in updated_user:
+        try:
+            updated_user["UIN"] = parse_uin(updated_user["UIN"])
+        except ValueError:
+            raise BadRequestError(f"Invalid UIN {updated_user['UIN']}")
 
     response = get_user_db().update_user(updated_user)
     return response
@@ -632,15 +708,19 @@ def get_my_metrics():
     try:
         user_id = app.current_request.context["authorizer"]["principalId"]
 
-        public_panels = get_panel_db().get_public_panels()
-        metrics = []
-
-        for panel in public_panels:
-            metric = get_metric_db().get_metric(
-                user_id=user_id, panel_id=panel["PanelID"]
-            )
-            if metric is not None:
-                metrics.append(metric)
+        public_panel_ids = {
+            panel["PanelID"] for panel in get_panel_db().get_public_panels()
+        }
+        # One query over the user partition instead of a get_item per panel, sorted so the order
+        # does not depend on the panel scan
+        metrics = sorted(
+            (
+                metric
+                for metric in get_metric_db().get_metrics_by_user(user_id)
+                if metric["PanelID"] in public_panel_ids
+            ),
+            key=lambda metric: metric["PanelID"],
+        )
 
     except Exception as e:
         raise ChaliceViewError("Could not get metrics for user")
@@ -776,7 +856,9 @@ def post_question_batch():
 
         # Validate if panel still acepts questions!!
         present = datetime.now(timezone.utc)
-        questions_deadline = datetime.fromisoformat(panel["QuestionStageDeadline"])
+        questions_deadline = get_panel_db().get_panel_deadlines(panel_id)[
+            "QuestionStageDeadline"
+        ]
 
         if present > questions_deadline:
             raise BadRequestError("Action not allowed anymore")
@@ -893,6 +975,7 @@ def post_question_batch():
     authorizer=authorizers,
     content_types=[REQUEST_CONTENT_TYPE_JSON],
 )
+@with_identity_map
 def post_question_tagging(id):
     # Request Format {"liked":["<id_1>", "<id_2>",..., "<id_n>"], "disliked":["<id_1>", "<id_2>",..., "<id_n>"], "flagged":["<id_1>", "<id_2>",..., "<id_n>"]}
     try:
@@ -925,61 +1008,64 @@ def post_question_tagging(id):
             request["disliked"],
             request["flagged"],
         )
-        batch_update_request = {}
-
-        for q_id in liked_list:
-            question = get_question_db().get_question(q_id)
-            if "LikedBy" in question:
-                if user_id not in question["LikedBy"]:
-                    # if len(question["LikedBy"]) > 0:
-                    #     question["LikedBy"].extend(user_id)
-                    # else:
-                    question["LikedBy"].append(user_id)
-            else:
-                question["LikedBy"] = [user_id]
-            batch_update_request[q_id] = question
-
-        for q_id in disliked_list:
-            question = (
-                get_question_db().get_question(q_id)
-                if q_id not in batch_update_request
-                else batch_update_request[q_id]
-            )
-            if "DislikedBy" in question:
-                if user_id not in question["DislikedBy"]:
-                    # if len(question["DislikedBy"]) > 0:
-                    #     question["DislikedBy"].extend(user_id)
-                    # else:
-                    question["DislikedBy"].append(user_id)
-            else:
-                question["DislikedBy"] = [user_id]
-            batch_update_request[q_id] = question
-
-        for q_id in flagged_list:
-            question = (
-                get_question_db().get_question(q_id)
-                if q_id not in batch_update_request
-                else batch_update_request[q_id]
-            )
-            if "FlaggedBy" in question:
-                if user_id not in question["FlaggedBy"]:
-                    # if len(question["FlaggedBy"]) > 0:
-                    #     question["FlaggedBy"].extend(user_id)
-                    # else:
-                    question["FlaggedBy"].append(user_id)
-            else:
-                question["FlaggedBy"] = [user_id]
-            batch_update_request[q_id] = question
+        # Group the lists each question has to be added to, one conditional update per question
+        question_lists = {}
+        for list_name, q_ids in (
+            ("LikedBy", liked_list),
+            ("DislikedBy", disliked_list),
+            ("FlaggedBy", flagged_list),
+        ):
+            for q_id in q_ids:
+                question_lists.setdefault(q_id, []).append(list_name)
+
+        # Adding total interactions and storing it in metrics table
+        total_interactions = len(liked_list) + len(disliked_list) + len(flagged_list)
+
+        source_ip = app.current_request.context["identity"]["sourceIp"]
+        user_agent = app.current_request.headers["user-agent"]
+        path = app.current_request.path
+
+        message = f"{len(liked_list)} questions liked\n{len(disliked_list)} questions disliked\n{len(flagged_list)} questions flagged !"
+
+        new_log = {
+            "LogID": generate_log_id(),
+            "PanelID": panel_id,
+            "UserID": user_id,
+            "SourceIP": source_ip,
+            "UserAgent": user_agent,
+            "Action": path,
+            "Result": f"User tagged questions completed successfully, {message}",
+            "CreatedAt": get_current_time_utc(),
+        }
 
-        get_question_db().add_questions_batch(batch_update_request.values())
+        # Questions, out time/interactions in the metrics and the log are stored all together or not at all
+        try:
+            get_submission_db().submit_tagging(
+                panel_id,
+                user_id,
+                question_lists,
+                {
+                    "TagStageOutTime": get_current_time_utc(),
+                    "TagStageInteractions": total_interactions,
+                },
+                new_log,
+            )
+        except ValueError as e:
+            raise BadRequestError(str(e))
 
         html_body = "<h4>Question flagged</h4>"
 
         html_body += f"<p>{panel['PanelName']}</p>"
         html_body += "<ul>"
+        updated_questions = (
+            get_question_db().get_questions_batch(flagged_list) if flagged_list else {}
+        )
+        flagged_users = get_user_db().get_users_batch(
+            updated_questions[question_id]["UserID"] for question_id in flagged_list
+        )
         for question_id in flagged_list:
-            flagged_question = get_question_db().get_question(question_id)
-            flagged_user = get_user_db().get_user(flagged_question["UserID"])
+            flagged_question = updated_questions[question_id]
+            flagged_user = flagged_users[flagged_question["UserID"]]
             html_body += f"<li>Question ID: {flagged_question['QuestionID']}</li>"
             html_body += "<ul>"
 
@@ -1006,34 +1092,6 @@ def post_question_tagging(id):
                 html_body=html_body,
             )
 
-        # Adding total interactions and storing it in metrics table
-        total_interactions = len(liked_list) + len(disliked_list) + len(flagged_list)
-
-        # Add total_interactions, and out_time to metrics db
-        student_metrics = get_metric_db().get_metric(user_id, panel_id)
-        student_metrics["TagStageOutTime"] = get_current_time_utc()
-        student_metrics["TagStageInteractions"] = total_interactions
-
-        get_metric_db().add_metric(student_metrics)
-
-        source_ip = app.current_request.context["identity"]["sourceIp"]
-        user_agent = app.current_request.headers["user-agent"]
-        path = app.current_request.path
-
-        message = f"{len(liked_list)} questions liked\n{len(disliked_list)} questions disliked\n{len(flagged_list)} questions flagged !"
-
-        new_log = {
-            "LogID": generate_log_id(),
-            "PanelID": panel_id,
-            "UserID": user_id,
-            "SourceIP": source_ip,
-            "UserAgent": user_agent,
-            "Action": path,
-            "Result": f"User tagged questions completed successfully, {message}",
-            "CreatedAt": get_current_time_utc(),
-        }
-        get_log_db().add_log(new_log)
-
         return message
     except Exception as e:
         return {"error": str(e)}
@@ -1045,6 +1103,7 @@ def post_question_tagging(id):
     authorizer=authorizers,
     content_types=[REQUEST_CONTENT_TYPE_JSON],
 )
+@with_identity_map
 def post_question_mark_similar(id):
     # Request Format {"similar":[["<id_1>", "<id_2>",..., "<id_n>"], [], []]}
     # for every question_id in the list, append to its "similar-to" lsit in the database with every other question_id
@@ -1054,11 +1113,12 @@ def post_question_mark_similar(id):
         panel = get_panel_db().get_panel(id)
         request = app.current_request.json_body
 
-        present = datetime.now(timezone.utc)
-        tagging_deadline = datetime.fromisoformat(panel["TagStageDeadline"])
-
         if panel is None:
             raise BadRequestError("The panel id does not exist")
+
+        present = datetime.now(timezone.utc)
+        tagging_deadline = get_panel_db().get_panel_deadlines(id)["TagStageDeadline"]
+
         if present > tagging_deadline:
             raise BadRequestError("The deadline for this task has passed")
         if "similar" not in request:
@@ -1066,28 +1126,16 @@ def post_question_mark_similar(id):
 
         similar_list = request["similar"]
 
-        for similar_subset in similar_list:
-            similar_set = set(similar_subset)
-            for q_id in similar_set:
-                question_obj = get_question_db().get_question(q_id)
-                if not question_obj:
-                    raise BadRequestError("Invalid question_id", q_id)
-                other_ids = similar_set.copy()
-                other_ids.remove(q_id)
-                if "SimilarTo" in question_obj:
-                    question_obj["SimilarTo"].extend(
-                        uuid
-                        for uuid in other_ids
-                        if uuid not in question_obj["SimilarTo"]
-                    )
-                else:
-                    question_obj["SimilarTo"] = list(other_ids)
-                get_question_db().add_question(question_obj)
-
-        # Adding tag-stage out time
-        student_metrics = get_metric_db().get_metric(user_id, panel_id)
-        student_metrics["TagStageOutTime"] = get_current_time_utc()
-        get_metric_db().add_metric(student_metrics)
+        # Merges the clusters of every subset and adds the tag-stage out time, see submit_similar
+        try:
+            get_submission_db().submit_similar(
+                panel_id,
+                user_id,
+                similar_list,
+                {"TagStageOutTime": get_current_time_utc()},
+            )
+        except ValueError as e:
+            raise BadRequestError(str(e))
 
         panel_name = panel.get("PanelName")
         pretty_time = datetime.now(timezone.utc).strftime("%m/%d/%Y at %H:%M:%S UTC")
@@ -1126,8 +1174,7 @@ def post_question_mark_similar(id):
 )
 def get_panels():
     try:
-        user_id = app.current_request.context["authorizer"]["principalId"]
-        user_role = get_user_db().get_user_role(user_id)
+        user_role = get_current_user_role()
 
         if user_role == ADMIN_ROLE:
             panels = get_panel_db().get_all_panels()
@@ -1207,7 +1254,10 @@ def post_panel():
         get_panel_db().add_panel(new_panel)
 
         students = []
-        students = get_user_db().get_users_by_role(STUDENT_ROLE)
+        students = get_user_db().get_users_by_role(
+            STUDENT_ROLE,
+            attributes=["UserID", "CanvasID", "UIN", "Section", "FName", "LName"],
+        )
         new_metrics = []
         for student in students:
             try:
@@ -1243,9 +1293,7 @@ def post_panel():
 )
 def get_panel(id):
     try:
-        # Fetch user id
-        user_id = app.current_request.context["authorizer"]["principalId"]
-        user_role = get_user_db().get_user_role(user_id)
+        user_role = get_current_user_role()
         panel = get_panel_db().get_panel(id)
 
         if user_role != ADMIN_ROLE and panel["Visibility"] == "internal":
@@ -1269,9 +1317,13 @@ def patch_panel(id):
     if item is None:
         raise NotFoundError(f"Panel {id} not found")
 
-    updated_panel = app.current_request.json_body
+    # Only the attributes in the body change, concurrent edits of the others are kept
+    updated_panel = dict(app.current_request.json_body, PanelID=id)
 
-    response = get_panel_db().update_panel(updated_panel)
+    try:
+        response = get_panel_db().update_panel(updated_panel)
+    except ValueError as e:
+        raise NotFoundError(str(e))
     return response
 
 
@@ -1396,6 +1448,7 @@ def get_all_metrics_():
     methods=["GET"],
     authorizer=authorizers,
 )
+@with_identity_map
 def get_questions_per_student(id):
     panel_id = id
     user_question = None
@@ -1408,8 +1461,9 @@ def get_questions_per_student(id):
 
     # Deadline checks
     present_time = datetime.now(timezone.utc)
-    questions_deadline = datetime.fromisoformat(panel["QuestionStageDeadline"])
-    tagging_deadline = datetime.fromisoformat(panel["TagStageDeadline"])
+    deadlines = get_panel_db().get_panel_deadlines(panel_id)
+    questions_deadline = deadlines["QuestionStageDeadline"]
+    tagging_deadline = deadlines["TagStageDeadline"]
 
     # if present_time < questions_deadline + timedelta(minutes=30):
     #     return Response(
@@ -1421,7 +1475,8 @@ def get_questions_per_student(id):
 
     # Fetch the metrics for the student from the database and check if they have already completed it
     student_metrics = get_metric_db().get_metric(user_id, panel_id)
-    if "TagStageOutTime" in student_metrics:
+    # Students enrolled after the panel was created have no metric until they get their questions
+    if student_metrics is not None and "TagStageOutTime" in student_metrics:
         return Response(
             body={
                 "error": "This task has been completed and can no longer be modified"
@@ -1436,12 +1491,29 @@ def get_questions_per_student(id):
     if not panel_id or not user_id:
         return Response(body={"error": "Missing panelId or userId"}, status_code=400)
 
-    object_key = f"{panel_id}/questions.json"
+    object_key = f"{panel_id}/{get_tag_questions_file_name(user_id)}"
 
     print(
         f"Getting questions for User ID: {user_id} from S3 Bucket Name: {PANELS_BUCKET_NAME} and object name: {object_key}"
     )
-    questions_data, error = get_s3_objects(PANELS_BUCKET_NAME, object_key)
+    user_question, error = get_s3_objects(PANELS_BUCKET_NAME, object_key)
+    tag_stage_in_time_stored = False
+
+    if is_missing_s3_object(error):
+        # Panels distributed before the questions were split per student
+        object_key = f"{panel_id}/questions.json"
+        questions_data, error = get_s3_objects(PANELS_BUCKET_NAME, object_key)
+        user_question = questions_data.get(user_id) if questions_data else None
+
+        if is_missing_s3_object(error):
+            # Students who joined after the panel was distributed get their questions now
+            late_question = assign_late_tag_questions(panel_id, user_id)
+            if late_question is not None and "error" in late_question:
+                error = late_question["error"]
+            elif late_question is not None:
+                # The claim of the questions already stored the TagStageInTime of the student
+                user_question, error = late_question, None
+                tag_stage_in_time_stored = True
 
     if error:
         app.log.error(f"Error fetching from S3: {error}")
@@ -1450,19 +1522,30 @@ def get_questions_per_student(id):
             status_code=500,
         )
 
-    if questions_data:
-        user_question = questions_data.get(user_id)
-
     if user_question:
-        student_metrics = get_metric_db().get_metric(user_id, panel_id)
-        student_metrics["TagStageInTime"] = get_current_time_utc()
-        get_metric_db().add_metric(student_metrics)
+        if not tag_stage_in_time_stored:
+            student_metrics = get_metric_db().get_metric(user_id, panel_id)
+            student_metrics["TagStageInTime"] = get_current_time_utc()
+            get_metric_db().add_metric(student_metrics)
 
         return {"question": user_question}
     else:
         return Response(body={"error": "Question not found for user"}, status_code=404)
 
 
+# One-off before creating UINIndex (terraform apply), the index only takes string UINs.
+# Run with: chalice invoke -n backfill_uins
+@app.lambda_function(name="backfill_uins")
+def backfill_uins(event, context):
+    return {"updated": get_user_db().backfill_uins()}
+
+
+# One-off after deploying LogDateIndex, run with: chalice invoke -n backfill_log_dates
+@app.lambda_function(name="backfill_log_dates")
+def backfill_log_dates(event, context):
+    return {"updated": get_log_db().backfill_log_dates()}
+
+
 # It will run every day at 00:05 AM UTC
 @app.schedule(Cron(5, 0, "*", "*", "?", "*"))
 def daily_tasks(event):
@@ -1591,6 +1674,7 @@ def daily_tasks(event):
     methods=["GET"],
     authorizer=authorizers,
 )
+@with_identity_map
 def get_questions_for_voting_stage(id):
     panel_id = id
     # user_question = None
@@ -1603,8 +1687,9 @@ def get_questions_for_voting_stage(id):
 
     # Deadline checks
     present_time = datetime.now(timezone.utc)
-    tagging_deadline = datetime.fromisoformat(panel["TagStageDeadline"])
-    voting_deadline = datetime.fromisoformat(panel["VoteStageDeadline"])
+    deadlines = get_panel_db().get_panel_deadlines(panel_id)
+    tagging_deadline = deadlines["TagStageDeadline"]
+    voting_deadline = deadlines["VoteStageDeadline"]
 
     # check if the deadline for the tagging stage has sufficiently passed
     # if present_time < tagging_deadline + timedelta(minutes=30):
@@ -1657,6 +1742,18 @@ def get_questions_for_voting_stage(id):
 
     questions_data, error = get_s3_objects(PANELS_BUCKET_NAME, object_key)
 
+    if (
+        is_missing_s3_object(error)
+        and present_time > tagging_deadline
+        and get_panel_db().acquire_panel_lease(
+            panel_id, "SortedClusterLease", SORTED_CLUSTER_LEASE_SECONDS
+        )
+    ):
+        # mark_similar keeps the clusters up to date, no need to wait for daily_tasks
+        clusters = group_similar_questions(panel_id)
+        if isinstance(clusters, list):
+            questions_data, error = clusters, None
+
     if error:
         app.log.error(f"Error fetching from S3: {error}")
         return Response(
@@ -1701,6 +1798,7 @@ def get_questions_for_voting_stage(id):
     methods=["POST"],
     authorizer=authorizers,
 )
+@with_identity_map
 def post_submit_votes(id):
     try:
         # {vote_order: [<id_1>, <id_2>, <id_3>...<id_20>]}
@@ -1709,23 +1807,24 @@ def post_submit_votes(id):
         request = app.current_request.json_body
         if "vote_order" not in request:
             raise BadRequestError("vote_order not present in request body")
+        vote_scores = {}
         score = 20
-        batch_res = []
         for q_id in request["vote_order"]:
-            q_obj = get_question_db().get_question(q_id)
-            if "VoteScore" in q_obj:
-                q_obj["VoteScore"] += score
-            else:
-                q_obj["VoteScore"] = score
-            batch_res.append(q_obj)
+            vote_scores[q_id] = vote_scores.get(q_id, 0) + score
             score -= 1
 
-        get_question_db().add_questions_batch(batch_res)
-
-        # Record VoteStageOutTime
-        student_metrics = get_metric_db().get_metric(user_id, panel_id)
-        student_metrics["VoteStageOutTime"] = get_current_time_utc()
-        get_metric_db().add_metric(student_metrics)
+        # The scores and VoteStageOutTime are stored together, a resubmission counts nothing twice
+        try:
+            get_submission_db().submit_votes(
+                panel_id,
+                user_id,
+                vote_scores,
+                {"VoteStageOutTime": get_current_time_utc()},
+            )
+        except AlreadySubmittedError:
+            return Response(body={"error": "Votes were already submitted"}, status_code=409)
+        except ValueError as e:
+            raise BadRequestError(str(e))
 
         panel_name = get_panel_db().get_panel(id).get("PanelName")
         pretty_time = datetime.now(timezone.utc).strftime("%m/%d/%Y at %H:%M:%S UTC")
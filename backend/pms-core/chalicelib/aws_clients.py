@@ -0,0 +1,74 @@
+"""Shared boto3 session, clients and resources.
+
+Every AWS call in the application goes through here, so a warm Lambda container builds each client once
+and keeps reusing its connection pool. Clients are only created the first time they are asked for.
+"""
+
+from threading import Lock
+
+from boto3.session import Session
+from botocore.config import Config
+
+from .config import (
+    AWS_MAX_POOL_CONNECTIONS,
+    AWS_CONNECT_TIMEOUT_SECONDS,
+    AWS_READ_TIMEOUT_SECONDS,
+    AWS_MAX_RETRY_ATTEMPTS,
+)
+
+_SESSION = None
+_CLIENTS = {}
+_RESOURCES = {}
+# boto3 sessions are not thread safe, only one thread may build clients at a time
+_LOCK = Lock()
+
+
+def get_session():
+    global _SESSION
+    if _SESSION is None:
+        with _LOCK:
+            if _SESSION is None:
+                _SESSION = Session()
+    return _SESSION
+
+
+def get_client(service_name):
+    """Shared low level client, thread safe once created."""
+    client = _CLIENTS.get(service_name)
+    if client is None:
+        session = get_session()
+        with _LOCK:
+            client = _CLIENTS.get(service_name)
+            if client is None:
+                if service_name in _RESOURCES:
+                    # Share the connection pool of the resource created before
+                    client = _RESOURCES[service_name].meta.client
+                else:
+                    client = session.client(service_name, config=_get_config())
+                _CLIENTS[service_name] = client
+    return client
+
+
+def get_resource(service_name):
+    """Shared resource, its client is the one get_client hands out for the service afterwards."""
+    resource = _RESOURCES.get(service_name)
+    if resource is None:
+        session = get_session()
+        with _LOCK:
+            resource = _RESOURCES.get(service_name)
+            if resource is None:
+                resource = session.resource(service_name, config=_get_config())
+                # The resource client also (de)serializes python types, hand it out from now on
+                _CLIENTS[service_name] = resource.meta.client
+                _RESOURCES[service_name] = resource
+    return resource
+
+
+def _get_config():
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=AWS_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=AWS_READ_TIMEOUT_SECONDS,
+        retries={"mode": "adaptive", "max_attempts": AWS_MAX_RETRY_ATTEMPTS},
+    )
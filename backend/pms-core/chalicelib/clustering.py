@@ -0,0 +1,66 @@
+"""Clusters of the questions students marked as similar."""
+
+
+class DisjointSet(object):
+    """Union-find over hashable ids, with path compression and union by rank."""
+
+    def __init__(self, ids=()):
+        self.parent = {}
+        self.rank = {}
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        if id not in self.parent:
+            self.parent[id] = id
+            self.rank[id] = 0
+
+    def find(self, id):
+        root = id
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Point the whole path to the root, iteratively so long chains can not hit the recursion limit
+        while self.parent[id] != root:
+            self.parent[id], id = root, self.parent[id]
+        return root
+
+    def union(self, id, other_id):
+        """Merge the sets of both ids, returns the root of the merged set."""
+        root, other_root = self.find(id), self.find(other_id)
+        if root == other_root:
+            return root
+        if self.rank[root] < self.rank[other_root]:
+            root, other_root = other_root, root
+        self.parent[other_root] = root
+        if self.rank[root] == self.rank[other_root]:
+            self.rank[root] += 1
+        return root
+
+
+def cluster_similar_questions(questions):
+    """
+    Group the questions marked as similar.
+
+    mark_similar submissions keep the clusters in the ClusterParent pointers of the questions, the
+    SimilarTo links of questions marked before the pointers were kept are merged as well.
+
+    Returns the clusters as lists of question ids, sorted by id both inside the clusters and
+    between them (by their first id), so the order the questions were read in does not change
+    the outcome, e.g. which question of a tie represents its cluster. Ids that are not among the
+    questions are left out.
+    """
+    question_ids = sorted(question["QuestionID"] for question in questions)
+    clusters = DisjointSet(question_ids)
+    for question in questions:
+        linked_ids = question.get("SimilarTo", [])
+        if "ClusterParent" in question:
+            linked_ids = [question["ClusterParent"], *linked_ids]
+        for linked_id in linked_ids:
+            if linked_id in clusters.parent:
+                clusters.union(question["QuestionID"], linked_id)
+
+    members = {}
+    for question_id in question_ids:
+        members.setdefault(clusters.find(question_id), []).append(question_id)
+    # dicts keep insertion order, the smallest id of every cluster put it in first
+    return list(members.values())
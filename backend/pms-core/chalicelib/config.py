@@ -1,7 +1,7 @@
 """Configuration file for the application. This file is used to set the environment variables"""
 
 from os import environ
-from .constants import AUTH_BEARER_TYPE, AUTH_BASIC_TYPE
+from .constants import AUTH_BEARER_TYPE, AUTH_BASIC_TYPE, DB_BACKEND_DYNAMODB
 
 
 # Fetches form enviroment variables or sets default local development values
@@ -28,6 +28,40 @@ PANELS_BUCKET_NAME = environ.get(
     "S3_PANELS_BUCKET_NAME", "local-istm689-panels-students-data"
 )
 
+# Panels are cached in warm Lambda containers, edits through the API invalidate them right away
+PANEL_CACHE_TTL_SECONDS = int(environ.get("PANEL_CACHE_TTL_SECONDS", "60"))
+PANEL_CACHE_MAX_SIZE = int(environ.get("PANEL_CACHE_MAX_SIZE", "128"))
+# Keep it short, role changes made in other containers only show up after it expires
+ROLE_CACHE_TTL_SECONDS = int(environ.get("ROLE_CACHE_TTL_SECONDS", "30"))
+ROLE_CACHE_MAX_SIZE = int(environ.get("ROLE_CACHE_MAX_SIZE", "1024"))
+# Number of segments (and threads) used to scan whole tables in the admin listings, 1 scans sequentially
+PARALLEL_SCAN_SEGMENTS = int(environ.get("PARALLEL_SCAN_SEGMENTS", "4"))
+# Logs are buffered and written in one batch per invocation, or earlier once this many are waiting
+LOG_BUFFER_MAX_SIZE = int(environ.get("LOG_BUFFER_MAX_SIZE", "25"))
+# Opt-in pacing of batch writes to the provisioned write capacity of each table (read with DescribeTable).
+# Consumed capacity includes the writes to the GSIs and the pace is kept per container, throttled writes
+# are retried with backoff either way
+DYNAMODB_WRITE_PACING_ENABLED = (
+    environ.get("DYNAMODB_WRITE_PACING_ENABLED", "false").lower() == "true"
+)
+# Like DynamoDB burst capacity, unused capacity of up to this many seconds can be spent at once
+DYNAMODB_WRITE_BURST_SECONDS = float(environ.get("DYNAMODB_WRITE_BURST_SECONDS", "300"))
+# Opt-in logging of the DynamoDB calls (capacity, items, time) of every invocation as one JSON line
+DB_METRICS_ENABLED = environ.get("DB_METRICS_ENABLED", "false").lower() == "true"
+# Shared boto3 clients, one connection pool per service and container
+AWS_MAX_POOL_CONNECTIONS = int(environ.get("AWS_MAX_POOL_CONNECTIONS", "50"))
+AWS_CONNECT_TIMEOUT_SECONDS = int(environ.get("AWS_CONNECT_TIMEOUT_SECONDS", "2"))
+AWS_READ_TIMEOUT_SECONDS = int(environ.get("AWS_READ_TIMEOUT_SECONDS", "10"))
+# Adaptive mode also rate limits the client itself when DynamoDB starts throttling
+AWS_MAX_RETRY_ATTEMPTS = int(environ.get("AWS_MAX_RETRY_ATTEMPTS", "5"))
+# Estimated similarity at which questions count as near duplicates before distributing them, 0 disables it
+NEAR_DUPLICATE_THRESHOLD = float(environ.get("NEAR_DUPLICATE_THRESHOLD", "0.7"))
+# One request builds sortedCluster.json once the tag stage is over, the others wait until it is there
+# or the lease runs out (e.g. the request failed)
+SORTED_CLUSTER_LEASE_SECONDS = int(environ.get("SORTED_CLUSTER_LEASE_SECONDS", "300"))
+# "dynamodb" or "memory", the latter keeps every table (and panel file) in process for offline runs
+DB_BACKEND = environ.get("DB_BACKEND", DB_BACKEND_DYNAMODB)
+
 # Need to cast string to bool, it is weird in python but it works
 SES_IS_SANDBOX = (
     True
@@ -7,6 +7,24 @@ AUTH_BASIC_TYPE = "Basic"
 BOTO3_DYNAMODB_TYPE = "dynamodb"
 BOTO3_SES_TYPE = "ses"
 BOTO3_S3_TYPE = "s3"
+# Database backends, selected with the DB_BACKEND environment variable
+DB_BACKEND_DYNAMODB = "dynamodb"
+DB_BACKEND_MEMORY = "memory"
+# DynamoDB batch operations
+DYNAMODB_BATCH_GET_MAX_KEYS = 100
+DYNAMODB_BATCH_WRITE_MAX_ITEMS = 25
+DYNAMODB_TRANSACTION_MAX_ITEMS = 100
+DYNAMODB_BATCH_MAX_RETRIES = 8
+# Seconds, doubled on every retry of unprocessed keys/items
+DYNAMODB_BATCH_RETRY_BASE_DELAY = 0.05
+# Errors DynamoDB returns when a table (or its indexes) runs out of capacity
+DYNAMODB_THROTTLING_ERROR_CODES = (
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+)
+# Panels bucket, number of students every question is assigned to for tagging
+TAG_QUESTIONS_COVERAGE_FILE_NAME = "questions/coverage.json"
 # Request Content Types
 REQUEST_CONTENT_TYPE_JSON = "application/json"
 
@@ -16,6 +34,15 @@ PANELIST_ROLE = "panelist"
 
 GOOGLE_ISSUER = "https://accounts.google.com"
 
+# Panel attributes holding ISO 8601 dates
+PANEL_DEADLINE_ATTRIBUTES = (
+    "PanelStartDate",
+    "QuestionStageDeadline",
+    "TagStageDeadline",
+    "VoteStageDeadline",
+    "PanelPresentationDate",
+)
+
 STUDENT_ROLE_AUTHORIZE_ROUTES = [
     "/me",
     "/panel",
@@ -4,84 +4,381 @@ from chalicelib.config import (
     PANEL_TABLE_NAME,
     METRIC_TABLE_NAME,
     LOG_TABLE_NAME,
+    PANEL_CACHE_TTL_SECONDS,
+    PANEL_CACHE_MAX_SIZE,
+    ROLE_CACHE_TTL_SECONDS,
+    ROLE_CACHE_MAX_SIZE,
+    DB_BACKEND,
+    PARALLEL_SCAN_SEGMENTS,
+    LOG_BUFFER_MAX_SIZE,
+    DYNAMODB_WRITE_PACING_ENABLED,
+    DYNAMODB_WRITE_BURST_SECONDS,
+    DB_METRICS_ENABLED,
 )
 from chalicelib.constants import (
     BOTO3_DYNAMODB_TYPE,
+    DB_BACKEND_MEMORY,
+    PANEL_DEADLINE_ATTRIBUTES,
+    DYNAMODB_BATCH_GET_MAX_KEYS,
+    DYNAMODB_BATCH_WRITE_MAX_ITEMS,
+    DYNAMODB_BATCH_MAX_RETRIES,
+    DYNAMODB_BATCH_RETRY_BASE_DELAY,
+    DYNAMODB_THROTTLING_ERROR_CODES,
+    DYNAMODB_TRANSACTION_MAX_ITEMS,
 )
 
+from chalicelib.aws_clients import get_resource
+from chalicelib.database.instrumentation import (
+    get_request_metrics,
+    instrument_client,
+    instrumented,
+)
+from chalicelib.database.identity_map import (
+    wrap_provider,
+    CachedQuestionDB,
+    CachedPanelDB,
+    CachedUserDB,
+    CachedMetricDB,
+    CachedSubmissionDB,
+)
+
+from copy import deepcopy
+from time import sleep, monotonic
+from random import uniform
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from cachetools import TTLCache
 from boto3.dynamodb.conditions import Key, Attr
-from boto3 import resource
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
 
 _USER_DB = None
 _QUESTION_DB = None
 _PANEL_DB = None
 _METRIC_DB = None
 _LOG_DB = None
+_SUBMISSION_DB = None
+# Write pacing per table (None when not paced), shared by every batch write of the container
+_WRITE_BUCKETS = {}
 
 
 def get_panel_db():
     global _PANEL_DB
     try:
-        if _PANEL_DB is None:
-            _PANEL_DB = DynamoPanelDB(
-                resource(BOTO3_DYNAMODB_TYPE).Table(PANEL_TABLE_NAME)
-            )
+        if _PANEL_DB is None and DB_BACKEND == DB_BACKEND_MEMORY:
+            _PANEL_DB = _memory_provider().MemoryPanelDB()
+        elif _PANEL_DB is None:
+            _PANEL_DB = DynamoPanelDB(_get_table(PANEL_TABLE_NAME))
     except Exception as e:
         return {"error": str(e)}
-    return _PANEL_DB
+    return wrap_provider(_PANEL_DB, CachedPanelDB)
 
 
 def get_user_db():
     global _USER_DB
     try:
-        if _USER_DB is None:
-            _USER_DB = DynamoUserDB(
-                resource(BOTO3_DYNAMODB_TYPE).Table(USER_TABLE_NAME)
-            )
+        if _USER_DB is None and DB_BACKEND == DB_BACKEND_MEMORY:
+            _USER_DB = _memory_provider().MemoryUserDB()
+        elif _USER_DB is None:
+            _USER_DB = DynamoUserDB(_get_table(USER_TABLE_NAME))
     except Exception as e:
         return {"error": str(e)}
-    return _USER_DB
+    return wrap_provider(_USER_DB, CachedUserDB)
 
 
 def get_question_db():
     global _QUESTION_DB
     try:
-        if _QUESTION_DB is None:
-            _QUESTION_DB = DynamoQuestionDB(
-                resource(BOTO3_DYNAMODB_TYPE).Table(QUESTION_TABLE_NAME)
-            )
+        if _QUESTION_DB is None and DB_BACKEND == DB_BACKEND_MEMORY:
+            _QUESTION_DB = _memory_provider().MemoryQuestionDB()
+        elif _QUESTION_DB is None:
+            _QUESTION_DB = DynamoQuestionDB(_get_table(QUESTION_TABLE_NAME))
     except Exception as e:
         return {"error": str(e)}
-    return _QUESTION_DB
+    return wrap_provider(_QUESTION_DB, CachedQuestionDB)
 
 
 def get_metric_db():
     global _METRIC_DB
     try:
-        if _METRIC_DB is None:
-            _METRIC_DB = DynamoMetricDB(
-                resource(BOTO3_DYNAMODB_TYPE).Table(METRIC_TABLE_NAME)
-            )
+        if _METRIC_DB is None and DB_BACKEND == DB_BACKEND_MEMORY:
+            _METRIC_DB = _memory_provider().MemoryMetricDB()
+        elif _METRIC_DB is None:
+            _METRIC_DB = DynamoMetricDB(_get_table(METRIC_TABLE_NAME))
     except Exception as e:
         return {"error": str(e)}
-    return _METRIC_DB
+    return wrap_provider(_METRIC_DB, CachedMetricDB)
 
 
 def get_log_db():
     global _LOG_DB
     try:
-        if _LOG_DB is None:
-            _LOG_DB = DynamoLogDB(resource(BOTO3_DYNAMODB_TYPE).Table(LOG_TABLE_NAME))
+        if _LOG_DB is None and DB_BACKEND == DB_BACKEND_MEMORY:
+            _LOG_DB = _memory_provider().MemoryLogDB()
+        elif _LOG_DB is None:
+            _LOG_DB = DynamoLogDB(_get_table(LOG_TABLE_NAME))
     except Exception as e:
         return {"error": str(e)}
     return _LOG_DB
 
 
+def get_submission_db():
+    global _SUBMISSION_DB
+    try:
+        if _SUBMISSION_DB is None:
+            # Built on top of the (unwrapped) providers of the tables it writes to
+            get_question_db(), get_metric_db(), get_log_db()
+            if DB_BACKEND == DB_BACKEND_MEMORY:
+                submission_db_class = _memory_provider().MemorySubmissionDB
+            else:
+                submission_db_class = DynamoSubmissionDB
+            _SUBMISSION_DB = submission_db_class(_QUESTION_DB, _METRIC_DB, _LOG_DB)
+    except Exception as e:
+        return {"error": str(e)}
+    return wrap_provider(_SUBMISSION_DB, CachedSubmissionDB)
+
+
+def _get_table(table_name):
+    resource = get_resource(BOTO3_DYNAMODB_TYPE)
+    if DB_METRICS_ENABLED:
+        instrument_client(resource.meta.client)
+    return resource.Table(table_name)
+
+
+def _memory_provider():
+    # Imported lazily, the in-memory backend builds on the classes defined in this module
+    from chalicelib.database import memory_provider
+
+    return memory_provider
+
+
+"""Pagination helpers"""
+
+
+def iter_scan(table, **scan_params):
+    """Yield every item of a table scan, following LastEvaluatedKey across pages."""
+    return _paginate(table.scan, scan_params)
+
+
+def iter_query(table, **query_params):
+    """Yield every item of a table/index query, following LastEvaluatedKey across pages."""
+    return _paginate(table.query, query_params)
+
+
+def parallel_scan(table, total_segments=None, **scan_params):
+    """Scan the whole table split in total_segments segments read concurrently, returns a list."""
+    if total_segments is None:
+        total_segments = PARALLEL_SCAN_SEGMENTS
+    if total_segments <= 1:
+        return list(iter_scan(table, **scan_params))
+
+    # Resources are not thread safe, the workers share the (thread safe) client underneath
+    client = table.meta.client
+
+    def scan_segment(segment):
+        params = dict(
+            scan_params,
+            TableName=table.name,
+            Segment=segment,
+            TotalSegments=total_segments,
+        )
+        return list(_paginate(client.scan, params))
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        segments = executor.map(scan_segment, range(total_segments))
+        return [item for items in segments for item in items]
+
+
+def _paginate(operation, params):
+    # DynamoDB returns at most 1 MB per call, keep asking until there is no more pages
+    params = dict(params)
+    while True:
+        response = operation(**params)
+        yield from response["Items"]
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if last_evaluated_key is None:
+            return
+        params["ExclusiveStartKey"] = last_evaluated_key
+
+
+"""Projection helpers"""
+
+
+def with_projection(params, attributes, key_attributes=()):
+    """Request params that only return the given attributes (plus the key attributes), all by name."""
+    if attributes is None:
+        return params
+    # Placeholders for every name, attributes like Name or Role are reserved words
+    names = dict(params.get("ExpressionAttributeNames", {}))
+    placeholders = []
+    for position, attribute in enumerate(dict.fromkeys([*key_attributes, *attributes])):
+        names[f"#proj{position}"] = attribute
+        placeholders.append(f"#proj{position}")
+    return dict(
+        params,
+        ProjectionExpression=", ".join(placeholders),
+        ExpressionAttributeNames=names,
+    )
+
+
+"""Batch helpers"""
+
+
+def batch_get_items(table, keys, **request_params):
+    """Fetch items by primary key with BatchGetItem, 100 keys per call, retrying unprocessed keys."""
+    items = []
+    for start in range(0, len(keys), DYNAMODB_BATCH_GET_MAX_KEYS):
+        request_items = {
+            table.name: {
+                "Keys": keys[start : start + DYNAMODB_BATCH_GET_MAX_KEYS],
+                **request_params,
+            }
+        }
+        attempt = 0
+        while request_items:
+            # The resource client accepts and returns plain python types
+            response = table.meta.client.batch_get_item(RequestItems=request_items)
+            items.extend(response["Responses"].get(table.name, []))
+            request_items = response.get("UnprocessedKeys")
+            if request_items:
+                if attempt >= DYNAMODB_BATCH_MAX_RETRIES:
+                    raise RuntimeError(
+                        f"Could not read {len(request_items[table.name]['Keys'])} keys from {table.name}"
+                    )
+                # Unprocessed keys means we are being throttled, back off before retrying
+                sleep(DYNAMODB_BATCH_RETRY_BASE_DELAY * 2**attempt)
+                attempt += 1
+    return items
+
+
+class TokenBucket(object):
+    """Paces work to `rate` units per second, allowing bursts of up to `burst` units."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+
+    def take(self, tokens):
+        """Take tokens (negative gives them back), sleeping while the bucket is in debt.
+
+        Returns the seconds slept.
+        """
+        now = monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= tokens
+        if self._tokens >= 0:
+            return 0
+        wait = -self._tokens / self.rate
+        sleep(wait)
+        return wait
+
+
+def get_write_bucket(table):
+    """
+    Bucket pacing the batch writes to the provisioned write capacity of the table, read once per
+    container. None when pacing is disabled or the table is on-demand (no provisioned capacity).
+    """
+    if not DYNAMODB_WRITE_PACING_ENABLED:
+        return None
+    if table.name not in _WRITE_BUCKETS:
+        response = table.meta.client.describe_table(TableName=table.name)
+        capacity = response["Table"].get("ProvisionedThroughput", {})
+        write_capacity_units = capacity.get("WriteCapacityUnits", 0)
+        _WRITE_BUCKETS[table.name] = (
+            TokenBucket(
+                write_capacity_units,
+                write_capacity_units * DYNAMODB_WRITE_BURST_SECONDS,
+            )
+            if write_capacity_units > 0
+            else None
+        )
+    return _WRITE_BUCKETS[table.name]
+
+
+def batch_write_items(table, items, key_attributes, paced=True):
+    """Put items with BatchWriteItem, 25 per call.
+
+    Unprocessed items and throttled calls are retried with exponential backoff. When paced and
+    DYNAMODB_WRITE_PACING_ENABLED is set, the calls are also paced to the table's write capacity.
+    Returns the counters of the write, they are also added to the request metrics when recorded.
+    """
+    # BatchWriteItem rejects two writes to the same key in one call, the last one wins
+    items = list(
+        {
+            tuple(item[attribute] for attribute in key_attributes): item
+            for item in items
+        }.values()
+    )
+    bucket = get_write_bucket(table) if paced else None
+    stats = {
+        "items": len(items),
+        "requests": 0,
+        "retries": 0,
+        "throttles": 0,
+        "consumed_capacity": 0,
+        "paced_seconds": 0,
+    }
+    for start in range(0, len(items), DYNAMODB_BATCH_WRITE_MAX_ITEMS):
+        request_items = {
+            table.name: [
+                {"PutRequest": {"Item": item}}
+                for item in items[start : start + DYNAMODB_BATCH_WRITE_MAX_ITEMS]
+            ]
+        }
+        attempt = 0
+        while request_items:
+            # At least one unit per item, corrected with the actual consumption below
+            estimate = len(request_items[table.name])
+            if bucket is not None:
+                stats["paced_seconds"] += bucket.take(estimate)
+            stats["requests"] += 1
+            try:
+                response = table.meta.client.batch_write_item(
+                    RequestItems=request_items, ReturnConsumedCapacity="TOTAL"
+                )
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in DYNAMODB_THROTTLING_ERROR_CODES:
+                    raise
+                stats["throttles"] += 1
+                response = {"UnprocessedItems": request_items}
+            else:
+                consumed = sum(
+                    capacity.get("CapacityUnits", 0)
+                    for capacity in response.get("ConsumedCapacity", [])
+                )
+                stats["consumed_capacity"] += consumed
+                if bucket is not None and consumed:
+                    stats["paced_seconds"] += bucket.take(consumed - estimate)
+
+            request_items = response.get("UnprocessedItems")
+            if request_items:
+                if attempt >= DYNAMODB_BATCH_MAX_RETRIES:
+                    raise RuntimeError(
+                        f"Could not write {len(request_items[table.name])} items to {table.name}"
+                    )
+                # Full jitter, concurrent writers should not retry in lockstep
+                sleep(uniform(0, DYNAMODB_BATCH_RETRY_BASE_DELAY * 2**attempt))
+                stats["retries"] += 1
+                attempt += 1
+
+    metrics = get_request_metrics()
+    if metrics is not None:
+        metrics.record_batch_write(table.name, stats)
+    return stats
+
+
 """Question Database Service"""
 
 
 class QuestionDB(object):
-    def list_questions(self):
+    def list_questions(self, startswith=None, total_segments=None):
+        pass
+
+    def iter_questions(self):
         pass
 
     def add_question(self, question):
@@ -90,6 +387,9 @@ class QuestionDB(object):
     def get_question(self, question_id):
         pass
 
+    def get_questions_batch(self, question_ids, attributes=None):
+        pass
+
     def add_questions_batch(self, questions):
         pass
 
@@ -99,13 +399,23 @@ class QuestionDB(object):
     def get_question_ids_by_panel_id(self, panel_id):
         pass
 
-    def get_questions_by_panel(self, panel_id):
+    def get_questions_by_panel(self, panel_id, attributes=None):
+        pass
+
+    def iter_questions_by_panel(self, panel_id, attributes=None):
+        pass
+
+    def get_questions_by_user(self, user_id):
         pass
 
     def get_my_questions_by_panel(self, panel_id, user_id):
         pass
 
+    def iter_my_questions_by_panel(self, panel_id, user_id):
+        pass
+
 
+@instrumented
 class DynamoQuestionDB(QuestionDB):
     def __init__(self, table_resource):
         self._table = table_resource
@@ -113,7 +423,19 @@ class DynamoQuestionDB(QuestionDB):
     def list_questions(
         self,
         startswith=None,
+        total_segments=None,
+    ):
+        return parallel_scan(
+            self._table, total_segments, **self._scan_params(startswith)
+        )
+
+    def iter_questions(
+        self,
+        startswith=None,
     ):
+        return iter_scan(self._table, **self._scan_params(startswith))
+
+    def _scan_params(self, startswith):
         scan_params = {}
         filter_expression = None
         if startswith is not None:
@@ -123,16 +445,13 @@ class DynamoQuestionDB(QuestionDB):
 
         if filter_expression:
             scan_params["FilterExpression"] = filter_expression
-        response = self._table.scan(**scan_params)
-        return response["Items"]
+        return scan_params
 
     def add_question(self, question):
         self._table.put_item(Item=question)
 
     def add_questions_batch(self, questions):
-        with self._table.batch_writer() as batch:
-            for question in questions:
-                batch.put_item(Item=question)
+        return batch_write_items(self._table, questions, ("QuestionID",))
 
     def get_question(self, question_id):
         response = self._table.get_item(
@@ -142,27 +461,40 @@ class DynamoQuestionDB(QuestionDB):
         )
         return response.get("Item")
 
-    def get_question_ids_by_panel_id(self, panel_id):
-        response = self._table.query(
-            IndexName="PanelIDIndex",
-            KeyConditionExpression="PanelID = :panel_id",
-            ExpressionAttributeValues={":panel_id": panel_id},
+    def get_questions_batch(self, question_ids, attributes=None):
+        # BatchGetItem rejects duplicated keys
+        keys = [
+            {"QuestionID": question_id} for question_id in dict.fromkeys(question_ids)
+        ]
+        items = batch_get_items(
+            self._table, keys, **with_projection({}, attributes, ("QuestionID",))
         )
-        return [item["QuestionID"] for item in response["Items"]]
+        return {item["QuestionID"]: item for item in items}
 
-    def get_questions_by_panel(self, panel_id):
-        response = self._table.scan(FilterExpression=Attr("PanelID").eq(panel_id))
-        return response["Items"]
+    def get_question_ids_by_panel_id(self, panel_id):
+        items = self.iter_questions_by_panel(panel_id, attributes=["QuestionID"])
+        return [item["QuestionID"] for item in items]
+
+    def get_questions_by_panel(self, panel_id, attributes=None):
+        return list(self.iter_questions_by_panel(panel_id, attributes=attributes))
+
+    def iter_questions_by_panel(self, panel_id, attributes=None):
+        return self._query_index(
+            "PanelIDIndex",
+            Key("PanelID").eq(panel_id),
+            **with_projection({}, attributes),
+        )
 
     def get_questions_by_user(self, user_id):
-        response = self._table.scan(FilterExpression=Attr("UserID").eq(user_id))
-        return response["Items"]
+        return list(self._query_index("UserIDIndex", Key("UserID").eq(user_id)))
 
     def get_my_questions_by_panel(self, panel_id, user_id):
-        response = self._table.scan(
-            FilterExpression=Attr("PanelID").eq(panel_id) & Attr("UserID").eq(user_id)
+        return list(self.iter_my_questions_by_panel(panel_id, user_id))
+
+    def iter_my_questions_by_panel(self, panel_id, user_id):
+        return self._query_index(
+            "UserIDIndex", Key("UserID").eq(user_id) & Key("PanelID").eq(panel_id)
         )
-        return response["Items"]
 
     def delete_question(self, question_id):
         self._table.delete_item(
@@ -171,6 +503,15 @@ class DynamoQuestionDB(QuestionDB):
             }
         )
 
+    def _query_index(self, index_name, key_condition, **query_params):
+        # Reads only the index partition(s) matching the key condition instead of the whole table
+        return iter_query(
+            self._table,
+            IndexName=index_name,
+            KeyConditionExpression=key_condition,
+            **query_params,
+        )
+
     def _add_to_filter_expression(self, expression, condition):
         if expression is None:
             return condition
@@ -188,6 +529,9 @@ class PanelDB(object):
     def get_panel(self, panel_id):
         pass
 
+    def get_panel_deadlines(self, panel_id):
+        pass
+
     def update_panel(self, panel):
         pass
 
@@ -197,55 +541,166 @@ class PanelDB(object):
     def get_all_panels(self):
         pass
 
+    def iter_all_panels(self):
+        pass
+
     def get_number_of_questions_by_panel_id(self, panel_id):
         pass
 
+    def acquire_panel_lease(self, panel_id, lease_name, lease_seconds):
+        pass
+
 
+@instrumented
 class DynamoPanelDB(PanelDB):
     def __init__(self, table_resource):
         self._table = table_resource
+        # Lives as long as the (warm) Lambda container, shared by every invocation it serves
+        self._cache = TTLCache(maxsize=PANEL_CACHE_MAX_SIZE, ttl=PANEL_CACHE_TTL_SECONDS)
 
     def add_panel(self, panel):
+        self._cache.pop(panel["PanelID"], None)
         return self._table.put_item(Item=panel)
 
     def update_panel(self, panel):
-        return self._table.put_item(Item=panel)
+        """
+        Set the attributes of panel on the stored panel, leaving the others (e.g. edits made
+        through another container, leases) as they are. Nothing is read, so the cache can not
+        write stale attributes back. Raises ValueError if the panel does not exist.
+        """
+        self._cache.pop(panel["PanelID"], None)
+        attributes = [name for name in panel if name != "PanelID"]
+        if not attributes:
+            return None
+        names = {f"#attr{i}": name for i, name in enumerate(attributes)}
+        set_clauses = [
+            f"{placeholder} = :attr{i}" for i, placeholder in enumerate(names)
+        ]
+        try:
+            return self._table.update_item(
+                Key={"PanelID": panel["PanelID"]},
+                UpdateExpression="SET " + ", ".join(set_clauses),
+                ConditionExpression="attribute_exists(PanelID)",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    f":attr{i}": panel[name] for i, name in enumerate(attributes)
+                },
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            raise ValueError(f"Panel {panel['PanelID']} not found")
 
     def get_all_panels(self):
-        response = self._table.scan()
-        return response["Items"]
+        # A handful of panels, a parallel scan would only add requests
+        return list(iter_scan(self._table))
+
+    def iter_all_panels(self):
+        return iter_scan(self._table)
 
     def get_public_panels(self):
-        response = self._table.scan(FilterExpression=Attr("Visibility").eq("public"))
-        return response["Items"]
+        return list(
+            iter_scan(self._table, FilterExpression=Attr("Visibility").eq("public"))
+        )
 
     def get_panel(self, panel_id):
-        response = self._table.get_item(
-            Key={
-                "PanelID": panel_id,
-            },
-        )
-        return response.get("Item")
+        entry = self._get_cached_entry(panel_id)
+        # Callers are free to modify the panel they get (and its lists), never hand out the cached one
+        return deepcopy(entry["panel"]) if entry is not None else None
+
+    def get_panel_deadlines(self, panel_id):
+        """
+        Stage dates of the panel as timezone aware datetimes (None when not set), parsed once per
+        cache entry. Raises ValueError if one of them is not an ISO 8601 date.
+        """
+        entry = self._get_cached_entry(panel_id)
+        if entry is None:
+            return None
+        if "deadlines" not in entry:
+            # A panel with an invalid date is not cached as parsed, every call raises
+            entry["deadlines"] = _parse_deadlines(entry["panel"])
+        return dict(entry["deadlines"])
+
+    def _get_cached_entry(self, panel_id):
+        entry = self._cache.get(panel_id)
+        if entry is None:
+            response = self._table.get_item(
+                Key={
+                    "PanelID": panel_id,
+                },
+            )
+            panel = response.get("Item")
+            if panel is None:
+                # Do not cache misses, the panel may be created any moment
+                return None
+            entry = {"panel": panel}
+            self._cache[panel_id] = entry
+        return entry
 
     def get_panels_by_deadline(self, stage_name, deadline_date):
-        response = self._table.scan(
-            FilterExpression=Attr(stage_name).begins_with(deadline_date)
+        return list(
+            iter_scan(
+                self._table,
+                FilterExpression=Attr(stage_name).begins_with(deadline_date),
+            )
         )
-        return response["Items"]
 
     def get_number_of_questions_by_panel_id(self, panel_id):
-        response = self._table.query(
-            KeyConditionExpression="PanelID = :panel_id",
-            ExpressionAttributeValues={":panel_id": panel_id},
+        query_params = {
+            "KeyConditionExpression": "PanelID = :panel_id",
+            "ExpressionAttributeValues": {":panel_id": panel_id},
+        }
+        items = iter_query(
+            self._table, **with_projection(query_params, ["NumberOfQuestions"])
         )
-        return [int(item["NumberOfQuestions"]) for item in response["Items"]]
+        return [int(item["NumberOfQuestions"]) for item in items]
+
+    def acquire_panel_lease(self, panel_id, lease_name, lease_seconds):
+        """
+        Hold the lease_name lease of the panel for lease_seconds, so a task runs once across
+        containers. Returns False while someone else holds it (or the panel does not exist).
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            self._table.update_item(
+                Key={"PanelID": panel_id},
+                UpdateExpression="SET #lease = :expires",
+                ConditionExpression="attribute_exists(PanelID)"
+                " AND (attribute_not_exists(#lease) OR #lease < :now)",
+                ExpressionAttributeNames={"#lease": lease_name},
+                ExpressionAttributeValues={
+                    ":expires": (now + timedelta(seconds=lease_seconds)).isoformat(),
+                    ":now": now.isoformat(),
+                },
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        self._cache.pop(panel_id, None)
+        return True
+
+
+def _parse_deadlines(panel):
+    deadlines = {}
+    for attribute in PANEL_DEADLINE_ATTRIBUTES:
+        value = panel.get(attribute)
+        if not value:
+            deadlines[attribute] = None
+            continue
+        try:
+            deadlines[attribute] = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except (AttributeError, ValueError):
+            raise ValueError(
+                f"Invalid {attribute} {value!r} of panel {panel.get('PanelID')}"
+            )
+    return deadlines
 
 
 """User Database Service"""
 
 
 class UserDB(object):
-    def list_users(self):
+    def list_users(self, startswith=None, total_segments=None):
+        pass
+
+    def iter_users(self):
         pass
 
     def add_user(self, user):
@@ -254,6 +709,9 @@ class UserDB(object):
     def get_user(self, user_id):
         pass
 
+    def get_users_batch(self, user_ids):
+        pass
+
     def get_user_role(self, user_id):
         pass
 
@@ -266,24 +724,59 @@ class UserDB(object):
     def get_user_by_google_id(self, google_id):
         pass
 
+    def find_user_by_google_id(self, google_id):
+        pass
+
     def get_user_by_email(self, email):
         pass
 
-    def get_users_by_role(self, role):
+    def find_user_by_email(self, email):
+        pass
+
+    def get_user_by_uin(self, uin):
+        pass
+
+    def find_user_by_uin(self, uin):
+        pass
+
+    def get_users_by_role(self, role, attributes=None):
+        pass
+
+    def iter_users_by_role(self, role, attributes=None):
         pass
 
     def delete_user(self, user_id):
         pass
 
+    def backfill_uins(self):
+        pass
+
 
+@instrumented
 class DynamoUserDB(UserDB):
     def __init__(self, table_resource):
         self._table = table_resource
+        # Role per principal, the authorizer resolves it on every authorized request
+        self._role_cache = TTLCache(
+            maxsize=ROLE_CACHE_MAX_SIZE, ttl=ROLE_CACHE_TTL_SECONDS
+        )
 
     def list_users(
         self,
         startswith=None,
+        total_segments=None,
+    ):
+        return parallel_scan(
+            self._table, total_segments, **self._scan_params(startswith)
+        )
+
+    def iter_users(
+        self,
+        startswith=None,
     ):
+        return iter_scan(self._table, **self._scan_params(startswith))
+
+    def _scan_params(self, startswith):
         scan_params = {}
         filter_expression = None
         if startswith is not None:
@@ -293,26 +786,28 @@ class DynamoUserDB(UserDB):
 
         if filter_expression:
             scan_params["FilterExpression"] = filter_expression
-        response = self._table.scan(**scan_params)
-        return response["Items"]
+        return scan_params
 
     def get_student_user_ids(self):
-        response = self._table.query(
-            IndexName="RoleIndex",
-            KeyConditionExpression="#roleAttr = :roleVal",
-            ExpressionAttributeNames={
+        query_params = {
+            "IndexName": "RoleIndex",
+            "KeyConditionExpression": "#roleAttr = :roleVal",
+            "ExpressionAttributeNames": {
                 "#roleAttr": "Role",  # Placeholder for the reserved word 'role'
             },
-            ExpressionAttributeValues={
+            "ExpressionAttributeValues": {
                 ":roleVal": "student",
             },
-        )
-        return {item["UserID"] for item in response["Items"]}
+        }
+        items = iter_query(self._table, **with_projection(query_params, ["UserID"]))
+        return {item["UserID"] for item in items}
 
     def add_user(self, user):
+        self._role_cache.pop(user["UserID"], None)
         return self._table.put_item(Item=user)
 
     def update_user(self, user):
+        self._role_cache.pop(user["UserID"], None)
         return self._table.put_item(Item=user)
 
     def add_user_google_id(self, user_id, google_id):
@@ -331,33 +826,96 @@ class DynamoUserDB(UserDB):
         )
         return response.get("Item")
 
+    def get_users_batch(self, user_ids):
+        keys = [{"UserID": user_id} for user_id in dict.fromkeys(user_ids)]
+        items = batch_get_items(self._table, keys)
+        return {item["UserID"]: item for item in items}
+
     def get_user_role(self, user_id):
-        user = self.get_user(user_id)
-        return user["Role"]
+        user_role = self._role_cache.get(user_id)
+        if user_role is None:
+            user = self.get_user(user_id)
+            user_role = user["Role"]
+            self._role_cache[user_id] = user_role
+        return user_role
 
     def get_user_by_google_id(self, google_id):
-        response = self._table.scan(FilterExpression=Attr("GoogleID").eq(google_id))
-        return response["Items"]
+        return list(self._query_index("GoogleIDIndex", Key("GoogleID").eq(google_id)))
+
+    def find_user_by_google_id(self, google_id):
+        return self._find_one("GoogleIDIndex", Key("GoogleID").eq(google_id))
 
     def get_user_by_email(self, email):
-        response = self._table.scan(FilterExpression=Attr("EmailID").eq(email))
-        return response["Items"]
+        return list(self._query_index("EmailIndex", Key("EmailID").eq(email)))
 
-    def get_users_by_role(self, role):
-        response = self._table.scan(FilterExpression=Attr("Role").eq(role))
-        return response["Items"]
+    def find_user_by_email(self, email):
+        return self._find_one("EmailIndex", Key("EmailID").eq(email))
+
+    def get_users_by_role(self, role, attributes=None):
+        return list(self.iter_users_by_role(role, attributes=attributes))
+
+    def iter_users_by_role(self, role, attributes=None):
+        return self._query_index(
+            "RoleIndex", Key("Role").eq(role), **with_projection({}, attributes)
+        )
 
     def get_user_by_uin(self, uin):
-        response = self._table.scan(FilterExpression=Attr("UIN").eq(uin))
-        return response["Items"]
+        # UIN is stored as the string of its number (see parse_uin), the index key type is S
+        return list(self._query_index("UINIndex", Key("UIN").eq(str(uin))))
+
+    def find_user_by_uin(self, uin):
+        return self._find_one("UINIndex", Key("UIN").eq(str(uin)))
 
     def delete_user(self, user_id):
+        self._role_cache.pop(user_id, None)
         self._table.delete_item(
             Key={
                 "UserID": user_id,
             }
         )
 
+    def _query_index(self, index_name, key_condition, **query_params):
+        return iter_query(
+            self._table,
+            IndexName=index_name,
+            KeyConditionExpression=key_condition,
+            **query_params,
+        )
+
+    def backfill_uins(self):
+        """
+        Rewrite the UINs stored as numbers (by the CSV importers before UINIndex existed) as the
+        string of their number, see parse_uin. One-off, it has to run before UINIndex is created:
+        DynamoDB rejects every write of an item whose UIN does not match the string index key.
+        Returns how many users were updated.
+        """
+        scan_params = with_projection(
+            {"FilterExpression": Attr("UIN").attribute_type("N")},
+            ["UIN"],
+            ("UserID",),
+        )
+        updated = 0
+        for user in iter_scan(self._table, **scan_params):
+            try:
+                self._table.update_item(
+                    Key={"UserID": user["UserID"]},
+                    UpdateExpression="SET UIN = :uin",
+                    ConditionExpression="UIN = :previous_uin",
+                    ExpressionAttributeValues={
+                        ":uin": str(int(user["UIN"])),
+                        ":previous_uin": user["UIN"],
+                    },
+                )
+            except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Changed in the meantime
+                continue
+            updated += 1
+        return updated
+
+    def _find_one(self, index_name, key_condition):
+        # Lookup attributes are unique per user, a single item read is enough
+        return next(self._query_index(index_name, key_condition, Limit=1), None)
+
     def _add_to_filter_expression(self, expression, condition):
         if expression is None:
             return condition
@@ -374,10 +932,16 @@ class MetricDB(object):
     def get_metric(self, user_id, panel_id):
         pass
 
+    def get_metrics_batch(self, keys):
+        pass
+
     def update_metric(self, metric):
         pass
 
-    def list_metrics(self):
+    def list_metrics(self, total_segments=None):
+        pass
+
+    def iter_metrics(self):
         pass
 
     def add_metrics_batch(self, metrics):
@@ -392,7 +956,11 @@ class MetricDB(object):
     def get_metrics_by_panel(self, panel_id):
         pass
 
+    def iter_metrics_by_panel(self, panel_id):
+        pass
+
 
+@instrumented
 class DynamoMetricDB(MetricDB):
     def __init__(self, table_resource):
         self._table = table_resource
@@ -401,9 +969,7 @@ class DynamoMetricDB(MetricDB):
         return self._table.put_item(Item=metric)
 
     def add_metrics_batch(self, metrics):
-        with self._table.batch_writer() as batch:
-            for metric in metrics:
-                batch.put_item(Item=metric)
+        return batch_write_items(self._table, metrics, ("UserID", "PanelID"))
 
     def get_metric(self, user_id, panel_id):
         response = self._table.get_item(
@@ -414,12 +980,23 @@ class DynamoMetricDB(MetricDB):
         )
         return response.get("Item")
 
+    def get_metrics_batch(self, keys):
+        # keys: iterable of (user_id, panel_id) tuples
+        batch_keys = [
+            {"UserID": user_id, "PanelID": panel_id}
+            for user_id, panel_id in dict.fromkeys(keys)
+        ]
+        items = batch_get_items(self._table, batch_keys)
+        return {(item["UserID"], item["PanelID"]): item for item in items}
+
     def update_metric(self, metric):
         return self._table.put_item(Item=metric)
 
-    def list_metrics(self):
-        response = self._table.scan()
-        return response["Items"]
+    def list_metrics(self, total_segments=None):
+        return parallel_scan(self._table, total_segments)
+
+    def iter_metrics(self):
+        return iter_scan(self._table)
 
     def delete_metric(self, user_id, panel_id):
         self._table.delete_item(
@@ -430,38 +1007,82 @@ class DynamoMetricDB(MetricDB):
         )
 
     def get_metrics_by_user(self, user_id):
-        response = self._table.scan(FilterExpression=Attr("UserID").eq(user_id))
-        return response["Items"]
+        # UserID is the partition key of the table itself, no index needed
+        return list(
+            iter_query(self._table, KeyConditionExpression=Key("UserID").eq(user_id))
+        )
 
     def get_metrics_by_panel(self, panel_id):
-        response = self._table.scan(FilterExpression=Attr("PanelID").eq(panel_id))
-        return response["Items"]
+        return list(self.iter_metrics_by_panel(panel_id))
+
+    def iter_metrics_by_panel(self, panel_id):
+        return iter_query(
+            self._table,
+            IndexName="PanelIDIndex",
+            KeyConditionExpression=Key("PanelID").eq(panel_id),
+        )
 
 
 class LogDB(object):
     def list_logs(self):
         pass
 
+    def iter_logs(self):
+        pass
+
     def add_log(self, log):
         pass
 
+    def flush_logs(self):
+        pass
+
     def get_log(self, log_id):
         pass
 
     def get_logs_by_date(self, date):
         pass
 
+    def get_logs_by_date_range(self, start, end):
+        pass
+
+    def iter_logs_by_date_range(self, start, end):
+        pass
+
+    def get_logs_by_user(self, user_id, start=None, end=None):
+        pass
+
+    def get_logs_by_panel(self, panel_id, start=None, end=None):
+        pass
+
+    def backfill_log_dates(self):
+        pass
+
 
+@instrumented
 class DynamoLogDB(LogDB):
     def __init__(self, table_resource):
         self._table = table_resource
+        # Logs are written in batches at the end of the invocation, see flush_logs
+        self._buffer = []
 
     def list_logs(self):
-        response = self._table.scan()
-        return response["Items"]
+        return list(self.iter_logs())
+
+    def iter_logs(self):
+        return iter_scan(self._table)
 
     def add_log(self, log):
-        return self._table.put_item(Item=log)
+        self._buffer.append(with_log_date(log))
+        if len(self._buffer) >= LOG_BUFFER_MAX_SIZE:
+            self.flush_logs()
+
+    def flush_logs(self):
+        """Write the buffered logs with BatchWriteItem, returns how many were written."""
+        logs, self._buffer = self._buffer, []
+        if logs:
+            # Flushed by the request middleware, it must never sleep for pacing
+            batch_write_items(self._table, logs, ("LogID",), paced=False)
+        return len(logs)
 
     def get_log(self, log_id):
         response = self._table.get_item(
@@ -472,4 +1093,563 @@ class DynamoLogDB(LogDB):
         return response.get("Item")
 
     def get_logs_by_date(self, date):
+        """Logs of one day (YYYY-MM-DD), oldest first."""
+        return list(self._query_index("LogDateIndex", Key("LogDate").eq(date)))
+
+    def get_logs_by_date_range(self, start, end):
+        return list(self.iter_logs_by_date_range(start, end))
+
+    def iter_logs_by_date_range(self, start, end):
+        """Logs created between start and end (dates or timestamps, inclusive), one day bucket at a time."""
+        start, end = _created_at_bounds(start, end)
+        for date in _iter_log_dates(start, end):
+            yield from self._query_index(
+                "LogDateIndex",
+                Key("LogDate").eq(date) & Key("CreatedAt").between(start, end),
+            )
+
+    def get_logs_by_user(self, user_id, start=None, end=None):
+        return list(
+            self._query_index(
+                "UserIDIndex",
+                _created_at_condition(Key("UserID").eq(user_id), start, end),
+            )
+        )
+
+    def get_logs_by_panel(self, panel_id, start=None, end=None):
+        return list(
+            self._query_index(
+                "PanelIDIndex",
+                _created_at_condition(Key("PanelID").eq(panel_id), start, end),
+            )
+        )
+
+    def backfill_log_dates(self):
+        """
+        Set the LogDate of the logs written before LogDateIndex existed, they are not in the index
+        (and the date queries) without it. One-off, logs written since get it with with_log_date.
+        Returns how many logs were updated.
+        """
+        scan_params = with_projection(
+            {
+                "FilterExpression": Attr("LogDate").not_exists()
+                & Attr("CreatedAt").exists()
+            },
+            ["CreatedAt"],
+            ("LogID",),
+        )
+        updated = 0
+        for log in iter_scan(self._table, **scan_params):
+            try:
+                self._table.update_item(
+                    Key={"LogID": log["LogID"]},
+                    UpdateExpression="SET LogDate = :log_date",
+                    ConditionExpression="attribute_not_exists(LogDate)",
+                    ExpressionAttributeValues={
+                        ":log_date": with_log_date(log)["LogDate"]
+                    },
+                )
+            except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+                # Set in the meantime
+                continue
+            updated += 1
+        return updated
+
+    def _query_index(self, index_name, key_condition, **query_params):
+        return iter_query(
+            self._table,
+            IndexName=index_name,
+            KeyConditionExpression=key_condition,
+            **query_params,
+        )
+
+
+def with_log_date(log):
+    """Log with its LogDate day bucket, the partition key of LogDateIndex."""
+    if "CreatedAt" not in log:
+        log = dict(log, CreatedAt=_current_time_utc())
+    if "LogDate" not in log:
+        # CreatedAt is ISO 8601 in UTC, e.g. 2021-09-01T12:00:00Z
+        log = dict(log, LogDate=log["CreatedAt"][:10])
+    return log
+
+
+def _current_time_utc():
+    # Same format as chalicelib.utils.get_current_time_utc, e.g. 2021-09-01T12:00:00Z
+    return datetime.now(timezone.utc).isoformat(timespec="seconds").replace("+00:00", "Z")
+
+
+def _created_at_bounds(start, end):
+    # A bare date covers the whole day
+    if len(start) == len("YYYY-MM-DD"):
+        start = f"{start}T00:00:00Z"
+    if len(end) == len("YYYY-MM-DD"):
+        end = f"{end}T23:59:59Z"
+    return start, end
+
+
+def _created_at_condition(key_condition, start, end):
+    if start is None and end is None:
+        return key_condition
+    start, end = _created_at_bounds(start or "0000-01-01", end or "9999-12-31")
+    return key_condition & Key("CreatedAt").between(start, end)
+
+
+def _iter_log_dates(start, end):
+    date = datetime.fromisoformat(start[:10]).date()
+    last_date = datetime.fromisoformat(end[:10]).date()
+    while date <= last_date:
+        yield date.isoformat()
+        date += timedelta(days=1)
+
+
+"""Submission Database Service"""
+
+
+class AlreadySubmittedError(ValueError):
+    """The stage was already submitted by the student, the submission is not stored again."""
+
+
+class SubmissionDB(object):
+    def __init__(self, question_db, metric_db, log_db):
+        self._question_db = question_db
+        self._metric_db = metric_db
+        self._log_db = log_db
+
+    def submit_tagging(self, panel_id, user_id, question_lists, metric_updates, log):
+        pass
+
+    def submit_similar(self, panel_id, user_id, similar_sets, metric_updates):
+        pass
+
+    def link_similar(self, similar_sets):
+        pass
+
+    def submit_votes(self, panel_id, user_id, vote_scores, metric_updates):
+        pass
+
+    def claim_late_tag_questions(self, panel_id, user_id, question_ids, tag_stage_in_time):
         pass
+
+
+@instrumented
+class DynamoSubmissionDB(SubmissionDB):
+    """
+    Writes the questions, the metric and the log of a tagging stage submission together with
+    TransactWriteItems, either everything is stored or nothing is.
+    """
+
+    def submit_tagging(self, panel_id, user_id, question_lists, metric_updates, log):
+        """
+        Add user_id to the lists (LikedBy, DislikedBy, FlaggedBy) of every question in question_lists,
+        a {question_id: [list names]} map, update the metric and store the log.
+        Lists already containing the user are left untouched.
+        Raises ValueError if a question or the metric does not exist.
+        """
+        pending = {
+            question_id: list(dict.fromkeys(list_names))
+            for question_id, list_names in question_lists.items()
+        }
+        for _ in range(DYNAMODB_BATCH_MAX_RETRIES + 1):
+            question_ids = [
+                question_id for question_id, list_names in pending.items() if list_names
+            ]
+            actions = [
+                self._add_user_to_lists_action(
+                    question_id, user_id, pending[question_id]
+                )
+                for question_id in question_ids
+            ]
+            actions.append(
+                self._update_metric_action(user_id, panel_id, metric_updates)
+            )
+            actions.append(
+                {
+                    "Put": {
+                        "TableName": self._log_db._table.name,
+                        "Item": with_log_date(log),
+                    }
+                }
+            )
+            failed = self._transact_write(actions)
+            if failed is None:
+                return
+            for position, item in failed:
+                if position >= len(question_ids):
+                    raise ValueError(f"Metrics for user {user_id} not found")
+                question_id = question_ids[position]
+                if item is None:
+                    raise ValueError(f"Invalid question_id {question_id}")
+                # The user is already in some of the lists (e.g. a resubmission)
+                pending[question_id] = [
+                    name
+                    for name in pending[question_id]
+                    if user_id not in item.get(name, [])
+                ]
+        raise RuntimeError(f"Could not submit tagging of user {user_id}")
+
+    def submit_similar(self, panel_id, user_id, similar_sets, metric_updates):
+        """
+        Merge the clusters of every set of similar question ids and update the metric. The
+        clusters are a disjoint-set kept in the ClusterParent/ClusterRank pointers of the
+        questions (see cluster_similar_questions). The roots are read once and written back only
+        if another submission did not change them in between, otherwise they are read
+        (consistently, after a jittered backoff) and merged again.
+        Merges of more questions than a transaction holds are written by consecutive
+        transactions, each of them leaves consistent clusters and the metric goes with the last.
+        Raises ValueError if a question or the metric does not exist.
+        """
+        self._merge_similar(
+            similar_sets,
+            [self._update_metric_action(user_id, panel_id, metric_updates)],
+            f"Metrics for user {user_id} not found",
+        )
+
+    def link_similar(self, similar_sets):
+        """
+        Merge sets of similar question ids found by the application (see find_near_duplicates)
+        like submit_similar does, without a metric to update.
+        """
+        self._merge_similar(similar_sets, [], None)
+
+    def submit_votes(self, panel_id, user_id, vote_scores, metric_updates):
+        """
+        Add the scores of vote_scores, a {question_id: score} map, to the VoteScore of the
+        questions and update the metric, in one transaction. The VoteStageOutTime of the metric
+        marks the student as voted, only the first submission of a student is counted.
+        Raises ValueError if a question or the metric does not exist, or the student already voted.
+        """
+        question_ids = list(vote_scores)
+        actions = [
+            {
+                "Update": {
+                    "TableName": self._question_db._table.name,
+                    "Key": {"QuestionID": question_id},
+                    # ADD is applied atomically by DynamoDB, concurrent votes are never lost
+                    "UpdateExpression": "ADD VoteScore :score",
+                    "ConditionExpression": "attribute_exists(QuestionID)",
+                    "ExpressionAttributeValues": {":score": vote_scores[question_id]},
+                }
+            }
+            for question_id in question_ids
+        ]
+        actions.append(
+            self._update_metric_action(
+                user_id, panel_id, metric_updates, unset_attribute="VoteStageOutTime"
+            )
+        )
+        failed = self._transact_write(actions)
+        if failed is None:
+            return
+        for position, item in failed:
+            if position < len(question_ids):
+                raise ValueError(f"Invalid question_id {question_ids[position]}")
+            if item is None:
+                raise ValueError(f"Metrics for user {user_id} not found")
+            raise AlreadySubmittedError(f"Votes of user {user_id} were already submitted")
+
+    def claim_late_tag_questions(self, panel_id, user_id, question_ids, tag_stage_in_time):
+        """
+        Store question_ids as the tagging questions of a student who joined after the panel was
+        distributed, together with its TagStageInTime, and add one to the LateTagCoverage of each
+        of them, in one transaction.
+        Only the first claim of a student is stored, so concurrent requests can not count the
+        coverage twice or hand out two sets. Returns the question ids the student ends up with.
+        The metric of the student is created when it is missing, students enrolled after the panel
+        was created have none.
+        Raises ValueError if a question does not exist.
+        """
+        actions = [
+            {
+                "Update": {
+                    "TableName": self._metric_db._table.name,
+                    "Key": {"UserID": user_id, "PanelID": panel_id},
+                    "UpdateExpression": "SET LateTagQuestions = :question_ids,"
+                    " TagStageInTime = :tag_stage_in_time,"
+                    " CreatedAt = if_not_exists(CreatedAt, :created_at)",
+                    "ConditionExpression": "attribute_not_exists(LateTagQuestions)",
+                    "ExpressionAttributeValues": {
+                        ":question_ids": question_ids,
+                        ":tag_stage_in_time": tag_stage_in_time,
+                        ":created_at": _current_time_utc(),
+                    },
+                    "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+                }
+            }
+        ]
+        actions.extend(
+            {
+                "Update": {
+                    "TableName": self._question_db._table.name,
+                    "Key": {"QuestionID": question_id},
+                    "UpdateExpression": "ADD LateTagCoverage :one",
+                    "ConditionExpression": "attribute_exists(QuestionID)",
+                    "ExpressionAttributeValues": {":one": 1},
+                }
+            }
+            for question_id in question_ids
+        )
+        failed = self._transact_write(actions)
+        if failed is None:
+            return question_ids
+        for position, item in failed:
+            if position > 0:
+                raise ValueError(f"Invalid question_id {question_ids[position - 1]}")
+            # Another request claimed the questions of the student first
+            return item["LateTagQuestions"]
+
+    def _merge_similar(self, similar_sets, actions, failed_action_error):
+        similar_sets = [
+            list(dict.fromkeys(similar_set)) for similar_set in similar_sets
+        ]
+        question_ids = list(
+            dict.fromkeys(
+                question_id
+                for similar_set in similar_sets
+                for question_id in similar_set
+            )
+        )
+        for attempt in range(DYNAMODB_BATCH_MAX_RETRIES + 1):
+            if attempt:
+                # Another submission changed some of the clusters, back off before reading them again
+                sleep(uniform(0, DYNAMODB_BATCH_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            questions = self._get_cluster_questions(question_ids)
+            for question_id in question_ids:
+                if question_id not in questions:
+                    raise ValueError(f"Invalid question_id {question_id}")
+
+            transactions = self._union_clusters(
+                questions, similar_sets, DYNAMODB_TRANSACTION_MAX_ITEMS - len(actions)
+            )
+            transactions[-1].extend(actions)
+            for transaction in transactions:
+                failed = self._transact_write(transaction)
+                if failed is not None:
+                    break
+            else:
+                return
+            for position, item in failed:
+                if transaction is transactions[-1] and position >= len(
+                    transaction
+                ) - len(actions):
+                    raise ValueError(failed_action_error)
+        raise RuntimeError(f"Could not merge similar questions {question_ids}")
+
+    def _get_cluster_questions(self, question_ids):
+        """
+        The cluster pointers of the questions and of every question on the way to their roots,
+        read consistently since they are written back conditionally.
+        """
+        questions = {}
+        pending = question_ids
+        while pending:
+            items = batch_get_items(
+                self._question_db._table,
+                [{"QuestionID": question_id} for question_id in pending],
+                **with_projection(
+                    {"ConsistentRead": True},
+                    ["ClusterParent", "ClusterRank"],
+                    ("QuestionID",),
+                ),
+            )
+            questions.update((item["QuestionID"], item) for item in items)
+            pending = list(
+                dict.fromkeys(
+                    item["ClusterParent"]
+                    for item in items
+                    if item.get("ClusterParent", item["QuestionID"]) not in questions
+                )
+            )
+        return questions
+
+    def _union_clusters(self, questions, similar_sets, transaction_size):
+        """
+        Union the clusters of every set on the pointers of the questions read, by rank.
+        Returns the actions writing the changed roots, split into transactions of at most
+        transaction_size actions between two unions, so every transaction leaves consistent
+        clusters. Each action is conditioned on the pointers its transaction starts from.
+        """
+        stored = {
+            question_id: (question.get("ClusterParent"), question.get("ClusterRank"))
+            for question_id, question in questions.items()
+        }
+        parents = {
+            question_id: question.get("ClusterParent", question_id)
+            for question_id, question in questions.items()
+        }
+        ranks = {
+            question_id: question.get("ClusterRank", 0)
+            for question_id, question in questions.items()
+        }
+
+        def find(question_id):
+            # A parent that was deleted leaves its children as roots
+            while (
+                parents[question_id] != question_id and parents[question_id] in parents
+            ):
+                question_id = parents[question_id]
+            return question_id
+
+        transactions = []
+        changed_ids = []
+
+        def end_transaction():
+            transactions.append(
+                [
+                    self._set_cluster_action(
+                        question_id,
+                        parents[question_id],
+                        ranks[question_id],
+                        *stored[question_id],
+                    )
+                    for question_id in changed_ids
+                ]
+            )
+            stored.update(
+                (question_id, (parents[question_id], ranks[question_id]))
+                for question_id in changed_ids
+            )
+            changed_ids.clear()
+
+        for similar_set in similar_sets:
+            for question_id in similar_set[1:]:
+                root, other_root = find(similar_set[0]), find(question_id)
+                if root == other_root:
+                    continue
+                if ranks[root] < ranks[other_root]:
+                    root, other_root = other_root, root
+                # The root is only written when its rank grows
+                union_ids = [other_root, root][
+                    : 2 if ranks[root] == ranks[other_root] else 1
+                ]
+                new_ids = [
+                    union_id for union_id in union_ids if union_id not in changed_ids
+                ]
+                if len(changed_ids) + len(new_ids) > transaction_size:
+                    end_transaction()
+                    new_ids = union_ids
+                parents[other_root] = root
+                if ranks[root] == ranks[other_root]:
+                    ranks[root] += 1
+                changed_ids.extend(new_ids)
+        end_transaction()
+        return transactions
+
+    def _set_cluster_action(
+        self, question_id, parent, rank, previous_parent, previous_rank
+    ):
+        # Written back only if the pointers are still the ones read, a root changed by another
+        # submission in between fails the transaction
+        values = {":parent": parent, ":rank": rank}
+        conditions = ["attribute_exists(QuestionID)"]
+        for name, placeholder, previous in (
+            ("ClusterParent", ":previous_parent", previous_parent),
+            ("ClusterRank", ":previous_rank", previous_rank),
+        ):
+            if previous is None:
+                conditions.append(f"attribute_not_exists({name})")
+            else:
+                conditions.append(f"{name} = {placeholder}")
+                values[placeholder] = previous
+        return {
+            "Update": {
+                "TableName": self._question_db._table.name,
+                "Key": {"QuestionID": question_id},
+                "UpdateExpression": "SET ClusterParent = :parent, ClusterRank = :rank",
+                "ConditionExpression": " AND ".join(conditions),
+                "ExpressionAttributeValues": values,
+            }
+        }
+
+    def _add_user_to_lists_action(self, question_id, user_id, list_names):
+        names = {f"#attr{i}": name for i, name in enumerate(list_names)}
+        set_clauses = [
+            f"{placeholder} = list_append(if_not_exists({placeholder}, :empty), :user)"
+            for placeholder in names
+        ]
+        conditions = ["attribute_exists(QuestionID)"] + [
+            f"NOT contains({placeholder}, :user_id)" for placeholder in names
+        ]
+        return {
+            "Update": {
+                "TableName": self._question_db._table.name,
+                "Key": {"QuestionID": question_id},
+                "UpdateExpression": "SET " + ", ".join(set_clauses),
+                "ConditionExpression": " AND ".join(conditions),
+                "ExpressionAttributeNames": names,
+                "ExpressionAttributeValues": {
+                    ":empty": [],
+                    ":user": [user_id],
+                    ":user_id": user_id,
+                },
+                "ReturnValuesOnConditionCheckFailure": "ALL_OLD",
+            }
+        }
+
+    def _update_metric_action(
+        self, user_id, panel_id, metric_updates, unset_attribute=None
+    ):
+        # With unset_attribute, the update only goes through while the metric does not have it
+        names = {f"#metric{i}": name for i, name in enumerate(metric_updates)}
+        values = {
+            f":metric{i}": value for i, value in enumerate(metric_updates.values())
+        }
+        set_clauses = [
+            f"{placeholder} = :metric{i}" for i, placeholder in enumerate(names)
+        ]
+        action = {
+            "TableName": self._metric_db._table.name,
+            "Key": {"UserID": user_id, "PanelID": panel_id},
+            "UpdateExpression": "SET " + ", ".join(set_clauses),
+            "ConditionExpression": "attribute_exists(UserID)",
+            "ExpressionAttributeNames": names,
+            "ExpressionAttributeValues": values,
+        }
+        if unset_attribute is not None:
+            names["#unset"] = unset_attribute
+            action["ConditionExpression"] += " AND attribute_not_exists(#unset)"
+            action["ReturnValuesOnConditionCheckFailure"] = "ALL_OLD"
+        return {"Update": action}
+
+    def _transact_write(self, actions):
+        """
+        Run the actions with TransactWriteItems, all of them or none.
+        Returns None on success, or the (position, old item) of every action whose condition
+        failed. Conflicts with other transactions are retried with backoff.
+        Raises ValueError for more actions than a transaction holds, splitting them would give up
+        the atomicity callers rely on.
+        """
+        if len(actions) > DYNAMODB_TRANSACTION_MAX_ITEMS:
+            raise ValueError(
+                f"{len(actions)} actions do not fit in one transaction of {DYNAMODB_TRANSACTION_MAX_ITEMS}"
+            )
+        if not actions:
+            return None
+        client = self._question_db._table.meta.client
+        attempt = 0
+        while True:
+            try:
+                client.transact_write_items(TransactItems=actions)
+                return None
+            except client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get("CancellationReasons", [])
+                failed = [
+                    (position, _deserialize_item(reason.get("Item")))
+                    for position, reason in enumerate(reasons)
+                    if reason.get("Code") == "ConditionalCheckFailed"
+                ]
+                if failed:
+                    return failed
+                if attempt >= DYNAMODB_BATCH_MAX_RETRIES:
+                    raise
+                # TransactionConflict or throttling, back off before trying again
+                sleep(uniform(0, DYNAMODB_BATCH_RETRY_BASE_DELAY * 2**attempt))
+                attempt += 1
+
+
+def _deserialize_item(item):
+    # Items in cancellation reasons come back in the low level format
+    if item is None:
+        return None
+    deserializer = TypeDeserializer()
+    return {name: deserializer.deserialize(value) for name, value in item.items()}
@@ -0,0 +1,283 @@
+"""Request scoped identity map for the database providers.
+
+While a scope is active, the get_*_db() factories hand out wrappers that remember every item read
+or written by primary key. Repeated reads of the same item are served from memory instead of
+doing another round trip to DynamoDB. Scopes are opt-in, see `with_identity_map`.
+"""
+
+from functools import wraps
+
+from chalicelib.database.instrumentation import get_request_metrics
+
+_ACTIVE_MAP = None
+
+
+class IdentityMap(object):
+    def __init__(self):
+        self._items = {}
+        self._providers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return (found, item). Items known to be missing are cached as None."""
+        if key in self._items:
+            self.hits += 1
+            return True, self._items[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key, item):
+        self._items[key] = item
+
+    def forget(self, key):
+        self._items.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "items": len(self._items)}
+
+
+def get_identity_map():
+    return _ACTIVE_MAP
+
+
+def start_identity_map():
+    global _ACTIVE_MAP
+    _ACTIVE_MAP = IdentityMap()
+    return _ACTIVE_MAP
+
+
+def end_identity_map():
+    global _ACTIVE_MAP
+    identity_map, _ACTIVE_MAP = _ACTIVE_MAP, None
+    return identity_map.stats() if identity_map is not None else None
+
+
+def with_identity_map(function):
+    """
+    Run the decorated function inside its own identity map scope. Its hit/miss counts go to the
+    request metrics, when they are recorded (see DB_METRICS_ENABLED).
+    """
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        # Nested scopes share the outer map (e.g. a route calling grading_script)
+        if _ACTIVE_MAP is not None:
+            return function(*args, **kwargs)
+        start_identity_map()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats = end_identity_map()
+            metrics = get_request_metrics()
+            if metrics is not None:
+                metrics.record_identity_map(function.__name__, stats)
+
+    return wrapper
+
+
+def wrap_provider(provider, wrapper_class):
+    """Return the provider wrapped for the active scope, or the provider itself if there is none."""
+    identity_map = _ACTIVE_MAP
+    if identity_map is None or isinstance(provider, dict):
+        # Factories return a dict when the provider could not be created, leave it alone
+        return provider
+    if wrapper_class not in identity_map._providers:
+        identity_map._providers[wrapper_class] = wrapper_class(provider, identity_map)
+    return identity_map._providers[wrapper_class]
+
+
+class _CachedProvider(object):
+    _kind = None
+
+    def __init__(self, provider, identity_map):
+        self._provider = provider
+        self._map = identity_map
+
+    def __getattr__(self, name):
+        # Everything that is not keyed by primary key goes straight to the real provider
+        return getattr(self._provider, name)
+
+    def _read(self, key, loader):
+        found, item = self._map.lookup((self._kind, key))
+        if not found:
+            item = loader()
+            self._map.store((self._kind, key), item)
+        return item
+
+    def _read_batch(self, keys, loader):
+        items = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            found, item = self._map.lookup((self._kind, key))
+            if not found:
+                missing.append(key)
+            elif item is not None:
+                items[key] = item
+        if missing:
+            loaded = loader(missing)
+            for key in missing:
+                self._map.store((self._kind, key), loaded.get(key))
+            items.update(loaded)
+        return items
+
+    def _store(self, key, item):
+        self._map.store((self._kind, key), item)
+
+    def _forget(self, key):
+        self._map.forget((self._kind, key))
+
+
+class CachedQuestionDB(_CachedProvider):
+    _kind = "question"
+
+    def get_question(self, question_id):
+        return self._read(question_id, lambda: self._provider.get_question(question_id))
+
+    def get_questions_batch(self, question_ids, attributes=None):
+        if attributes is not None:
+            # Partial items must never be served as whole ones, bypass the map
+            return self._provider.get_questions_batch(question_ids, attributes)
+        return self._read_batch(question_ids, self._provider.get_questions_batch)
+
+    def add_question(self, question):
+        self._provider.add_question(question)
+        self._store(question["QuestionID"], question)
+
+    def add_questions_batch(self, questions):
+        questions = list(questions)
+        response = self._provider.add_questions_batch(questions)
+        for question in questions:
+            self._store(question["QuestionID"], question)
+        return response
+
+    def delete_question(self, question_id):
+        self._provider.delete_question(question_id)
+        self._store(question_id, None)
+
+
+class CachedPanelDB(_CachedProvider):
+    _kind = "panel"
+
+    def get_panel(self, panel_id):
+        return self._read(panel_id, lambda: self._provider.get_panel(panel_id))
+
+    def add_panel(self, panel):
+        response = self._provider.add_panel(panel)
+        self._store(panel["PanelID"], panel)
+        return response
+
+    def update_panel(self, panel):
+        response = self._provider.update_panel(panel)
+        # Only some of the attributes were given, the next read has to go to the database
+        self._forget(panel["PanelID"])
+        return response
+
+    def acquire_panel_lease(self, panel_id, lease_name, lease_seconds):
+        acquired = self._provider.acquire_panel_lease(
+            panel_id, lease_name, lease_seconds
+        )
+        self._forget(panel_id)
+        return acquired
+
+
+class CachedUserDB(_CachedProvider):
+    _kind = "user"
+
+    def get_user(self, user_id):
+        return self._read(user_id, lambda: self._provider.get_user(user_id))
+
+    def get_users_batch(self, user_ids):
+        return self._read_batch(user_ids, self._provider.get_users_batch)
+
+    def add_user(self, user):
+        response = self._provider.add_user(user)
+        self._store(user["UserID"], user)
+        return response
+
+    def update_user(self, user):
+        response = self._provider.update_user(user)
+        self._store(user["UserID"], user)
+        return response
+
+    def add_user_google_id(self, user_id, google_id):
+        response = self._provider.add_user_google_id(user_id, google_id)
+        self._forget(user_id)
+        return response
+
+    def delete_user(self, user_id):
+        self._provider.delete_user(user_id)
+        self._store(user_id, None)
+
+
+class CachedMetricDB(_CachedProvider):
+    _kind = "metric"
+
+    def get_metric(self, user_id, panel_id):
+        return self._read(
+            (user_id, panel_id), lambda: self._provider.get_metric(user_id, panel_id)
+        )
+
+    def get_metrics_batch(self, keys):
+        return self._read_batch(keys, self._provider.get_metrics_batch)
+
+    def add_metric(self, metric):
+        response = self._provider.add_metric(metric)
+        self._store((metric["UserID"], metric["PanelID"]), metric)
+        return response
+
+    def update_metric(self, metric):
+        response = self._provider.update_metric(metric)
+        self._store((metric["UserID"], metric["PanelID"]), metric)
+        return response
+
+    def add_metrics_batch(self, metrics):
+        metrics = list(metrics)
+        response = self._provider.add_metrics_batch(metrics)
+        for metric in metrics:
+            self._store((metric["UserID"], metric["PanelID"]), metric)
+        return response
+
+    def delete_metric(self, user_id, panel_id):
+        self._provider.delete_metric(user_id, panel_id)
+        self._store((user_id, panel_id), None)
+
+
+class CachedSubmissionDB(_CachedProvider):
+    _kind = "submission"
+
+    def submit_tagging(self, panel_id, user_id, question_lists, metric_updates, log):
+        self._provider.submit_tagging(
+            panel_id, user_id, question_lists, metric_updates, log
+        )
+        self._forget_submission(panel_id, user_id, question_lists)
+
+    def submit_similar(self, panel_id, user_id, similar_sets, metric_updates):
+        self._provider.submit_similar(panel_id, user_id, similar_sets, metric_updates)
+        question_ids = [
+            question_id for similar_set in similar_sets for question_id in similar_set
+        ]
+        self._forget_submission(panel_id, user_id, question_ids)
+
+    def link_similar(self, similar_sets):
+        self._provider.link_similar(similar_sets)
+        for similar_set in similar_sets:
+            for question_id in similar_set:
+                self._map.forget(("question", question_id))
+
+    def submit_votes(self, panel_id, user_id, vote_scores, metric_updates):
+        self._provider.submit_votes(panel_id, user_id, vote_scores, metric_updates)
+        self._forget_submission(panel_id, user_id, vote_scores)
+
+    def claim_late_tag_questions(self, panel_id, user_id, question_ids, tag_stage_in_time):
+        claimed_ids = self._provider.claim_late_tag_questions(
+            panel_id, user_id, question_ids, tag_stage_in_time
+        )
+        self._forget_submission(panel_id, user_id, question_ids)
+        return claimed_ids
+
+    def _forget_submission(self, panel_id, user_id, question_ids):
+        # The items were updated in place, the next read has to go to the database
+        for question_id in question_ids:
+            self._map.forget(("question", question_id))
+        self._map.forget(("metric", (user_id, panel_id)))
@@ -0,0 +1,235 @@
+"""Consumed capacity and latency of the DynamoDB calls made while handling a request.
+
+Every call made through an instrumented client asks DynamoDB for its ConsumedCapacity. While a
+scope is active (see `start_request_metrics`), each call is recorded with the provider method that
+made it and the totals are aggregated per method, operation, table and index.
+"""
+
+from collections import defaultdict
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from types import GeneratorType
+
+# Operations that accept ReturnConsumedCapacity
+_CAPACITY_OPERATIONS = {
+    "GetItem",
+    "PutItem",
+    "UpdateItem",
+    "DeleteItem",
+    "Query",
+    "Scan",
+    "BatchGetItem",
+    "BatchWriteItem",
+    "TransactGetItems",
+    "TransactWriteItems",
+}
+
+_ACTIVE_METRICS = None
+_INSTRUMENTED_CLIENTS = set()
+
+
+class RequestMetrics(object):
+    def __init__(self, name):
+        self.name = name
+        self._calls = defaultdict(
+            lambda: {"calls": 0, "items": 0, "consumed_capacity": 0, "seconds": 0}
+        )
+        # Provider methods being executed, the innermost one owns the calls
+        self._methods = []
+        # parallel_scan records from its worker threads
+        self._lock = Lock()
+        # Hit/miss counts of the identity map scopes, see with_identity_map
+        self._identity_maps = []
+        # Counters of batch_write_items per table (retries, throttles, pacing)
+        self._batch_writes = defaultdict(lambda: defaultdict(int))
+
+    def enter(self, method):
+        self._methods.append(method)
+
+    def exit(self):
+        self._methods.pop()
+
+    def record(self, operation, table, index, items, consumed_capacity, seconds):
+        method = self._methods[-1] if self._methods else None
+        with self._lock:
+            call = self._calls[(method, operation, table, index)]
+            call["calls"] += 1
+            call["items"] += items
+            call["consumed_capacity"] += consumed_capacity
+            call["seconds"] += seconds
+
+    def record_identity_map(self, function_name, stats):
+        self._identity_maps.append({"function": function_name, **stats})
+
+    def record_batch_write(self, table, stats):
+        with self._lock:
+            for key, value in stats.items():
+                self._batch_writes[table][key] += value
+
+    def summary(self):
+        calls = [
+            {
+                "method": method,
+                "operation": operation,
+                "table": table,
+                "index": index,
+                **call,
+                "seconds": round(call["seconds"], 4),
+            }
+            for (method, operation, table, index), call in self._calls.items()
+        ]
+        totals = {
+            key: sum(call[key] for call in calls)
+            for key in ("calls", "items", "consumed_capacity")
+        }
+        totals["seconds"] = round(sum(call["seconds"] for call in calls), 4)
+        return {
+            "name": self.name,
+            "totals": totals,
+            "calls": calls,
+            "identity_maps": self._identity_maps,
+            "batch_writes": [
+                {"table": table, **stats} for table, stats in self._batch_writes.items()
+            ],
+        }
+
+
+def get_request_metrics():
+    return _ACTIVE_METRICS
+
+
+def start_request_metrics(name):
+    global _ACTIVE_METRICS
+    _ACTIVE_METRICS = RequestMetrics(name)
+    return _ACTIVE_METRICS
+
+
+def end_request_metrics():
+    global _ACTIVE_METRICS
+    metrics, _ACTIVE_METRICS = _ACTIVE_METRICS, None
+    return metrics.summary() if metrics is not None else None
+
+
+def instrument_client(client):
+    """Register the botocore handlers on a DynamoDB client, once per client."""
+    if id(client) in _INSTRUMENTED_CLIENTS:
+        return client
+    events = client.meta.events
+    # First, the resource handler returns a copy of the params that is what gets sent
+    events.register_first("provide-client-params.dynamodb", _request_consumed_capacity)
+    events.register("before-call.dynamodb", _start_call)
+    events.register("after-call.dynamodb", _record_call)
+    _INSTRUMENTED_CLIENTS.add(id(client))
+    return client
+
+
+def instrumented(cls):
+    """Class decorator, attributes the calls made by the public methods to ClassName.method."""
+    for name, attribute in list(vars(cls).items()):
+        if callable(attribute) and not name.startswith("_"):
+            setattr(cls, name, _trace_method(f"{cls.__name__}.{name}", attribute))
+    return cls
+
+
+def _trace_method(method, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        metrics = _ACTIVE_METRICS
+        if metrics is None:
+            return function(*args, **kwargs)
+        metrics.enter(method)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            metrics.exit()
+        if isinstance(result, GeneratorType):
+            # Lazy reads happen while the caller iterates
+            return _trace_iterator(metrics, method, result)
+        return result
+
+    return wrapper
+
+
+def _trace_iterator(metrics, method, iterator):
+    while True:
+        metrics.enter(method)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            metrics.exit()
+        yield item
+
+
+def _request_consumed_capacity(params, model, context, **kwargs):
+    if _ACTIVE_METRICS is None:
+        return
+    if model.name in _CAPACITY_OPERATIONS:
+        params.setdefault("ReturnConsumedCapacity", "TOTAL")
+    # The API params, later handlers only get the serialized request
+    context["metrics_params"] = params
+
+
+def _start_call(context, **kwargs):
+    if "metrics_params" in context:
+        context["metrics_started_at"] = perf_counter()
+
+
+def _record_call(parsed, model, context, **kwargs):
+    metrics = _ACTIVE_METRICS
+    if metrics is None or "metrics_started_at" not in context:
+        return
+    seconds = perf_counter() - context["metrics_started_at"]
+    params = context["metrics_params"]
+    metrics.record(
+        model.name,
+        _table_name(params),
+        params.get("IndexName"),
+        _item_count(model.name, params, parsed),
+        _consumed_capacity(parsed),
+        seconds,
+    )
+
+
+def _table_name(params):
+    if "TableName" in params:
+        return params["TableName"]
+    if "RequestItems" in params:
+        return ",".join(sorted(params["RequestItems"]))
+    if "TransactItems" in params:
+        tables = {
+            action["TableName"]
+            for item in params["TransactItems"]
+            for action in item.values()
+        }
+        return ",".join(sorted(tables))
+    return None
+
+
+def _item_count(operation, params, parsed):
+    if "Items" in parsed:
+        return len(parsed["Items"])
+    if operation == "BatchGetItem":
+        return sum(len(items) for items in parsed.get("Responses", {}).values())
+    if operation == "BatchWriteItem":
+        requested = sum(len(items) for items in params["RequestItems"].values())
+        unprocessed = sum(
+            len(items) for items in parsed.get("UnprocessedItems", {}).values()
+        )
+        return requested - unprocessed
+    if operation in ("TransactGetItems", "TransactWriteItems"):
+        return len(params["TransactItems"])
+    if operation == "GetItem":
+        return 1 if "Item" in parsed else 0
+    return 1
+
+
+def _consumed_capacity(parsed):
+    consumed = parsed.get("ConsumedCapacity")
+    if consumed is None:
+        return 0
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return sum(capacity.get("CapacityUnits", 0) for capacity in consumed)
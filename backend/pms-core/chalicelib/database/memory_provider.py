@@ -0,0 +1,600 @@
+"""In-memory implementation of the database services.
+
+Selected with DB_BACKEND=memory. Every table is a dict keyed by primary key plus dict based secondary
+indexes mirroring the GSIs defined in terraform, so the whole panel lifecycle can run (and be profiled)
+offline without DynamoDB. Items are copied in and out and numbers are stored as Decimal, the same way
+boto3 hands them back, so callers behave like they do against the real tables.
+"""
+
+from collections import defaultdict
+from copy import deepcopy
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from chalicelib.database.db_provider import (
+    QuestionDB,
+    PanelDB,
+    UserDB,
+    MetricDB,
+    LogDB,
+    SubmissionDB,
+    AlreadySubmittedError,
+    with_log_date,
+    _parse_deadlines,
+    _created_at_bounds,
+    _current_time_utc,
+)
+
+
+def _to_dynamo(value):
+    # boto3 rejects floats and returns every number as Decimal, do the same
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {key: _to_dynamo(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_dynamo(item) for item in value]
+    if isinstance(value, set):
+        return {_to_dynamo(item) for item in value}
+    return value
+
+
+def _project(item, attributes, key_attributes=()):
+    if attributes is None:
+        return item
+    return {
+        attribute: item[attribute]
+        for attribute in dict.fromkeys([*key_attributes, *attributes])
+        if attribute in item
+    }
+
+
+class _MemoryTable(object):
+    def __init__(self, key_attributes, indexes=None):
+        self._key_attributes = key_attributes
+        self._items = {}
+        # index name -> hash attribute, and index name -> hash value -> keys of the items
+        self._index_attributes = indexes or {}
+        self._indexes = {name: defaultdict(dict) for name in self._index_attributes}
+
+    def key(self, item):
+        return tuple(_to_dynamo(item[attribute]) for attribute in self._key_attributes)
+
+    def put(self, item):
+        item = _to_dynamo(deepcopy(item))
+        key = self.key(item)
+        self._unindex(key)
+        self._items[key] = item
+        self._index(key)
+
+    def get(self, key):
+        item = self._items.get(tuple(_to_dynamo(value) for value in key))
+        return deepcopy(item) if item is not None else None
+
+    def delete(self, key):
+        key = tuple(_to_dynamo(value) for value in key)
+        self._unindex(key)
+        self._items.pop(key, None)
+
+    def update(self, key, update_function):
+        """Apply update_function to the stored item in place, returns a copy of the result."""
+        key = tuple(_to_dynamo(value) for value in key)
+        if key not in self._items:
+            return None
+        self._unindex(key)
+        update_function(self._items[key])
+        self._items[key] = _to_dynamo(self._items[key])
+        self._index(key)
+        return deepcopy(self._items[key])
+
+    def scan(self, condition=None):
+        for item in list(self._items.values()):
+            if condition is None or condition(item):
+                yield deepcopy(item)
+
+    def query(self, index_name, value, condition=None):
+        keys = list(self._indexes[index_name].get(_to_dynamo(value), {}))
+        for key in keys:
+            item = self._items[key]
+            if condition is None or condition(item):
+                yield deepcopy(item)
+
+    def _index(self, key):
+        item = self._items[key]
+        for name, attribute in self._index_attributes.items():
+            # Like GSIs, items without the attribute are not part of the index
+            if attribute in item:
+                self._indexes[name][item[attribute]][key] = None
+
+    def _unindex(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return
+        for name, attribute in self._index_attributes.items():
+            if attribute in item:
+                bucket = self._indexes[name].get(item[attribute])
+                if bucket is not None:
+                    bucket.pop(key, None)
+                    if not bucket:
+                        del self._indexes[name][item[attribute]]
+
+
+"""Question Database Service"""
+
+
+class MemoryQuestionDB(QuestionDB):
+    def __init__(self):
+        self._table = _MemoryTable(
+            ("QuestionID",),
+            indexes={"PanelIDIndex": "PanelID", "UserIDIndex": "UserID"},
+        )
+
+    def list_questions(self, startswith=None, total_segments=None):
+        return list(self.iter_questions(startswith=startswith))
+
+    def iter_questions(self, startswith=None):
+        if startswith is None:
+            return self._table.scan()
+        return self._table.scan(
+            lambda item: item.get("Name", "").startswith(startswith)
+        )
+
+    def add_question(self, question):
+        self._table.put(question)
+
+    def add_questions_batch(self, questions):
+        questions = list(questions)
+        for question in questions:
+            self._table.put(question)
+        return {"items": len(questions)}
+
+    def get_question(self, question_id):
+        return self._table.get((question_id,))
+
+    def get_questions_batch(self, question_ids, attributes=None):
+        questions = {}
+        for question_id in dict.fromkeys(question_ids):
+            question = self._table.get((question_id,))
+            if question is not None:
+                questions[question_id] = _project(question, attributes, ("QuestionID",))
+        return questions
+
+    def get_question_ids_by_panel_id(self, panel_id):
+        items = self._table.query("PanelIDIndex", panel_id)
+        return [item["QuestionID"] for item in items]
+
+    def get_questions_by_panel(self, panel_id, attributes=None):
+        return list(self.iter_questions_by_panel(panel_id, attributes=attributes))
+
+    def iter_questions_by_panel(self, panel_id, attributes=None):
+        for item in self._table.query("PanelIDIndex", panel_id):
+            yield _project(item, attributes)
+
+    def get_questions_by_user(self, user_id):
+        return list(self._table.query("UserIDIndex", user_id))
+
+    def get_my_questions_by_panel(self, panel_id, user_id):
+        return list(self.iter_my_questions_by_panel(panel_id, user_id))
+
+    def iter_my_questions_by_panel(self, panel_id, user_id):
+        return self._table.query(
+            "UserIDIndex", user_id, lambda item: item.get("PanelID") == panel_id
+        )
+
+    def delete_question(self, question_id):
+        self._table.delete((question_id,))
+
+
+""" Panel DB service """
+
+
+class MemoryPanelDB(PanelDB):
+    def __init__(self):
+        self._table = _MemoryTable(("PanelID",))
+
+    def add_panel(self, panel):
+        self._table.put(panel)
+
+    def update_panel(self, panel):
+        # Only the given attributes change, like DynamoPanelDB
+        updated = self._table.update((panel["PanelID"],), lambda item: item.update(panel))
+        if updated is None:
+            raise ValueError(f"Panel {panel['PanelID']} not found")
+
+    def get_all_panels(self):
+        return list(self.iter_all_panels())
+
+    def iter_all_panels(self):
+        return self._table.scan()
+
+    def get_public_panels(self):
+        return list(self._table.scan(lambda item: item.get("Visibility") == "public"))
+
+    def get_panel(self, panel_id):
+        return self._table.get((panel_id,))
+
+    def get_panel_deadlines(self, panel_id):
+        panel = self._table.get((panel_id,))
+        return _parse_deadlines(panel) if panel is not None else None
+
+    def get_panels_by_deadline(self, stage_name, deadline_date):
+        return list(
+            self._table.scan(
+                lambda item: str(item.get(stage_name, "")).startswith(deadline_date)
+            )
+        )
+
+    def get_number_of_questions_by_panel_id(self, panel_id):
+        panel = self._table.get((panel_id,))
+        return [int(panel["NumberOfQuestions"])] if panel is not None else []
+
+    def acquire_panel_lease(self, panel_id, lease_name, lease_seconds):
+        now = datetime.now(timezone.utc)
+        panel = self._table.get((panel_id,))
+        if panel is None or panel.get(lease_name, "") >= now.isoformat():
+            return False
+        expires = (now + timedelta(seconds=lease_seconds)).isoformat()
+        self._table.update((panel_id,), lambda item: item.update({lease_name: expires}))
+        return True
+
+
+"""User Database Service"""
+
+
+class MemoryUserDB(UserDB):
+    def __init__(self):
+        self._table = _MemoryTable(
+            ("UserID",),
+            indexes={
+                "RoleIndex": "Role",
+                "EmailIndex": "EmailID",
+                "UINIndex": "UIN",
+                "GoogleIDIndex": "GoogleID",
+            },
+        )
+
+    def list_users(self, startswith=None, total_segments=None):
+        return list(self.iter_users(startswith=startswith))
+
+    def iter_users(self, startswith=None):
+        if startswith is None:
+            return self._table.scan()
+        return self._table.scan(
+            lambda item: item.get("Name", "").startswith(startswith)
+        )
+
+    def get_student_user_ids(self):
+        return {item["UserID"] for item in self._table.query("RoleIndex", "student")}
+
+    def add_user(self, user):
+        self._table.put(user)
+
+    def update_user(self, user):
+        self._table.put(user)
+
+    def add_user_google_id(self, user_id, google_id):
+        def set_google_id(user):
+            user["GoogleID"] = google_id
+
+        return self._table.update((user_id,), set_google_id)
+
+    def get_user(self, user_id):
+        return self._table.get((user_id,))
+
+    def get_users_batch(self, user_ids):
+        users = {}
+        for user_id in dict.fromkeys(user_ids):
+            user = self._table.get((user_id,))
+            if user is not None:
+                users[user_id] = user
+        return users
+
+    def get_user_role(self, user_id):
+        return self.get_user(user_id)["Role"]
+
+    def get_user_by_google_id(self, google_id):
+        return list(self._table.query("GoogleIDIndex", google_id))
+
+    def find_user_by_google_id(self, google_id):
+        return next(self._table.query("GoogleIDIndex", google_id), None)
+
+    def get_user_by_email(self, email):
+        return list(self._table.query("EmailIndex", email))
+
+    def find_user_by_email(self, email):
+        return next(self._table.query("EmailIndex", email), None)
+
+    def get_users_by_role(self, role, attributes=None):
+        return list(self.iter_users_by_role(role, attributes=attributes))
+
+    def iter_users_by_role(self, role, attributes=None):
+        for item in self._table.query("RoleIndex", role):
+            yield _project(item, attributes)
+
+    def get_user_by_uin(self, uin):
+        return list(self._table.query("UINIndex", str(uin)))
+
+    def find_user_by_uin(self, uin):
+        return next(self._table.query("UINIndex", str(uin)), None)
+
+    def backfill_uins(self):
+        updated = 0
+        for user in self._table.scan(
+            lambda item: isinstance(item.get("UIN"), Decimal)
+        ):
+            self._table.put(dict(user, UIN=str(int(user["UIN"]))))
+            updated += 1
+        return updated
+
+    def delete_user(self, user_id):
+        self._table.delete((user_id,))
+
+
+"""Metric Database Service"""
+
+
+class MemoryMetricDB(MetricDB):
+    def __init__(self):
+        self._table = _MemoryTable(
+            ("UserID", "PanelID"),
+            indexes={"UserIDIndex": "UserID", "PanelIDIndex": "PanelID"},
+        )
+
+    def add_metric(self, metric):
+        self._table.put(metric)
+
+    def add_metrics_batch(self, metrics):
+        metrics = list(metrics)
+        for metric in metrics:
+            self._table.put(metric)
+        return {"items": len(metrics)}
+
+    def get_metric(self, user_id, panel_id):
+        return self._table.get((user_id, panel_id))
+
+    def get_metrics_batch(self, keys):
+        metrics = {}
+        for user_id, panel_id in dict.fromkeys(keys):
+            metric = self._table.get((user_id, panel_id))
+            if metric is not None:
+                metrics[(user_id, panel_id)] = metric
+        return metrics
+
+    def update_metric(self, metric):
+        self._table.put(metric)
+
+    def list_metrics(self, total_segments=None):
+        return list(self.iter_metrics())
+
+    def iter_metrics(self):
+        return self._table.scan()
+
+    def delete_metric(self, user_id, panel_id):
+        self._table.delete((user_id, panel_id))
+
+    def get_metrics_by_user(self, user_id):
+        return list(self._table.query("UserIDIndex", user_id))
+
+    def get_metrics_by_panel(self, panel_id):
+        return list(self.iter_metrics_by_panel(panel_id))
+
+    def iter_metrics_by_panel(self, panel_id):
+        return self._table.query("PanelIDIndex", panel_id)
+
+
+"""Log Database Service"""
+
+
+class MemoryLogDB(LogDB):
+    def __init__(self):
+        self._table = _MemoryTable(
+            ("LogID",),
+            indexes={
+                "LogDateIndex": "LogDate",
+                "UserIDIndex": "UserID",
+                "PanelIDIndex": "PanelID",
+            },
+        )
+
+    def list_logs(self):
+        return list(self.iter_logs())
+
+    def iter_logs(self):
+        return self._table.scan()
+
+    def add_log(self, log):
+        self._table.put(with_log_date(log))
+
+    def flush_logs(self):
+        # Nothing is buffered, logs are stored right away
+        return 0
+
+    def get_log(self, log_id):
+        return self._table.get((log_id,))
+
+    def get_logs_by_date(self, date):
+        return self._query_by_created_at("LogDateIndex", date, None, None)
+
+    def get_logs_by_date_range(self, start, end):
+        return list(self.iter_logs_by_date_range(start, end))
+
+    def iter_logs_by_date_range(self, start, end):
+        start, end = _created_at_bounds(start, end)
+        logs = self._table.scan(lambda item: start <= item.get("CreatedAt", "") <= end)
+        return iter(sorted(logs, key=lambda item: item["CreatedAt"]))
+
+    def get_logs_by_user(self, user_id, start=None, end=None):
+        return self._query_by_created_at("UserIDIndex", user_id, start, end)
+
+    def get_logs_by_panel(self, panel_id, start=None, end=None):
+        return self._query_by_created_at("PanelIDIndex", panel_id, start, end)
+
+    def backfill_log_dates(self):
+        updated = 0
+        for log in self._table.scan(
+            lambda item: "LogDate" not in item and "CreatedAt" in item
+        ):
+            self._table.put(with_log_date(log))
+            updated += 1
+        return updated
+
+    def _query_by_created_at(self, index_name, value, start, end):
+        # Like the GSIs, sorted by their CreatedAt range key
+        start, end = _created_at_bounds(start or "0000-01-01", end or "9999-12-31")
+        logs = self._table.query(
+            index_name, value, lambda item: start <= item["CreatedAt"] <= end
+        )
+        return sorted(logs, key=lambda item: item["CreatedAt"])
+
+
+"""Submission Database Service"""
+
+
+class MemorySubmissionDB(SubmissionDB):
+    def submit_tagging(self, panel_id, user_id, question_lists, metric_updates, log):
+        # Validate everything first, nothing is written if something is missing
+        for question_id in question_lists:
+            if self._question_db.get_question(question_id) is None:
+                raise ValueError(f"Invalid question_id {question_id}")
+        self._check_metric(user_id, panel_id)
+
+        for question_id, list_names in question_lists.items():
+
+            def add_user(question, list_names=list_names):
+                for name in list_names:
+                    question.setdefault(name, [])
+                    if user_id not in question[name]:
+                        question[name].append(user_id)
+
+            self._question_db._table.update((question_id,), add_user)
+        self._update_metric(user_id, panel_id, metric_updates)
+        self._log_db.add_log(log)
+
+    def submit_similar(self, panel_id, user_id, similar_sets, metric_updates):
+        questions = self._get_similar_questions(similar_sets)
+        self._check_metric(user_id, panel_id)
+        self._merge_similar(similar_sets, questions)
+        self._update_metric(user_id, panel_id, metric_updates)
+
+    def link_similar(self, similar_sets):
+        self._merge_similar(similar_sets, self._get_similar_questions(similar_sets))
+
+    def submit_votes(self, panel_id, user_id, vote_scores, metric_updates):
+        for question_id in vote_scores:
+            if self._question_db.get_question(question_id) is None:
+                raise ValueError(f"Invalid question_id {question_id}")
+        self._check_metric(user_id, panel_id)
+        if "VoteStageOutTime" in self._metric_db.get_metric(user_id, panel_id):
+            raise AlreadySubmittedError(f"Votes of user {user_id} were already submitted")
+
+        for question_id, score in vote_scores.items():
+
+            def add_score(question, score=score):
+                question["VoteScore"] = question.get("VoteScore", 0) + score
+
+            self._question_db._table.update((question_id,), add_score)
+        self._update_metric(user_id, panel_id, metric_updates)
+
+    def claim_late_tag_questions(self, panel_id, user_id, question_ids, tag_stage_in_time):
+        metric = self._metric_db.get_metric(user_id, panel_id)
+        if metric is not None and "LateTagQuestions" in metric:
+            return metric["LateTagQuestions"]
+        for question_id in question_ids:
+            if self._question_db.get_question(question_id) is None:
+                raise ValueError(f"Invalid question_id {question_id}")
+
+        for question_id in question_ids:
+            self._question_db._table.update(
+                (question_id,),
+                lambda question: question.update(
+                    LateTagCoverage=question.get("LateTagCoverage", 0) + 1
+                ),
+            )
+        if metric is None:
+            # Students enrolled after the panel was created have no metric yet
+            metric = {
+                "UserID": user_id,
+                "PanelID": panel_id,
+                "CreatedAt": _current_time_utc(),
+            }
+        self._metric_db._table.put(
+            dict(
+                metric,
+                LateTagQuestions=list(question_ids),
+                TagStageInTime=tag_stage_in_time,
+            )
+        )
+        return question_ids
+
+    def _get_similar_questions(self, similar_sets):
+        question_ids = [
+            question_id for similar_set in similar_sets for question_id in similar_set
+        ]
+        questions = self._question_db.get_questions_batch(question_ids)
+        for question_id in question_ids:
+            if question_id not in questions:
+                raise ValueError(f"Invalid question_id {question_id}")
+        return questions
+
+    def _merge_similar(self, similar_sets, questions):
+        # Same pointers as DynamoSubmissionDB, only the roots of the clusters change
+        for similar_set in similar_sets:
+            similar_set = list(dict.fromkeys(similar_set))
+            for question_id in similar_set[1:]:
+                self._union_clusters(similar_set[0], question_id)
+
+    def _union_clusters(self, question_id, other_id):
+        table = self._question_db._table
+        root, other_root = self._find_cluster(question_id), self._find_cluster(other_id)
+        if root == other_root:
+            return
+        rank = table.get((root,)).get("ClusterRank", 0)
+        other_rank = table.get((other_root,)).get("ClusterRank", 0)
+        if rank < other_rank:
+            root, rank, other_root, other_rank = other_root, other_rank, root, rank
+        if rank == other_rank:
+            table.update(
+                (root,),
+                lambda item: item.update(ClusterParent=root, ClusterRank=rank + 1),
+            )
+        table.update(
+            (other_root,),
+            lambda item: item.update(ClusterParent=root, ClusterRank=other_rank),
+        )
+
+    def _find_cluster(self, question_id):
+        table = self._question_db._table
+        while True:
+            parent = table.get((question_id,)).get("ClusterParent", question_id)
+            # A parent that was deleted leaves its children as roots
+            if parent == question_id or table.get((parent,)) is None:
+                return question_id
+            question_id = parent
+
+    def _check_metric(self, user_id, panel_id):
+        if self._metric_db.get_metric(user_id, panel_id) is None:
+            raise ValueError(f"Metrics for user {user_id} not found")
+
+    def _update_metric(self, user_id, panel_id, metric_updates):
+        self._metric_db._table.update(
+            (user_id, panel_id), lambda metric: metric.update(metric_updates)
+        )
+
+
+"""Object Store"""
+
+_OBJECTS = {}
+
+
+def put_object(bucket_name, object_key, body):
+    """Stand-in for S3 put_object used by the panel files while DB_BACKEND=memory."""
+    _OBJECTS[(bucket_name, object_key)] = body
+
+
+def get_object(bucket_name, object_key):
+    """Body stored under the key, raises KeyError like a missing S3 key would fail."""
+    return _OBJECTS[(bucket_name, object_key)]
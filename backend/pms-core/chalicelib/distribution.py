@@ -0,0 +1,191 @@
+"""Assignment of the questions every student has to tag during the tagging stage."""
+
+from heapq import heapify, heappop
+from random import Random
+from zlib import crc32
+
+import numpy as np
+
+# Marks the cells of a plan that could not be filled
+UNASSIGNED = -1
+# Candidate cells drawn at once when repairing a conflicting cell, before trying every cell
+_REPAIR_SAMPLE_SIZE = 64
+
+
+def assign_tag_questions(
+    question_owners, student_ids, questions_per_student, seed=None
+):
+    """
+    Assign questions_per_student distinct questions to every student, never their own ones.
+
+    question_owners maps every question id to the user id of its author. The ids are mapped to
+    integers and the assignment is planned by plan_tag_questions, reproducibly when a seed is given.
+
+    Returns {student_id: [question_id, ...]}.
+    """
+    # Sorted first, the order of sets and query results must not change the outcome of a seed
+    question_ids = sorted(question_owners)
+    students = sorted(student_ids)
+    student_indexes = {student_id: index for index, student_id in enumerate(students)}
+    owners = np.fromiter(
+        (
+            student_indexes.get(question_owners[question_id], UNASSIGNED)
+            for question_id in question_ids
+        ),
+        dtype=np.int32,
+        count=len(question_ids),
+    )
+
+    plan = plan_tag_questions(owners, len(students), questions_per_student, seed=seed)
+
+    # UNASSIGNED picks the trailing None
+    assigned = np.array(question_ids + [None], dtype=object)[plan].tolist()
+    if (plan == UNASSIGNED).any():
+        assigned = [
+            [question_id for question_id in row if question_id is not None]
+            for row in assigned
+        ]
+    return dict(zip(students, assigned))
+
+
+def pick_least_covered_questions(
+    coverage, question_owners, student_id, questions_per_student, seed=None
+):
+    """
+    Pick the questions of a student who joined after the panel was distributed.
+
+    coverage maps question ids to the number of students they are assigned to. The student gets
+    the least covered questions not written by them, ties broken randomly (reproducibly when a
+    seed is given), so the coverage of the panel stays balanced. Picking k of N questions from a
+    heap costs O(N + k log N), every call.
+    """
+    # Ties are broken by a salted checksum of the question id instead of the next random number,
+    # the order of the questions must not change the outcome of a seed
+    salt = Random(seed).getrandbits(32)
+    heap = [
+        (
+            coverage.get(question_id, 0),
+            crc32(f"{salt}:{question_id}".encode()),
+            question_id,
+        )
+        for question_id, owner in question_owners.items()
+        if owner != student_id
+    ]
+    heapify(heap)
+    return [
+        heappop(heap)[2] for _ in range(min(max(questions_per_student, 0), len(heap)))
+    ]
+
+
+def plan_tag_questions(owners, number_of_students, questions_per_student, seed=None):
+    """
+    Plan the tagging questions of every student on integers.
+
+    owners holds the index of the student who wrote every question (UNASSIGNED when not a student).
+    Returns a (number_of_students, questions_per_student) int32 matrix with the question indexes of
+    every student, UNASSIGNED where no eligible question was left.
+
+    The questions are laid out cyclically in a random permutation and cut into rows, so every
+    question fills the same number of slots (give or take one) and no row repeats a question. Rows
+    are dealt to the students in a random order, then only the cells holding the student's own
+    question are swapped with cells of other rows, which keeps the coverage of every question.
+    The cells no swap could fix are filled with the least covered questions their row can take.
+    """
+    rng = np.random.default_rng(seed)
+    owners = np.asarray(owners, dtype=np.int32)
+    number_of_questions = len(owners)
+    questions_per_student = max(min(questions_per_student, number_of_questions), 0)
+    if number_of_students == 0 or questions_per_student == 0:
+        return np.full(
+            (number_of_students, questions_per_student), UNASSIGNED, dtype=np.int32
+        )
+
+    permutation = rng.permutation(number_of_questions).astype(np.int32)
+    slots = (
+        np.arange(number_of_students * questions_per_student, dtype=np.int64)
+        % number_of_questions
+    )
+    plan = permutation[slots].reshape(number_of_students, questions_per_student)
+    # Student owning every row
+    row_students = rng.permutation(number_of_students).astype(np.int32)
+
+    for row, column in zip(*np.nonzero(find_conflicts(plan, owners, row_students))):
+        _repair(plan, owners, row_students, row, column, rng)
+    if (plan == UNASSIGNED).any():
+        _fill(plan, owners, row_students)
+
+    # Rows sorted back by student index
+    result = np.empty_like(plan)
+    result[row_students] = plan
+    return result
+
+
+def find_conflicts(plan, owners, row_students):
+    """Cells holding a question of the row's student, or a question already in the row."""
+    conflicts = owners[plan] == row_students[:, None]
+    sorted_plan = np.sort(plan, axis=1)
+    repeating = (sorted_plan[:, 1:] == sorted_plan[:, :-1]).any(axis=1)
+    for row in np.flatnonzero(repeating):
+        # The first copy stays, the later ones are conflicts
+        _, first = np.unique(plan[row], return_index=True)
+        repeated = np.ones(plan.shape[1], dtype=bool)
+        repeated[first] = False
+        conflicts[row] |= repeated
+    return conflicts
+
+
+def _repair(plan, owners, row_students, row, column, rng):
+    """Swap a conflicting cell with one of another row, both questions must suit their new row."""
+    student = row_students[row]
+    question = plan[row, column]
+    others = np.delete(plan[row], column)
+    if owners[question] != student and question not in others:
+        # Fixed by an earlier swap
+        return
+
+    number_of_students, questions_per_student = plan.shape
+    # Random cells first, every cell when none of them fits
+    rows = rng.integers(number_of_students, size=_REPAIR_SAMPLE_SIZE)
+    columns = rng.integers(questions_per_student, size=_REPAIR_SAMPLE_SIZE)
+    holding = (plan[rows] == question).any(axis=1)
+    if not _swap(plan, owners, row_students, row, column, rows, columns, holding):
+        rows, columns = np.indices(plan.shape).reshape(2, -1)
+        holding = (plan == question).any(axis=1)[rows]
+        if not _swap(plan, owners, row_students, row, column, rows, columns, holding):
+            # The student wrote too many of the questions to be given a full row
+            plan[row, column] = UNASSIGNED
+
+
+def _fill(plan, owners, row_students):
+    """Fill the UNASSIGNED cells with the least covered questions of other students not in their row."""
+    coverage = np.bincount(plan[plan != UNASSIGNED], minlength=len(owners))
+    for row, column in zip(*np.nonzero(plan == UNASSIGNED)):
+        eligible = owners != row_students[row]
+        eligible[plan[row][plan[row] != UNASSIGNED]] = False
+        if not eligible.any():
+            # The student wrote too many of the questions to be given a full row
+            continue
+        candidates = np.flatnonzero(eligible)
+        question = candidates[np.argmin(coverage[candidates])]
+        plan[row, column] = question
+        coverage[question] += 1
+
+
+def _swap(plan, owners, row_students, row, column, rows, columns, holding):
+    """Swap the cell with the first eligible candidate, holding tells the rows already holding its question."""
+    question = plan[row, column]
+    candidates = plan[rows, columns]
+    eligible = (
+        (rows != row)
+        & (candidates != UNASSIGNED)
+        & (owners[candidates] != row_students[row])
+        & ~np.isin(candidates, np.delete(plan[row], column))
+        & (owners[question] != row_students[rows])
+        & ~holding
+    )
+    if not eligible.any():
+        return False
+    index = np.argmax(eligible)
+    plan[row, column] = candidates[index]
+    plan[rows[index], columns[index]] = question
+    return True
@@ -1,5 +1,5 @@
 from json import dumps
-from boto3 import client
+from .aws_clients import get_client
 from .constants import BOTO3_SES_TYPE
 from .config import SES_EMAIL_ADDRESS, SES_IS_SANDBOX
 
@@ -12,7 +12,7 @@ def send_email(
     html_body="",
     text_body="",
 ):
-    ses = client(BOTO3_SES_TYPE)
+    ses = get_client(BOTO3_SES_TYPE)
 
     final_destination_addresses = destination_addresses
     final_cc_addresses = cc_addresses
@@ -0,0 +1,152 @@
+"""Near-duplicate questions, found with MinHash signatures and LSH banding.
+
+Every question is reduced to the set of its words and pairs of consecutive words. MinHash
+signatures estimate the Jaccard similarity of those sets, and LSH banding only compares the
+questions that share a band of their signatures, so a panel is not compared pair by pair.
+The bands follow the threshold and the pairs of a bucket are capped, so the memory stays linear
+in the number of questions even when most of them are alike.
+"""
+
+from re import findall
+from zlib import crc32
+
+import numpy as np
+
+from .clustering import DisjointSet
+
+# Signature length, split into bands of rows chosen from the threshold (see lsh_bands)
+NUM_PERMUTATIONS = 128
+# Mersenne prime of the universal hash functions, (a * x + b) stays below 2 ** 63
+_PRIME = (1 << 31) - 1
+# Hash functions evaluated at once, bounds the memory to (chunk x shingles) integers
+_PERMUTATION_CHUNK = 16
+# Members of a bucket are paired with this many following members only, bounds the pairs of a
+# band to signatures x window however many similar questions share a bucket
+_BUCKET_WINDOW = 16
+# Candidate pairs verified at once, bounds the memory to (chunk x NUM_PERMUTATIONS) integers
+_VERIFY_CHUNK = 8192
+
+
+def shingles(text):
+    """Hashes of the words of the text and of its pairs of consecutive words, in lower case."""
+    words = findall(r"\w+", text.lower())
+    words += [f"{word} {next_word}" for word, next_word in zip(words, words[1:])]
+    return {crc32(word.encode()) % _PRIME for word in words}
+
+
+def minhash_signatures(shingle_sets, seed=1):
+    """(len(shingle_sets), NUM_PERMUTATIONS) signatures, the sets must not be empty."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, _PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+    values = np.fromiter(
+        (value for shingle_set in shingle_sets for value in shingle_set),
+        dtype=np.uint64,
+    )
+    sizes = np.fromiter(
+        (len(shingle_set) for shingle_set in shingle_sets), dtype=np.int64
+    )
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    signatures = np.empty((len(shingle_sets), NUM_PERMUTATIONS), dtype=np.uint64)
+    for start in range(0, NUM_PERMUTATIONS, _PERMUTATION_CHUNK):
+        end = start + _PERMUTATION_CHUNK
+        hashes = (a[start:end, None] * values[None, :] + b[start:end, None]) % _PRIME
+        # Minimum of every question's shingles, for each hash function
+        signatures[:, start:end] = np.minimum.reduceat(hashes, offsets, axis=1).T
+    return signatures
+
+
+def lsh_bands(threshold):
+    """
+    (bands, rows) splitting NUM_PERMUTATIONS so pairs become candidates from about the threshold
+    on, (1 / bands) ** (1 / rows) is the similarity at which half of them do (16 x 8 for 0.7).
+    """
+    splits = [
+        (NUM_PERMUTATIONS // rows, rows)
+        for rows in range(1, NUM_PERMUTATIONS + 1)
+        if NUM_PERMUTATIONS % rows == 0
+    ]
+    return min(
+        splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold)
+    )
+
+
+def candidate_pairs(signatures, number_of_bands):
+    """
+    Yields the (first, second) index arrays of the signatures sharing each band, first < second
+    and without repeats within a band. Every member of a bucket is paired with the next
+    _BUCKET_WINDOW members, so buckets up to that size give all their pairs and larger ones a
+    chain linking all of them, without materializing bucket ** 2 pairs.
+    """
+    number_of_signatures = len(signatures)
+    rows_per_band = signatures.shape[1] // number_of_bands
+    # Folds the rows of a band into one bucket key, a collision only adds a candidate to verify
+    multipliers = np.random.default_rng(0).integers(
+        1, 1 << 63, size=rows_per_band, dtype=np.uint64
+    ) | np.uint64(1)
+    for band in range(number_of_bands):
+        columns = signatures[:, band * rows_per_band : (band + 1) * rows_per_band]
+        buckets = (columns * multipliers).sum(axis=1)
+        order = np.argsort(buckets, kind="stable")
+        sorted_buckets = buckets[order]
+        first, second = [], []
+        for distance in range(1, min(_BUCKET_WINDOW, number_of_signatures - 1) + 1):
+            same = sorted_buckets[distance:] == sorted_buckets[:-distance]
+            if not same.any():
+                # Buckets are runs of sorted keys, none is longer than this
+                break
+            first.append(order[:-distance][same])
+            second.append(order[distance:][same])
+        if first:
+            first, second = np.concatenate(first), np.concatenate(second)
+            yield np.minimum(first, second), np.maximum(first, second)
+
+
+def find_near_duplicates(texts, threshold, seed=1):
+    """
+    Groups of the texts whose estimated Jaccard similarity is at least threshold, directly or
+    through other texts of the group. Returns lists of indexes into texts, in ascending order and
+    only for groups of two or more, ordered by their first index.
+    """
+    shingle_sets = [shingles(text or "") for text in texts]
+    indexes = np.array(
+        [index for index, shingle_set in enumerate(shingle_sets) if shingle_set],
+        dtype=np.int64,
+    )
+    if len(indexes) < 2:
+        return []
+
+    signatures = minhash_signatures(
+        [shingle_sets[index] for index in indexes], seed=seed
+    )
+    # Identical signatures are duplicates already, only one of each shares the buckets so
+    # repeated texts can not blow them up
+    signatures, first_positions, inverse = np.unique(
+        signatures, axis=0, return_index=True, return_inverse=True
+    )
+    unique_groups = DisjointSet(range(len(signatures)))
+    for first, second in candidate_pairs(signatures, lsh_bands(threshold)[0]):
+        # Pairs already grouped by an earlier band need no verification
+        roots = np.fromiter(
+            (unique_groups.find(position) for position in range(len(signatures))),
+            dtype=np.int64,
+            count=len(signatures),
+        )
+        pending = roots[first] != roots[second]
+        first, second = first[pending], second[pending]
+        for start in range(0, len(first), _VERIFY_CHUNK):
+            left = first[start : start + _VERIFY_CHUNK]
+            right = second[start : start + _VERIFY_CHUNK]
+            keep = (signatures[left] == signatures[right]).mean(axis=1) >= threshold
+            for position, other_position in zip(
+                left[keep].tolist(), right[keep].tolist()
+            ):
+                unique_groups.union(position, other_position)
+
+    unique_roots = [unique_groups.find(position) for position in range(len(signatures))]
+    members = {}
+    for index, position in zip(indexes.tolist(), inverse.reshape(-1).tolist()):
+        members.setdefault(unique_roots[position], []).append(index)
+    return [group for group in members.values() if len(group) > 1]
@@ -1,8 +1,6 @@
 from decimal import Decimal
-import boto3
 
-from collections import defaultdict
-from random import shuffle
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
 from jwt import decode, get_unverified_header, encode
 from google.auth import exceptions
@@ -15,9 +13,20 @@ from json import dumps, loads
 import numpy as np
 from requests import Response
 
-from .constants import GOOGLE_ISSUER, BOTO3_S3_TYPE, BOTO3_DYNAMODB_TYPE
+from .constants import (
+    GOOGLE_ISSUER,
+    BOTO3_S3_TYPE,
+    BOTO3_DYNAMODB_TYPE,
+    DB_BACKEND_MEMORY,
+    TAG_QUESTIONS_COVERAGE_FILE_NAME,
+)
 
-from chalicelib.database.db_provider import get_user_db, get_panel_db, get_question_db, get_metric_db
+from chalicelib.database.db_provider import get_user_db, get_panel_db, get_question_db, get_metric_db, get_submission_db
+from chalicelib.database.identity_map import with_identity_map
+from chalicelib.clustering import cluster_similar_questions
+from chalicelib.distribution import assign_tag_questions, pick_least_covered_questions
+from chalicelib.near_duplicates import find_near_duplicates
+from chalicelib.aws_clients import get_client
 
 from chalicelib.constants import (
     submit_score,
@@ -41,11 +50,11 @@ from .config import (
     JWT_ISSUER,
     JWT_TOKEN_EXPIRATION_DAYS,
     PANELS_BUCKET_NAME,
+    DB_BACKEND,
+    AWS_MAX_POOL_CONNECTIONS,
+    NEAR_DUPLICATE_THRESHOLD,
 )
 
-s3_client = boto3.client(BOTO3_S3_TYPE)
-
-
 def _generate_id():
     """Generate a unique id."""
     return str(uuid4())
@@ -182,20 +191,6 @@ def create_token(user_id, email_id, name, picture, role):
     return token
 
 
-# DFS helper function for grouping similar questions
-def dfs(node, visited, adj_list):
-    if node in visited:
-        return (False, None)
-
-    visited.add(node)
-    cluster = [node]
-    for neighbor in adj_list[node]:
-        if neighbor not in visited:
-            cluster.extend(dfs(neighbor, visited, adj_list)[1])
-
-    return (True, cluster)
-
-
 def upload_objects(bucket_name, panel_id, file_name, json_object):
     """Upload objects to the bucket"""
     print("Start uploading objects to panels bucket")
@@ -207,16 +202,61 @@ def upload_objects(bucket_name, panel_id, file_name, json_object):
 
     # Upload the object
     try:
-        s3_client.put_object(Bucket=bucket_name, Key=object_name, Body=json_content)
+        _put_object(bucket_name, object_name, json_content)
         print(f"Uploaded {object_name} successfully")
     except Exception as e:
         print(f"Error uploading {object_name}:", e)
 
 
+def upload_objects_parallel(bucket_name, panel_id, json_objects):
+    """Upload {file_name: json_object} to the bucket in parallel, returns the file names that failed"""
+    print(f"Start uploading {len(json_objects)} objects to panels bucket")
+
+    def upload(file_name):
+        _put_object(bucket_name, f"{panel_id}/{file_name}", dumps(json_objects[file_name]))
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=AWS_MAX_POOL_CONNECTIONS) as executor:
+        futures = {executor.submit(upload, file_name): file_name for file_name in json_objects}
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                print(f"Error uploading {panel_id}/{futures[future]}:", future.exception())
+                failed.append(futures[future])
+    print(f"Uploaded {len(json_objects) - len(failed)} objects to {panel_id}/ successfully")
+    return failed
+
+
+def _memory_provider():
+    # Imported lazily like in db_provider, the deployed functions never load the in-memory backend
+    from chalicelib.database import memory_provider
+
+    return memory_provider
+
+
+def _put_object(bucket_name, object_name, json_content):
+    if DB_BACKEND == DB_BACKEND_MEMORY:
+        _memory_provider().put_object(bucket_name, object_name, json_content)
+    else:
+        get_client(BOTO3_S3_TYPE).put_object(Bucket=bucket_name, Key=object_name, Body=json_content)
+
+
+def get_tag_questions_file_name(user_id):
+    """Every student's tagging questions live in their own small object, see distribute_tag_questions"""
+    return f"questions/{user_id}.json"
+
+
 def get_s3_objects(bucket_name, object_key):
     """Get Objects from the bucket"""
     print("Start getting objects from panels bucket")
-
+    if DB_BACKEND == DB_BACKEND_MEMORY:
+        # No S3 client, the in-memory backend runs without AWS credentials
+        try:
+            return loads(_memory_provider().get_object(bucket_name, object_key)), None
+        except Exception as e:
+            print(f"Error getting {object_key}: {e}")
+            return None, e
+
+    s3_client = get_client(BOTO3_S3_TYPE)
     try:
         s3_object = s3_client.get_object(Bucket=bucket_name, Key=object_key)
         object_data = loads(s3_object["Body"].read().decode("utf-8"))
@@ -232,6 +272,13 @@ def get_s3_objects(bucket_name, object_key):
         return None, e
 
 
+def is_missing_s3_object(error):
+    """Whether get_s3_objects failed because the key does not exist, rather than a transient error"""
+    if DB_BACKEND == DB_BACKEND_MEMORY:
+        return isinstance(error, KeyError)
+    return isinstance(error, get_client(BOTO3_S3_TYPE).exceptions.NoSuchKey)
+
+
 def get_current_time_utc():
     # Created a function to have standarize dates from the backend!
     # Get the current time in ISO format
@@ -241,10 +288,27 @@ def get_current_time_utc():
     )
 
 
-def distribute_tag_questions(panel_id):
+def parse_uin(value):
+    """
+    UIN the way the user table stores it, the string of its number (UINIndex has a string key).
+    Raises ValueError for blank, NaN or non-numeric values, e.g. empty cells of an import.
+    """
+    try:
+        uin = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"Invalid UIN {value}")
+    if uin <= 0:
+        raise ValueError(f"Invalid UIN {value}")
+    return str(uin)
+
+
+@with_identity_map
+def distribute_tag_questions(panel_id, seed=None):
     try:
         # Get list of all questions for that panel from the usersDB
-        questions = get_question_db().get_questions_by_panel(panel_id)
+        questions = get_question_db().get_questions_by_panel(
+            panel_id, attributes=["QuestionID", "UserID", "QuestionText"]
+        )
         if questions is None:
             return f"Questions for Panel {id} not found"
         # Creating map to store questionID and corresponding userID
@@ -260,23 +324,22 @@ def distribute_tag_questions(panel_id):
                 "QuestionText": question_text,
             }
 
-        # Store all questionIDs from Map
-        question_ids = list(question_map.keys())
+        # Near duplicates are linked as similar, only the first question of each group is handed out
+        duplicate_groups = link_near_duplicate_questions(questions)
+        for duplicate_group in duplicate_groups:
+            for question_id in duplicate_group[1:]:
+                question_map.pop(question_id)
 
         # Get total students from the usersDB
         student_ids = list(get_user_db().get_student_user_ids())
-        number_of_questions = len(question_ids)
+        number_of_questions = len(question_map)
         number_of_students = len(student_ids)
 
         number_of_questions_submitted_per_student = get_panel_db().get_panel(panel_id).get("NumberOfQuestions")
         number_of_assignable_tag_questions_per_student = number_of_questions - number_of_questions_submitted_per_student
-        number_of_tag_questions_per_student = min(number_of_assignable_tag_questions_per_student, 20)
+        number_of_tag_questions_per_student = int(min(number_of_assignable_tag_questions_per_student, 20))
 
         number_of_question_slots = number_of_tag_questions_per_student * number_of_students
-        number_of_repetition_of_questions = (
-            number_of_question_slots // number_of_questions
-        )
-        number_of_extra_question_slots = number_of_question_slots % number_of_questions
 
         # Print variable values
         print("Panel ID: ", panel_id)
@@ -285,98 +348,146 @@ def distribute_tag_questions(panel_id):
         print("Total number of questions: ", number_of_questions)
         print("Total number of students: ", number_of_students)
         print("Total number of question slots: ", number_of_question_slots)
-        print("Number of extra question slots: ", number_of_extra_question_slots)
-
-        # Distribute questions to slots
-        distributed_question_id_slots = []
-
-        # Append each question id to the list with repetitions
-        for question_id in question_ids:
-            distributed_question_id_slots.extend(
-                [question_id] * number_of_repetition_of_questions
-            )
-
-        # Fill remaining slots with top question ids and append to the list
-        if number_of_extra_question_slots > 0:
-            top_questions = question_ids[:number_of_extra_question_slots]
-            distributed_question_id_slots.extend(top_questions)
-
-        # Shuffle the question slots to randomize the order
-        shuffle(distributed_question_id_slots)
+        print("Number of near duplicate questions left out: ", sum(len(group) - 1 for group in duplicate_groups))
+
+        # Assign the questions, never the student's own ones and never twice to the same student
+        assignments = assign_tag_questions(
+            {question_id: question["UserID"] for question_id, question in question_map.items()},
+            student_ids,
+            number_of_tag_questions_per_student,
+            seed=seed,
+        )
 
         # Create a collection to store questionSubLists
         student_id_questions_map = {}
-        # counter = 0
-
-        for _ in range(number_of_students):
-            student_id = student_ids.pop(0)
-
-            # Create a sublist for each iteration
-            question_id_text_map = {}
+        for student_id, assigned_question_ids in assignments.items():
+            student_id_questions_map[student_id] = {
+                question_id: question_map[question_id]["QuestionText"]
+                for question_id in assigned_question_ids
+            }
 
-            # Pop questions from the questions slot list to put in the map
-            for _ in range(number_of_tag_questions_per_student):
+        # Write every student's questions once, the tagging page only downloads its own ones
+        question_files = {
+            get_tag_questions_file_name(student_id): question_id_text_map
+            for student_id, question_id_text_map in student_id_questions_map.items()
+        }
+        failed = upload_objects_parallel(PANELS_BUCKET_NAME, panel_id, question_files)
+        if failed:
+            # Retried once, the errors are mostly throttling
+            failed = upload_objects_parallel(
+                PANELS_BUCKET_NAME, panel_id, {file_name: question_files[file_name] for file_name in failed}
+            )
+        # Kept for the students who join later, see assign_late_tag_questions
+        coverage = dict.fromkeys(question_map, 0)
+        for assigned_question_ids in assignments.values():
+            for question_id in assigned_question_ids:
+                coverage[question_id] += 1
+        upload_objects(PANELS_BUCKET_NAME, panel_id, TAG_QUESTIONS_COVERAGE_FILE_NAME, coverage)
+
+        if failed:
+            return {"error": f"Could not upload {len(failed)} tagging question files: {', '.join(sorted(failed))}"}
+        return student_id_questions_map
+    except Exception as e:
+        return {"error": str(e)}
 
-                # Initialize counter
-                counter = 0
 
-                # Get next question from the questionID slot list
-                question_id = distributed_question_id_slots.pop(0)
+def link_near_duplicate_questions(questions):
+    """
+    Link the near duplicate questions of a panel as similar, returns the groups of question ids.
+    Only an optimization of the distribution, on any error nothing is left out of it.
+    """
+    if NEAR_DUPLICATE_THRESHOLD <= 0:
+        return []
+    try:
+        duplicate_groups = [
+            [questions[index]["QuestionID"] for index in group]
+            for group in find_near_duplicates(
+                [question.get("QuestionText") for question in questions], NEAR_DUPLICATE_THRESHOLD
+            )
+        ]
+        if duplicate_groups:
+            get_submission_db().link_similar(duplicate_groups)
+        return duplicate_groups
+    except Exception as e:
+        print("Error linking near duplicate questions, distributing all of them:", e)
+        return []
 
-                # Check if question exists in the map keys and check if question was entered by user
-                # (failure condition - skip to next question)
-                while (question_id in question_id_text_map.keys()) or (
-                        student_id == question_map[question_id]["UserID"]
-                ):
-                    # Append it to the end of the master list and fetch the next question
-                    distributed_question_id_slots.append(question_id)
 
-                    # Get next question from the questionID slot list
-                    question_id = distributed_question_id_slots.pop(0)
+@with_identity_map
+def assign_late_tag_questions(panel_id, user_id, seed=None):
+    """
+    Give a student who was not there when the panel was distributed the least covered questions
+    and store its TagStageInTime with them. Returns None when the panel was not distributed yet.
 
-                    # Increment counter
-                    if counter > number_of_tag_questions_per_student:
-                        break
-                    else:
-                        counter += 1
+    coverage.json is only written by the distribution, the questions handed out later are counted
+    in the LateTagCoverage of the questions and claimed once per student (see
+    claim_late_tag_questions), so concurrent requests never overwrite each other.
+    Costs a query of the panel's questions and an O(N + k log N) pick of k among its N questions.
+    """
+    try:
+        coverage_key = f"{panel_id}/{TAG_QUESTIONS_COVERAGE_FILE_NAME}"
+        coverage, error = get_s3_objects(PANELS_BUCKET_NAME, coverage_key)
+        if error:
+            if is_missing_s3_object(error):
+                # Not distributed yet
+                return None
+            return {"error": str(error)}
 
-                # Add question to map
-                question_id_text_map[question_id] = question_map[question_id][
-                    "QuestionText"
-                ]
+        questions = get_question_db().get_questions_by_panel(
+            panel_id, attributes=["QuestionID", "UserID", "QuestionText", "LateTagCoverage"]
+        )
+        # Questions left out of the distribution (near duplicates) are not in the coverage
+        question_map = {question["QuestionID"]: question for question in questions if question["QuestionID"] in coverage}
 
-            if len(question_id_text_map) == number_of_tag_questions_per_student:
-                # Assign the sublist to the next available student ID
-                student_id_questions_map[student_id] = question_id_text_map
-            else:
-                # Handle edge case where last student doesn't get questions
-                distribute_tag_questions(panel_id)
+        number_of_questions_submitted_per_student = get_panel_db().get_panel(panel_id).get("NumberOfQuestions")
+        number_of_assignable_tag_questions_per_student = len(question_map) - number_of_questions_submitted_per_student
+        number_of_tag_questions_per_student = int(min(number_of_assignable_tag_questions_per_student, 20))
+
+        question_ids = pick_least_covered_questions(
+            {
+                question_id: coverage[question_id] + int(question.get("LateTagCoverage", 0))
+                for question_id, question in question_map.items()
+            },
+            {question_id: question["UserID"] for question_id, question in question_map.items()},
+            user_id,
+            number_of_tag_questions_per_student,
+            seed=seed,
+        )
+        # The questions of an earlier request win, the object below is then written again with them
+        question_ids = get_submission_db().claim_late_tag_questions(
+            panel_id, user_id, question_ids, get_current_time_utc()
+        )
+        question_id_text_map = {
+            question_id: question_map[question_id]["QuestionText"]
+            for question_id in question_ids
+            if question_id in question_map
+        }
 
-            # Add the student_question_map to an S3 bucket
-            upload_objects(PANELS_BUCKET_NAME, panel_id, "questions.json", student_id_questions_map)
+        # Only this student's questions are written, the other students keep theirs
+        upload_objects(PANELS_BUCKET_NAME, panel_id, get_tag_questions_file_name(user_id), question_id_text_map)
 
-        return student_id_questions_map
+        return question_id_text_map
     except Exception as e:
         return {"error": str(e)}
 
 
 def group_similar_questions(panel_id):
     try:
-        questions = get_question_db().get_questions_by_panel(panel_id)
-
-        # Build adjacency list {<q_id> : [q_id1, q_id2, ..., q_idn]} for every q_id present in panel_id
-        adj_list = defaultdict(list)
-        for question_obj in questions:
-            if "SimilarTo" in question_obj:
-                adj_list[question_obj["QuestionID"]] = question_obj["SimilarTo"]
+        questions = get_question_db().get_questions_by_panel(
+            panel_id,
+            attributes=[
+                "QuestionID",
+                "QuestionText",
+                "LikedBy",
+                "DislikedBy",
+                "FlaggedBy",
+                "SimilarTo",
+                "ClusterParent",
+            ],
+        )
 
-        # Iterate through all questions and perform DFS
-        similar_culsters = []
-        visited = set()
-        for question in questions:
-            is_new, cluster = dfs(question["QuestionID"], visited, adj_list)
-            if is_new:
-                similar_culsters.append(cluster)
+        # Clusters of the ClusterParent pointers kept by mark_similar
+        similar_culsters = cluster_similar_questions(questions)
 
         # Build hash-map of retrieved questions for faster lookup
         question_map = {}
@@ -399,25 +510,20 @@ def group_similar_questions(panel_id):
 
             if len(cluster) > 1:
                 for q_id in cluster:
-                    if (
-                        "FlaggedBy" not in question_map[rep_id]
-                        or len(question_map[q_id]["FlaggedBy"]) == 0
-                    ):
+                    # Near duplicates left out of the distribution were never tagged, no lists
+                    if len(question_map[q_id].get("FlaggedBy", [])) == 0:
                         filtered_cluster.append(q_id)
-                        q_likes = len(question_map[q_id]["LikedBy"])
-                        q_dislikes = len(question_map[q_id]["DislikedBy"])
+                        q_likes = len(question_map[q_id].get("LikedBy", []))
+                        q_dislikes = len(question_map[q_id].get("DislikedBy", []))
                         if q_likes > rep_likes:
                             rep_id = q_id
                             rep_likes = q_likes
                         cluster_likes += q_likes
                         cluster_dislikes += q_dislikes
             else:
-                if (
-                    "FlaggedBy" not in question_map[rep_id]
-                    or len(question_map[rep_id]["FlaggedBy"]) == 0
-                ):
-                    cluster_likes = len(question_map[rep_id]["LikedBy"])
-                    cluster_dislikes = len(question_map[rep_id]["DislikedBy"])
+                if len(question_map[rep_id].get("FlaggedBy", [])) == 0:
+                    cluster_likes = len(question_map[rep_id].get("LikedBy", []))
+                    cluster_dislikes = len(question_map[rep_id].get("DislikedBy", []))
                     filtered_cluster.append(rep_id)
 
             if len(filtered_cluster) > 0:
@@ -450,6 +556,7 @@ def group_similar_questions(panel_id):
     except Exception as e:
         return {"error": str(e)}
     
+@with_identity_map
 def generate_final_question_list(id):
     try:
         panel_id = id
@@ -469,8 +576,12 @@ def generate_final_question_list(id):
 
         # Build question cache of top 20 questions
         question_cache = []
+        questions_by_id = get_question_db().get_questions_batch(
+            [cluster_obj["rep_id"] for cluster_obj in questions_data[:20]],
+            attributes=["VoteScore"],
+        )
         for cluster_obj in questions_data[:20]:
-            question_obj = get_question_db().get_question(cluster_obj["rep_id"])
+            question_obj = questions_by_id[cluster_obj["rep_id"]]
             if "VoteScore" in question_obj:
                 cluster_obj["vote_score"] = int(question_obj["VoteScore"])
                 question_cache.append(cluster_obj)
@@ -491,6 +602,7 @@ def generate_final_question_list(id):
     except Exception as e:
         return {"error": str(e)}
 
+@with_identity_map
 def grading_script(panel_id):
     try:
         metric = get_metric_db().get_metrics_by_panel(panel_id)
@@ -556,6 +668,12 @@ def grading_script(panel_id):
             else:
                 student_grades[student["UserID"]]["VoteStageScore"] = Decimal(0)
 
+        # Fetch every clustered question once instead of one get_item per lookup
+        questions_by_id = get_question_db().get_questions_batch(
+            [question["rep_id"] for question in questions_data + final_questions_data]
+            + [q_id for question in questions_data for q_id in question["cluster"]]
+        )
+
         # Scoring individual questions
         for question in questions_data:
             question_perf_score = 0
@@ -569,22 +687,23 @@ def grading_script(panel_id):
             else:
                 penalty = round(min(performance_score, abs(1 - abs(deviation)) * penalty_rate),2)    
                 question_perf_score = max(0, round(performance_score - penalty,2))
-            question_obj = get_question_db().get_question(question["rep_id"])
+            question_obj = questions_by_id[question["rep_id"]]
             question_obj["FinalScore"] =  round(Decimal(question_perf_score) + Decimal(question_bonus_score),2)
-            get_question_db().add_question(question_obj)
             for cluster_id in question["cluster"]:
-                question_obj = get_question_db().get_question(cluster_id)
+                question_obj = questions_by_id[cluster_id]
                 question_obj["FinalScore"] = round(Decimal(question_perf_score) + Decimal(question_bonus_score),2)
-                get_question_db().add_question(question_obj)
+        get_question_db().add_questions_batch(questions_by_id.values())
 
+        # Scores of every student from the questions scored above, the UserIDIndex could still miss them
+        question_scores_by_student = {}
+        for question_obj in questions_by_id.values():
+            if "FinalScore" in question_obj:
+                question_scores_by_student.setdefault(question_obj["UserID"], []).append(question_obj["FinalScore"])
 
         # Averaging question scores for every student
         for student in metric:
             if student["EnteredQuestionsTotalScore"] != -1:
-                student_questions = get_question_db().get_my_questions_by_panel(panel_id, student["UserID"])
-                question_scores = []
-                for question in student_questions:
-                    question_scores.append(question["FinalScore"])
+                question_scores = question_scores_by_student.get(student["UserID"], [])
                 student_question_score = round(np.sum(question_scores)/int(total_questions[0]),2)           
                 question_stage_score = Decimal( ((student_question_score + Decimal(student["EnteredQuestionsTotalScore"])) / total_question_score) * 100)
                 student_grades[student["UserID"]]["QuestionStageScore"] = question_stage_score
@@ -593,20 +712,20 @@ def grading_script(panel_id):
         # Giving bonus scores for cray cray questions
         # +5 for getting to voting stage
         for question in questions_data[:20]:
-            question_obj = get_question_db().get_question(question["rep_id"])
+            question_obj = questions_by_id[question["rep_id"]]
             student_id = question_obj["UserID"]
             student_grades[student_id]["TagStageScore"] = Decimal(extra_voting_score)
             for cluster_id in question["cluster"]:
-                question_obj = get_question_db().get_question(question["rep_id"])
+                question_obj = questions_by_id[question["rep_id"]]
                 student_id = question_obj["UserID"]
                 student_grades[student_id]["TagStageScore"] = Decimal(extra_voting_score)
         # +5 for getting to final stage        
         for question in final_questions_data:
-            question_obj = get_question_db().get_question(question["rep_id"])
+            question_obj = questions_by_id[question["rep_id"]]
             student_id = question_obj["UserID"]
             student_grades[student_id]["VoteStageScore"] = Decimal(top_questions_score)
             for cluster_id in question["cluster"]:
-                question_obj = get_question_db().get_question(question["rep_id"])
+                question_obj = questions_by_id[question["rep_id"]]
                 student_id = question_obj["UserID"]
                 student_grades[student_id]["VoteStageScore"] = Decimal(top_questions_score)
 
@@ -714,9 +833,12 @@ def grading_script(panel_id):
         vote_stage_min, vote_stage_max, vote_stage_mean = min(all_vote_stage_scores), max(all_vote_stage_scores), round(np.mean(all_vote_stage_scores), 2)
 
         metric_batch_update = []
+        metrics_by_key = get_metric_db().get_metrics_batch(
+            (grade_obj["UserID"], grade_obj["PanelID"]) for grade_obj in student_grades.values()
+        )
 
         for _, grade_obj in student_grades.items():
-            metric_obj = get_metric_db().get_metric(grade_obj["UserID"], grade_obj["PanelID"])
+            metric_obj = metrics_by_key[(grade_obj["UserID"], grade_obj["PanelID"])]
             metric_obj["QuestionStageMin"] = question_stage_min
             metric_obj["QuestionStageMax"] = question_stage_max
             metric_obj["QuestionStageMean"] = question_stage_mean
@@ -732,8 +854,7 @@ def grading_script(panel_id):
             metric_obj["FinalTotalScore"] = grade_obj["FinalTotalScore"]
             metric_batch_update.append(metric_obj)
         
-        for metric_obj in metric_batch_update:
-            get_metric_db().add_metric(metric_obj)
+        get_metric_db().add_metrics_batch(metric_batch_update)
 
 
         return student_grades
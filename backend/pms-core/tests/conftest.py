@@ -0,0 +1,27 @@
+"""The tests run on the in-memory backend (DB_BACKEND=memory), no AWS account or credentials needed."""
+
+import os
+import sys
+
+# Read by chalicelib.config on import, set before anything imports it
+os.environ["DB_BACKEND"] = "memory"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from chalicelib.database import db_provider, memory_provider
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """Empty in-memory tables and panel files for the test."""
+    for name in (
+        "_USER_DB",
+        "_QUESTION_DB",
+        "_PANEL_DB",
+        "_METRIC_DB",
+        "_LOG_DB",
+        "_SUBMISSION_DB",
+    ):
+        monkeypatch.setattr(db_provider, name, None)
+    monkeypatch.setattr(memory_provider, "_OBJECTS", {})
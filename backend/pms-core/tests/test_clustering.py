@@ -0,0 +1,65 @@
+from random import Random
+
+from chalicelib.clustering import DisjointSet, cluster_similar_questions
+
+
+def test_disjoint_set_handles_long_chains_without_recursion():
+    ids = range(100000)
+    disjoint_set = DisjointSet(ids)
+    # Chained by hand, the worst case for find before path compression
+    for id in ids[1:]:
+        disjoint_set.parent[id] = id - 1
+
+    assert disjoint_set.find(99999) == 0
+    assert disjoint_set.parent[99999] == 0
+
+
+def test_disjoint_set_union_by_rank():
+    disjoint_set = DisjointSet(["a", "b", "c"])
+
+    root = disjoint_set.union("a", "b")
+
+    assert disjoint_set.union("c", "a") == root
+    assert disjoint_set.find("a") == disjoint_set.find("b") == disjoint_set.find("c")
+
+
+def test_cluster_similar_questions_follows_similar_to_links():
+    questions = [
+        {"QuestionID": "q1", "SimilarTo": ["q3"]},
+        {"QuestionID": "q2"},
+        {"QuestionID": "q3", "SimilarTo": ["q1", "q4"]},
+        {"QuestionID": "q4", "SimilarTo": ["q3", "missing"]},
+    ]
+
+    assert cluster_similar_questions(questions) == [["q1", "q3", "q4"], ["q2"]]
+
+
+def test_cluster_similar_questions_does_not_depend_on_the_read_order():
+    questions = [
+        {"QuestionID": f"q{index:03}", "SimilarTo": [f"q{index * 7 % 50:03}"]}
+        for index in range(50)
+    ]
+    clusters = cluster_similar_questions(questions)
+
+    for seed in range(10):
+        Random(seed).shuffle(questions)
+        assert cluster_similar_questions(questions) == clusters
+
+
+def test_cluster_similar_questions_merges_cluster_pointers_and_old_links():
+    questions = [
+        {"QuestionID": "q1", "ClusterParent": "q1"},
+        {"QuestionID": "q2", "ClusterParent": "q1"},
+        {"QuestionID": "q3", "ClusterParent": "q2"},
+        # Marked before the pointers were kept, then pointed to by a later submission
+        {"QuestionID": "q4", "ClusterParent": "q4", "SimilarTo": ["q5"]},
+        {"QuestionID": "q5", "SimilarTo": ["q4"]},
+        {"QuestionID": "q6", "SimilarTo": ["q3"]},
+        {"QuestionID": "q7"},
+    ]
+
+    assert cluster_similar_questions(questions) == [
+        ["q1", "q2", "q3", "q6"],
+        ["q4", "q5"],
+        ["q7"],
+    ]
@@ -0,0 +1,612 @@
+from copy import deepcopy
+from json import dumps, loads
+from types import SimpleNamespace
+
+import pytest
+from boto3.dynamodb.conditions import Key
+from boto3.session import Session
+from botocore.exceptions import ClientError
+from botocore.awsrequest import AWSResponse
+
+from chalicelib import aws_clients
+from chalicelib.clustering import cluster_similar_questions
+from chalicelib.constants import DYNAMODB_TRANSACTION_MAX_ITEMS
+from chalicelib.database import db_provider
+from chalicelib.database.identity_map import with_identity_map
+from chalicelib.database.instrumentation import (
+    end_request_metrics,
+    instrument_client,
+    start_request_metrics,
+)
+from chalicelib.database.memory_provider import MemoryMetricDB, MemoryPanelDB
+from chalicelib.database.db_provider import (
+    DynamoLogDB,
+    DynamoMetricDB,
+    DynamoPanelDB,
+    DynamoQuestionDB,
+    DynamoSubmissionDB,
+    DynamoUserDB,
+    get_metric_db,
+    get_panel_db,
+)
+
+
+class FakeClient(object):
+    """The calls of the DynamoDB client the tables below are read and written with."""
+
+    class exceptions(object):
+        class TransactionCanceledException(Exception):
+            pass
+
+    def __init__(self):
+        self.items = {}
+        self.transactions = []
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table_items = self.items.setdefault(table_name, {})
+            responses[table_name] = [
+                dict(table_items[key["QuestionID"]])
+                for key in request["Keys"]
+                if key["QuestionID"] in table_items
+            ]
+        return {"Responses": responses}
+
+    def transact_write_items(self, TransactItems):
+        assert len(TransactItems) <= DYNAMODB_TRANSACTION_MAX_ITEMS
+        self.transactions.append(TransactItems)
+        for action in TransactItems:
+            update = action["Update"]
+            item = self.items.setdefault(update["TableName"], {}).setdefault(
+                next(iter(update["Key"].values())), dict(update["Key"])
+            )
+            # Only SET name = :value clauses
+            for clause in update["UpdateExpression"][len("SET ") :].split(", "):
+                name, placeholder = clause.split(" = ")
+                item[name] = update["ExpressionAttributeValues"][placeholder]
+
+
+def fake_table(client, name):
+    return SimpleNamespace(name=name, meta=SimpleNamespace(client=client))
+
+
+class PagedTable(object):
+    """A table returning the items of every scan and query two per page."""
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+        self.calls = []
+        # Segmented scans go through the client
+        self.meta = SimpleNamespace(client=SimpleNamespace(scan=self._scan_segment))
+
+    def scan(self, **params):
+        return self._page("scan", self.items, params)
+
+    def _scan_segment(self, TableName, Segment, TotalSegments, **params):
+        assert TableName == self.name
+        return self._page(
+            "scan", self.items[Segment::TotalSegments], dict(params, Segment=Segment)
+        )
+
+    def query(self, **params):
+        return self._page("query", self.items, params)
+
+    def _page(self, operation, items, params):
+        self.calls.append((operation, params))
+        start = params.get("ExclusiveStartKey", {}).get("Position", 0)
+        response = {"Items": items[start : start + 2]}
+        if start + 2 < len(items):
+            response["LastEvaluatedKey"] = {"Position": start + 2}
+        return response
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def submission_db(client):
+    return DynamoSubmissionDB(
+        DynamoQuestionDB(fake_table(client, "Questions")),
+        DynamoMetricDB(fake_table(client, "Metrics")),
+        DynamoLogDB(fake_table(client, "Logs")),
+    )
+
+
+def test_submit_similar_splits_large_merges_into_whole_unions(client, submission_db):
+    question_ids = [f"q{index:03}" for index in range(300)]
+    client.items["Questions"] = {
+        question_id: {"QuestionID": question_id} for question_id in question_ids
+    }
+
+    submission_db.submit_similar("p", "s1", [question_ids], {"X": "1"})
+
+    assert len(client.transactions) > 1
+    # The metric goes with the last transaction
+    assert [action["Update"]["TableName"] for action in client.transactions[-1]].count(
+        "Metrics"
+    ) == 1
+    questions = list(client.items["Questions"].values())
+    assert cluster_similar_questions(questions) == [question_ids]
+
+
+def test_link_similar_writes_only_the_roots(client, submission_db):
+    client.items["Questions"] = {
+        question_id: {"QuestionID": question_id}
+        for question_id in ("q1", "q2", "q3", "q4")
+    }
+
+    submission_db.link_similar([["q1", "q2"], ["q3", "q4"]])
+    submission_db.link_similar([["q2", "q4"], ["q1", "q3"]])
+
+    questions = list(client.items["Questions"].values())
+    assert cluster_similar_questions(questions) == [["q1", "q2", "q3", "q4"]]
+    # The second merge joins the two roots, the other questions already point to them
+    assert len(client.transactions[-1]) == 2
+
+
+def test_transact_write_refuses_more_actions_than_a_transaction(client, submission_db):
+    actions = [
+        {
+            "Update": {
+                "TableName": "Questions",
+                "Key": {"QuestionID": f"q{index}"},
+                "UpdateExpression": "SET ClusterRank = :rank",
+                "ExpressionAttributeValues": {":rank": 0},
+            }
+        }
+        for index in range(DYNAMODB_TRANSACTION_MAX_ITEMS + 1)
+    ]
+
+    with pytest.raises(ValueError):
+        submission_db._transact_write(actions)
+    assert client.transactions == []
+
+
+def test_write_buckets_pace_each_table_to_its_own_capacity(client, monkeypatch):
+    monkeypatch.setattr(db_provider, "DYNAMODB_WRITE_PACING_ENABLED", True)
+    monkeypatch.setattr(db_provider, "_WRITE_BUCKETS", {})
+    capacities = {"Questions": 25, "Logs": 0}
+    described = []
+
+    def describe_table(TableName):
+        described.append(TableName)
+        return {
+            "Table": {
+                "ProvisionedThroughput": {"WriteCapacityUnits": capacities[TableName]}
+            }
+        }
+
+    client.describe_table = describe_table
+    questions, logs = fake_table(client, "Questions"), fake_table(client, "Logs")
+
+    assert db_provider.get_write_bucket(questions).rate == 25
+    assert db_provider.get_write_bucket(questions).rate == 25
+    # On-demand tables have no capacity to pace to
+    assert db_provider.get_write_bucket(logs) is None
+    assert db_provider.get_write_bucket(logs) is None
+    assert described == ["Questions", "Logs"]
+
+
+def test_get_panel_copies_the_cached_panel_and_rejects_invalid_deadlines():
+    panels = {
+        "p1": {
+            "PanelID": "p1",
+            "Tags": ["a"],
+            "TagStageDeadline": "2024-04-01T12:00:00Z",
+        },
+        "p2": {"PanelID": "p2", "TagStageDeadline": "tomorrow"},
+    }
+    table = SimpleNamespace(
+        get_item=lambda Key: {"Item": deepcopy(panels[Key["PanelID"]])}
+    )
+    panel_db = DynamoPanelDB(table)
+
+    panel_db.get_panel("p1")["Tags"].append("b")
+
+    assert panel_db.get_panel("p1")["Tags"] == ["a"]
+    deadlines = panel_db.get_panel_deadlines("p1")
+    assert deadlines["TagStageDeadline"].isoformat() == "2024-04-01T12:00:00+00:00"
+    assert deadlines["VoteStageDeadline"] is None
+    with pytest.raises(ValueError):
+        panel_db.get_panel_deadlines("p2")
+
+
+def test_batch_write_items_counts_retries_and_throttles(monkeypatch):
+    monkeypatch.setattr(db_provider, "sleep", lambda seconds: None)
+    calls = []
+
+    def batch_write_item(RequestItems, ReturnConsumedCapacity):
+        calls.append(len(RequestItems["Logs"]))
+        if len(calls) == 1:
+            raise ClientError(
+                {"Error": {"Code": "ProvisionedThroughputExceededException"}},
+                "BatchWriteItem",
+            )
+        if len(calls) == 2:
+            # Half of the items left unprocessed
+            return {
+                "UnprocessedItems": {"Logs": RequestItems["Logs"][:2]},
+                "ConsumedCapacity": [{"CapacityUnits": 2}],
+            }
+        return {"ConsumedCapacity": [{"CapacityUnits": len(RequestItems["Logs"])}]}
+
+    client = SimpleNamespace(batch_write_item=batch_write_item)
+    table = fake_table(client, "Logs")
+    logs = [{"LogID": f"l{index}"} for index in range(4)]
+
+    start_request_metrics("test")
+    stats = db_provider.batch_write_items(table, logs, ("LogID",), paced=False)
+    summary = end_request_metrics()
+
+    assert calls == [4, 4, 2]
+    assert stats["requests"] == 3
+    assert stats["retries"] == 2
+    assert stats["throttles"] == 1
+    assert stats["consumed_capacity"] == 4
+    assert summary["batch_writes"] == [{"table": "Logs", **stats}]
+
+
+def test_iter_scan_and_iter_query_follow_the_last_evaluated_key():
+    items = [{"QuestionID": f"q{index}"} for index in range(5)]
+    table = PagedTable("Questions", items)
+
+    assert list(db_provider.iter_scan(table, Limit=10)) == items
+    assert list(db_provider.iter_query(table, IndexName="PanelIDIndex")) == items
+
+    start_keys = [params.get("ExclusiveStartKey") for _, params in table.calls]
+    assert start_keys == [None, {"Position": 2}, {"Position": 4}] * 2
+    # Every page is asked with the params of the caller
+    assert [operation for operation, _ in table.calls] == ["scan"] * 3 + ["query"] * 3
+    assert all(params["Limit"] == 10 for _, params in table.calls[:3])
+    assert all(params["IndexName"] == "PanelIDIndex" for _, params in table.calls[3:])
+
+
+def test_paginate_reads_the_pages_only_while_iterated():
+    table = PagedTable("Questions", [{"QuestionID": f"q{index}"} for index in range(5)])
+
+    items = db_provider.iter_scan(table)
+    assert table.calls == []
+    assert next(items) == {"QuestionID": "q0"}
+    assert len(table.calls) == 1
+
+
+def test_question_lookups_query_the_indexes_instead_of_scanning():
+    items = [{"QuestionID": f"q{index}"} for index in range(3)]
+    question_db = DynamoQuestionDB(PagedTable("Questions", items))
+
+    assert question_db.get_questions_by_panel("p") == items
+    assert question_db.get_my_questions_by_panel("p", "s1") == items
+    assert question_db.get_questions_by_user("s1") == items
+
+    calls = question_db._table.calls
+    assert {operation for operation, _ in calls} == {"query"}
+    first_pages = [params for _, params in calls if "ExclusiveStartKey" not in params]
+    assert [
+        (params["IndexName"], params["KeyConditionExpression"]) for params in first_pages
+    ] == [
+        ("PanelIDIndex", Key("PanelID").eq("p")),
+        ("UserIDIndex", Key("UserID").eq("s1") & Key("PanelID").eq("p")),
+        ("UserIDIndex", Key("UserID").eq("s1")),
+    ]
+
+
+def test_identity_map_reuses_items_and_forgets_them_after_writes(memory_db, monkeypatch):
+    reads = []
+    for provider_class, method in (
+        (MemoryPanelDB, "get_panel"),
+        (MemoryMetricDB, "get_metric"),
+    ):
+        original = getattr(provider_class, method)
+
+        def read(self, *key, original=original):
+            reads.append(key)
+            return original(self, *key)
+
+        monkeypatch.setattr(provider_class, method, read)
+    get_panel_db().add_panel({"PanelID": "p", "PanelName": "Old"})
+
+    @with_identity_map
+    def handle_request():
+        panel = get_panel_db().get_panel("p")
+        assert get_panel_db().get_panel("p") is panel
+        # Missing items are remembered too
+        assert get_metric_db().get_metric("s1", "p") is None
+        assert get_metric_db().get_metric("s1", "p") is None
+        get_panel_db().update_panel({"PanelID": "p", "PanelName": "New"})
+        return get_panel_db().get_panel("p")
+
+    start_request_metrics("test")
+    panel = handle_request()
+    summary = end_request_metrics()
+
+    assert panel["PanelName"] == "New"
+    assert reads == [("p",), ("s1", "p"), ("p",)]
+    assert summary["identity_maps"] == [
+        {"function": "handle_request", "hits": 2, "misses": 3, "items": 2}
+    ]
+    # Outside of the scope every read goes to the provider
+    get_panel_db().get_panel("p")
+    assert len(reads) == 4
+
+
+def test_user_role_is_cached_until_the_user_is_written(monkeypatch):
+    users = {"u1": {"UserID": "u1", "Role": "student"}}
+    reads = []
+
+    def get_item(Key):
+        reads.append(Key["UserID"])
+        return {"Item": dict(users[Key["UserID"]])}
+
+    table = SimpleNamespace(get_item=get_item, put_item=lambda Item: None)
+    user_db = DynamoUserDB(table)
+
+    assert user_db.get_user_role("u1") == "student"
+    assert user_db.get_user_role("u1") == "student"
+    assert reads == ["u1"]
+
+    users["u1"]["Role"] = "admin"
+    user_db.update_user(users["u1"])
+    assert user_db.get_user_role("u1") == "admin"
+    assert reads == ["u1", "u1"]
+
+    # Changes made by other containers show up once the entry expires
+    users["u1"]["Role"] = "panelist"
+    user_db._role_cache.expire(
+        user_db._role_cache.timer() + db_provider.ROLE_CACHE_TTL_SECONDS
+    )
+    assert user_db.get_user_role("u1") == "panelist"
+    assert reads == ["u1", "u1", "u1"]
+
+
+def test_clients_are_created_once_and_share_the_resource_client(monkeypatch):
+    created = []
+
+    def client(service_name, config):
+        created.append(service_name)
+        return SimpleNamespace(service_name=service_name)
+
+    def resource(service_name, config):
+        created.append(f"{service_name} resource")
+        return SimpleNamespace(meta=SimpleNamespace(client=client(service_name, config)))
+
+    monkeypatch.setattr(
+        aws_clients, "_SESSION", SimpleNamespace(client=client, resource=resource)
+    )
+    monkeypatch.setattr(aws_clients, "_CLIENTS", {})
+    monkeypatch.setattr(aws_clients, "_RESOURCES", {})
+
+    assert aws_clients.get_client("s3") is aws_clients.get_client("s3")
+    dynamodb = aws_clients.get_resource("dynamodb")
+    assert aws_clients.get_resource("dynamodb") is dynamodb
+    assert aws_clients.get_client("dynamodb") is dynamodb.meta.client
+    assert created == ["s3", "dynamodb resource", "dynamodb"]
+
+
+def test_parallel_scan_merges_every_page_of_every_segment():
+    items = [{"QuestionID": f"q{index}"} for index in range(7)]
+    question_db = DynamoQuestionDB(PagedTable("Questions", items))
+
+    questions = question_db.list_questions(total_segments=3)
+
+    assert sorted(questions, key=lambda item: item["QuestionID"]) == items
+    calls = question_db._table.calls
+    # Segment 0 holds 3 of the items, two pages
+    assert sorted(params["Segment"] for _, params in calls) == [0, 0, 1, 2]
+
+    calls.clear()
+    assert question_db.list_questions(total_segments=1) == items
+    assert all("Segment" not in params for _, params in calls)
+
+
+def test_with_projection_names_every_attribute_once():
+    params = {"ExpressionAttributeNames": {"#roleAttr": "Role"}}
+
+    assert db_provider.with_projection(params, None) is params
+    projected = db_provider.with_projection(
+        params, ["Name", "UserID", "Role"], ("UserID",)
+    )
+
+    assert projected["ProjectionExpression"] == "#proj0, #proj1, #proj2"
+    assert projected["ExpressionAttributeNames"] == {
+        "#roleAttr": "Role",
+        "#proj0": "UserID",
+        "#proj1": "Name",
+        "#proj2": "Role",
+    }
+    # The params of the caller are left as they were
+    assert params == {"ExpressionAttributeNames": {"#roleAttr": "Role"}}
+
+
+def test_question_queries_request_only_the_given_attributes():
+    question_db = DynamoQuestionDB(PagedTable("Questions", [{"QuestionID": "q0"}]))
+
+    question_db.get_question_ids_by_panel_id("p")
+    question_db.get_questions_by_panel("p", attributes=["QuestionID", "UserID"])
+    question_db.get_questions_by_panel("p")
+
+    projections = [
+        (params.get("ProjectionExpression"), params.get("ExpressionAttributeNames"))
+        for _, params in question_db._table.calls
+    ]
+    assert projections == [
+        ("#proj0", {"#proj0": "QuestionID"}),
+        ("#proj0, #proj1", {"#proj0": "QuestionID", "#proj1": "UserID"}),
+        (None, None),
+    ]
+
+
+def test_logs_are_written_in_batches_when_the_buffer_fills_up():
+    batches = []
+
+    def batch_write_item(RequestItems, ReturnConsumedCapacity):
+        batches.append([request["PutRequest"]["Item"] for request in RequestItems["Logs"]])
+        return {}
+
+    log_db = DynamoLogDB(
+        fake_table(SimpleNamespace(batch_write_item=batch_write_item), "Logs")
+    )
+    logs = [
+        {"LogID": f"l{index}", "CreatedAt": "2024-04-01T12:00:00Z"}
+        for index in range(db_provider.LOG_BUFFER_MAX_SIZE + 1)
+    ]
+
+    for log in logs:
+        log_db.add_log(log)
+
+    assert len(batches) == 1
+    assert [log["LogID"] for log in batches[0]] == [
+        log["LogID"] for log in logs[:-1]
+    ]
+    assert batches[0][0]["LogDate"] == "2024-04-01"
+    assert log_db.flush_logs() == 1
+    assert log_db.flush_logs() == 0
+    assert [log["LogID"] for log in batches[1]] == [logs[-1]["LogID"]]
+
+
+def test_flush_logs_middleware_writes_the_logs_even_when_the_handler_fails(monkeypatch):
+    import app
+
+    flushes = []
+    monkeypatch.setattr(
+        app, "get_log_db", lambda: SimpleNamespace(flush_logs=lambda: flushes.append(1))
+    )
+
+    def failing_handler(event):
+        raise RuntimeError("handler failed")
+
+    def failing_flush():
+        raise RuntimeError("throttled")
+
+    assert app.flush_logs("event", lambda event: "response") == "response"
+    with pytest.raises(RuntimeError):
+        app.flush_logs("event", failing_handler)
+    assert len(flushes) == 2
+
+    # Losing the logs must not fail the request
+    monkeypatch.setattr(
+        app, "get_log_db", lambda: SimpleNamespace(flush_logs=failing_flush)
+    )
+    assert app.flush_logs("event", lambda event: "response") == "response"
+
+
+def test_instrumented_calls_record_the_consumed_capacity_per_method():
+    resource = Session(
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        region_name="us-east-1",
+    ).resource("dynamodb")
+    client = instrument_client(resource.meta.client)
+    requests = []
+    responses = [
+        {"Item": {"QuestionID": {"S": "q0"}}},
+        {
+            "Item": {"QuestionID": {"S": "q0"}},
+            "ConsumedCapacity": {"TableName": "Questions", "CapacityUnits": 0.5},
+        },
+        {
+            "Items": [{"QuestionID": {"S": "q0"}}, {"QuestionID": {"S": "q1"}}],
+            "ConsumedCapacity": {"TableName": "Questions", "CapacityUnits": 1.5},
+        },
+    ]
+
+    def send(request, **kwargs):
+        # Answered instead of sending the request, every other handler still runs
+        requests.append(loads(request.body))
+        body = dumps(responses.pop(0)).encode()
+        raw = SimpleNamespace(stream=lambda **kwargs: iter([body]))
+        return AWSResponse(request.url, 200, {}, raw)
+
+    client.meta.events.register("before-send.dynamodb", send)
+    question_db = DynamoQuestionDB(resource.Table("Questions"))
+
+    # Not recorded, no scope is active
+    question_db.get_question("q0")
+    start_request_metrics("GET /panel/{id}")
+    question_db.get_question("q0")
+    question_db.get_questions_by_panel("p")
+    summary = end_request_metrics()
+
+    assert [request.get("ReturnConsumedCapacity") for request in requests] == [
+        None,
+        "TOTAL",
+        "TOTAL",
+    ]
+    assert summary["name"] == "GET /panel/{id}"
+    assert [
+        (
+            call["method"],
+            call["operation"],
+            call["index"],
+            call["items"],
+            call["consumed_capacity"],
+        )
+        for call in summary["calls"]
+    ] == [
+        ("DynamoQuestionDB.get_question", "GetItem", None, 1, 0.5),
+        # The innermost provider method owns the call
+        ("DynamoQuestionDB.iter_questions_by_panel", "Query", "PanelIDIndex", 2, 1.5),
+    ]
+    assert summary["totals"]["calls"] == 2
+    assert summary["totals"]["consumed_capacity"] == 2
+    assert summary["totals"]["seconds"] >= 0
+
+
+def test_submit_tagging_writes_everything_in_one_transaction(client, submission_db):
+    def transact_write_items(TransactItems):
+        client.transactions.append(TransactItems)
+        if len(client.transactions) == 1:
+            # A resubmission, s1 already liked q1
+            error = client.exceptions.TransactionCanceledException()
+            error.response = {
+                "CancellationReasons": [
+                    {
+                        "Code": "ConditionalCheckFailed",
+                        "Item": {"LikedBy": {"L": [{"S": "s1"}]}},
+                    },
+                    {"Code": "None"},
+                    {"Code": "None"},
+                    {"Code": "None"},
+                ]
+            }
+            raise error
+
+    client.transact_write_items = transact_write_items
+    log = {"LogID": "l1", "CreatedAt": "2024-04-01T12:00:00Z"}
+
+    submission_db.submit_tagging(
+        "p",
+        "s1",
+        {"q1": ["LikedBy", "FlaggedBy"], "q2": ["DislikedBy"]},
+        {"TagStageOutTime": "t"},
+        log,
+    )
+
+    first, second = client.transactions
+    assert [
+        (kind, request["TableName"])
+        for action in first
+        for kind, request in action.items()
+    ] == [
+        ("Update", "Questions"),
+        ("Update", "Questions"),
+        ("Update", "Metrics"),
+        ("Put", "Logs"),
+    ]
+    q1 = first[0]["Update"]
+    assert q1["Key"] == {"QuestionID": "q1"}
+    assert list(q1["ExpressionAttributeNames"].values()) == ["LikedBy", "FlaggedBy"]
+    assert q1["ConditionExpression"] == (
+        "attribute_exists(QuestionID) AND NOT contains(#attr0, :user_id)"
+        " AND NOT contains(#attr1, :user_id)"
+    )
+    metric = first[2]["Update"]
+    assert metric["Key"] == {"UserID": "s1", "PanelID": "p"}
+    assert metric["ExpressionAttributeValues"] == {":metric0": "t"}
+    assert first[3]["Put"]["Item"] == dict(log, LogDate="2024-04-01")
+    # Only the lists the user is not in yet are written again
+    assert second[0]["Update"]["ExpressionAttributeNames"] == {"#attr0": "FlaggedBy"}
+    assert second[1:] == first[1:]
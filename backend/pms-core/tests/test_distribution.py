@@ -0,0 +1,132 @@
+from collections import Counter
+
+import numpy as np
+
+from chalicelib.distribution import (
+    UNASSIGNED,
+    assign_tag_questions,
+    find_conflicts,
+    pick_least_covered_questions,
+    plan_tag_questions,
+)
+
+
+def make_panel(number_of_students, questions_per_student):
+    question_owners = {
+        f"q{student}-{question}": f"s{student}"
+        for student in range(number_of_students)
+        for question in range(questions_per_student)
+    }
+    return question_owners, [f"s{student}" for student in range(number_of_students)]
+
+
+def test_assign_tag_questions_gives_distinct_questions_of_other_students():
+    question_owners, student_ids = make_panel(30, 3)
+
+    assignments = assign_tag_questions(question_owners, student_ids, 20, seed=7)
+
+    assert sorted(assignments) == sorted(student_ids)
+    for student_id, question_ids in assignments.items():
+        assert len(question_ids) == 20
+        assert len(set(question_ids)) == 20
+        assert all(
+            question_owners[question_id] != student_id for question_id in question_ids
+        )
+
+
+def test_assign_tag_questions_balances_coverage():
+    question_owners, student_ids = make_panel(30, 3)
+
+    assignments = assign_tag_questions(question_owners, student_ids, 20, seed=7)
+
+    coverage = Counter(
+        question_id
+        for question_ids in assignments.values()
+        for question_id in question_ids
+    )
+    assert set(coverage) == set(question_owners)
+    assert max(coverage.values()) - min(coverage.values()) <= 1
+
+
+def test_assign_tag_questions_is_reproducible_whatever_the_input_order():
+    question_owners, student_ids = make_panel(12, 2)
+    reversed_owners = dict(reversed(list(question_owners.items())))
+
+    assignments = assign_tag_questions(question_owners, student_ids, 5, seed=3)
+
+    assert assign_tag_questions(question_owners, student_ids, 5, seed=3) == assignments
+    assert (
+        assign_tag_questions(reversed_owners, list(reversed(student_ids)), 5, seed=3)
+        == assignments
+    )
+
+
+def test_assign_tag_questions_never_gives_own_questions_even_if_rows_stay_short():
+    # s0 wrote almost everything, the others can not get a full row of distinct questions
+    question_owners = {f"q{question}": "s0" for question in range(10)}
+    question_owners.update({"x": "s1", "y": "s2"})
+
+    assignments = assign_tag_questions(question_owners, ["s0", "s1", "s2"], 5, seed=1)
+
+    assert sorted(assignments["s0"]) == ["x", "y"]
+    for student_id, question_ids in assignments.items():
+        assert len(set(question_ids)) == len(question_ids)
+        assert all(
+            question_owners[question_id] != student_id for question_id in question_ids
+        )
+
+
+def test_assign_tag_questions_without_questions_or_slots():
+    assert assign_tag_questions({}, ["s0"], 20) == {"s0": []}
+    assert assign_tag_questions({"q0": "s0"}, ["s0", "s1"], 0) == {"s0": [], "s1": []}
+
+
+def test_plan_tag_questions_has_no_conflicts_and_balanced_coverage():
+    owners = np.repeat(np.arange(500, dtype=np.int32), 2)
+
+    plan = plan_tag_questions(owners, 500, 20, seed=3)
+
+    assert plan.shape == (500, 20) and plan.dtype == np.int32
+    assert not find_conflicts(plan, owners, np.arange(500, dtype=np.int32)).any()
+    coverage = np.bincount(plan.ravel(), minlength=len(owners))
+    assert coverage.max() - coverage.min() <= 1
+    assert (plan_tag_questions(owners, 500, 20, seed=3) == plan).all()
+
+
+def test_plan_tag_questions_marks_the_cells_it_can_not_fill():
+    owners = np.array([0, 0, 0, 1], dtype=np.int32)
+
+    plan = plan_tag_questions(owners, 2, 3, seed=1)
+
+    assert sorted(plan[0].tolist()) == [UNASSIGNED, UNASSIGNED, 3]
+    assert sorted(plan[1].tolist()) == [0, 1, 2]
+
+
+def test_plan_tag_questions_fills_the_cells_no_swap_can_fix():
+    # Every swap keeping the coverage fails, yet both students can get a full row
+    owners = np.array([UNASSIGNED] * 5 + [0, 0, 1, 1], dtype=np.int32)
+
+    for seed in range(20):
+        plan = plan_tag_questions(owners, 2, 7, seed=seed)
+
+        assert not (plan == UNASSIGNED).any()
+        assert not find_conflicts(plan, owners, np.arange(2, dtype=np.int32)).any()
+
+
+def test_find_conflicts_flags_own_and_repeated_questions():
+    owners = np.array([0, 1, 1], dtype=np.int32)
+    plan = np.array([[0, 1, 1], [2, 0, 1]], dtype=np.int32)
+
+    conflicts = find_conflicts(plan, owners, np.array([0, 1], dtype=np.int32))
+
+    assert conflicts.tolist() == [[True, False, True], [True, False, True]]
+
+
+def test_pick_least_covered_questions_prefers_the_least_covered_of_others():
+    coverage = {"q0": 3, "q1": 1, "q2": 1, "q3": 0, "q4": 2}
+    question_owners = {"q0": "s0", "q1": "s1", "q2": "s2", "q3": "late", "q4": "s4"}
+
+    picked = pick_least_covered_questions(coverage, question_owners, "late", 3, seed=1)
+
+    assert sorted(picked[:2]) == ["q1", "q2"] and picked[2] == "q4"
+    assert len(pick_least_covered_questions(coverage, question_owners, "late", 10)) == 4
@@ -0,0 +1,121 @@
+from random import Random
+
+import pytest
+
+from chalicelib.clustering import DisjointSet, cluster_similar_questions
+from chalicelib.database.db_provider import (
+    AlreadySubmittedError,
+    get_log_db,
+    get_metric_db,
+    get_panel_db,
+    get_question_db,
+    get_submission_db,
+    get_user_db,
+)
+
+
+def test_submit_similar_keeps_the_clusters_in_the_pointers(memory_db):
+    question_ids = [f"q{index:02}" for index in range(40)]
+    get_question_db().add_questions_batch(
+        [
+            {"QuestionID": question_id, "PanelID": "p", "UserID": "s0"}
+            for question_id in question_ids
+        ]
+    )
+    get_metric_db().add_metric({"UserID": "s1", "PanelID": "p"})
+    expected = DisjointSet(question_ids)
+    rng = Random(5)
+
+    for _ in range(30):
+        similar_set = rng.sample(question_ids, rng.randint(2, 4))
+        get_submission_db().submit_similar("p", "s1", [similar_set], {"X": "1"})
+        for question_id in similar_set[1:]:
+            expected.union(similar_set[0], question_id)
+
+    questions = get_question_db().get_questions_by_panel("p")
+    assert not any("SimilarTo" in question for question in questions)
+    members = {}
+    for question_id in question_ids:
+        members.setdefault(expected.find(question_id), []).append(question_id)
+    assert cluster_similar_questions(questions) == list(members.values())
+    assert get_metric_db().get_metric("s1", "p")["X"] == "1"
+
+
+def test_acquire_panel_lease_once_until_it_expires(memory_db):
+    get_panel_db().add_panel({"PanelID": "p"})
+
+    assert get_panel_db().acquire_panel_lease("p", "TaskLease", 60)
+    assert not get_panel_db().acquire_panel_lease("p", "TaskLease", 60)
+    assert get_panel_db().acquire_panel_lease("p", "ExpiredLease", -1)
+    assert get_panel_db().acquire_panel_lease("p", "ExpiredLease", 60)
+    assert not get_panel_db().acquire_panel_lease("missing", "TaskLease", 60)
+
+
+def test_submit_votes_counts_the_scores_of_a_student_once(memory_db):
+    get_question_db().add_questions_batch(
+        [{"QuestionID": question_id, "PanelID": "p"} for question_id in ("q1", "q2")]
+    )
+    get_metric_db().add_metric({"UserID": "s1", "PanelID": "p"})
+
+    get_submission_db().submit_votes(
+        "p", "s1", {"q1": 20, "q2": 19}, {"VoteStageOutTime": "t"}
+    )
+    with pytest.raises(AlreadySubmittedError):
+        get_submission_db().submit_votes(
+            "p", "s1", {"q1": 20}, {"VoteStageOutTime": "t2"}
+        )
+    with pytest.raises(ValueError):
+        get_submission_db().submit_votes(
+            "p", "s1", {"q1": 20, "missing": 19}, {"VoteStageOutTime": "t2"}
+        )
+
+    questions = get_question_db().get_questions_batch(["q1", "q2"])
+    assert [questions[question_id]["VoteScore"] for question_id in ("q1", "q2")] == [
+        20,
+        19,
+    ]
+    assert get_metric_db().get_metric("s1", "p")["VoteStageOutTime"] == "t"
+
+
+def test_backfill_log_dates_adds_old_logs_to_the_date_queries(memory_db):
+    # Written before LogDate existed
+    get_log_db()._table.put({"LogID": "l1", "CreatedAt": "2024-03-01T10:00:00Z"})
+    get_log_db().add_log({"LogID": "l2", "CreatedAt": "2024-03-01T11:00:00Z"})
+    assert [log["LogID"] for log in get_log_db().get_logs_by_date("2024-03-01")] == [
+        "l2"
+    ]
+
+    assert get_log_db().backfill_log_dates() == 1
+    assert get_log_db().backfill_log_dates() == 0
+
+    assert [log["LogID"] for log in get_log_db().get_logs_by_date("2024-03-01")] == [
+        "l1",
+        "l2",
+    ]
+
+
+def test_backfill_uins_makes_imported_users_findable_by_uin(memory_db):
+    # Stored as a number by the importers before UINIndex existed
+    get_user_db().add_user({"UserID": "u1", "UIN": 123456789, "Role": "student"})
+    get_user_db().add_user({"UserID": "u2", "UIN": "223456789", "Role": "student"})
+    assert get_user_db().find_user_by_uin("123456789") is None
+
+    assert get_user_db().backfill_uins() == 1
+    assert get_user_db().backfill_uins() == 0
+
+    assert get_user_db().find_user_by_uin("123456789")["UserID"] == "u1"
+    assert get_user_db().find_user_by_uin("223456789")["UserID"] == "u2"
+
+
+def test_update_panel_keeps_the_attributes_it_is_not_given(memory_db):
+    get_panel_db().add_panel({"PanelID": "p", "PanelName": "Old", "Visibility": "public"})
+    assert get_panel_db().acquire_panel_lease("p", "SortedClusterLease", 60)
+
+    get_panel_db().update_panel({"PanelID": "p", "PanelName": "New"})
+
+    panel = get_panel_db().get_panel("p")
+    assert panel["PanelName"] == "New"
+    assert panel["Visibility"] == "public"
+    assert "SortedClusterLease" in panel
+    with pytest.raises(ValueError):
+        get_panel_db().update_panel({"PanelID": "missing", "PanelName": "New"})
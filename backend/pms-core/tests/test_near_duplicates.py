@@ -0,0 +1,107 @@
+import tracemalloc
+from random import Random
+
+import numpy as np
+
+from chalicelib.near_duplicates import (
+    candidate_pairs,
+    find_near_duplicates,
+    lsh_bands,
+    minhash_signatures,
+    shingles,
+)
+
+TEXTS = [
+    "What is your favorite programming language?",
+    "What's your favourite programming language?",
+    "what is your favorite programming language",
+    "How did you get started in cybersecurity?",
+    "How did you get started in cyber security?",
+    "What advice would you give to new graduates?",
+    "",
+    "Hi",
+    "hi!",
+]
+
+
+def test_shingles_ignore_case_and_punctuation():
+    assert shingles("Hello, World!") == shingles("hello world")
+    assert shingles("") == set()
+
+
+def test_find_near_duplicates_by_threshold():
+    assert find_near_duplicates(TEXTS, 0.7) == [[0, 2], [7, 8]]
+    assert find_near_duplicates(TEXTS, 0.5) == [[0, 2], [3, 4], [7, 8]]
+    assert find_near_duplicates(TEXTS[5:7], 0.7) == []
+
+
+def test_find_near_duplicates_with_many_identical_texts():
+    texts = ["Other"] * 5000 + ["What do you do all day?"] * 2 + ["Unique"]
+
+    groups = find_near_duplicates(texts, 0.7)
+
+    assert groups == [list(range(5000)), [5000, 5001]]
+
+
+def test_lsh_bands_follow_the_threshold():
+    assert lsh_bands(0.7) == (16, 8)
+    assert lsh_bands(0.4) == (32, 4)
+    assert lsh_bands(0.9) == (8, 16)
+
+
+def test_candidate_pairs_are_the_pairs_sharing_a_band():
+    signatures = np.random.default_rng(1).integers(0, 4, size=(60, 64), dtype=np.uint64)
+    bands = signatures.reshape(len(signatures), 32, 2)
+    expected = {
+        (first, second)
+        for first in range(len(signatures))
+        for second in range(first + 1, len(signatures))
+        if (bands[first] == bands[second]).all(axis=1).any()
+    }
+
+    pairs = [
+        set(zip(first.tolist(), second.tolist()))
+        for first, second in candidate_pairs(signatures, 32)
+    ]
+
+    assert set().union(*pairs) == expected
+
+
+def test_candidate_pairs_of_an_oversized_bucket_stay_linear():
+    signatures = np.zeros((1000, 8), dtype=np.uint64)
+
+    (first, second), *other_bands = list(candidate_pairs(signatures, 1))
+
+    assert other_bands == []
+    assert len(first) < 1000 * 16
+    assert (first < second).all()
+
+
+def test_find_near_duplicates_of_a_large_templated_panel():
+    rng = Random(0)
+    topics = ["python", "java", "security", "cloud", "data", "career", "ai"]
+    texts = [
+        f"What do you think about {rng.choice(topics)} in {rng.choice(topics)}"
+        f" for student {index % 50} today?"
+        for index in range(6000)
+    ] + ["How did you start your career?"]
+
+    tracemalloc.start()
+    try:
+        groups = find_near_duplicates(texts, 0.7)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert peak < 128 * 1024 * 1024
+    assert sum(len(group) for group in groups) <= 6000
+    assert all(6000 not in group for group in groups)
+
+
+def test_minhash_signatures_estimate_jaccard_similarity():
+    left, right = shingles(TEXTS[3]), shingles(TEXTS[4])
+    signatures = minhash_signatures([left, right])
+
+    estimate = (signatures[0] == signatures[1]).mean()
+
+    assert abs(estimate - len(left & right) / len(left | right)) < 0.15
@@ -0,0 +1,199 @@
+from json import loads
+
+import pytest
+
+from chalicelib import utils
+from chalicelib.database import memory_provider
+from chalicelib.database.db_provider import (
+    get_metric_db,
+    get_panel_db,
+    get_question_db,
+    get_user_db,
+)
+
+
+def add_panel(panel_id, texts_by_student, questions_per_student=2):
+    get_panel_db().add_panel(
+        {"PanelID": panel_id, "NumberOfQuestions": questions_per_student}
+    )
+    for student_id, texts in texts_by_student.items():
+        get_user_db().add_user(
+            {"UserID": student_id, "Role": "student", "EmailID": f"{student_id}@x"}
+        )
+        get_metric_db().add_metric({"UserID": student_id, "PanelID": panel_id})
+        get_question_db().add_questions_batch(
+            [
+                {
+                    "QuestionID": f"{student_id}-q{position}",
+                    "PanelID": panel_id,
+                    "UserID": student_id,
+                    "QuestionText": text,
+                    "LikedBy": [],
+                    "DislikedBy": [],
+                    "FlaggedBy": [],
+                }
+                for position, text in enumerate(texts)
+            ]
+        )
+
+
+def like_question(question_id, user_id):
+    get_question_db()._table.update(
+        (question_id,),
+        lambda question: question.setdefault("LikedBy", []).append(user_id),
+    )
+
+
+def get_panel_file(panel_id, file_name):
+    return loads(
+        memory_provider.get_object(utils.PANELS_BUCKET_NAME, f"{panel_id}/{file_name}")
+    )
+
+
+def test_assign_late_tag_questions_claims_once_and_keeps_the_coverage_file(memory_db):
+    add_panel(
+        "p",
+        {
+            f"s{student}": [f"Question {student} about {topic}" for topic in ("a", "b")]
+            for student in range(6)
+        },
+    )
+    assert "error" not in utils.distribute_tag_questions("p", seed=1)
+    coverage = get_panel_file("p", utils.TAG_QUESTIONS_COVERAGE_FILE_NAME)
+
+    # Enrolled after the panel was created, without a metric
+    late_questions = utils.assign_late_tag_questions("p", "late", seed=2)
+
+    assert len(late_questions) == 10
+    assert (
+        get_panel_file("p", utils.get_tag_questions_file_name("late")) == late_questions
+    )
+    # A second (e.g. concurrent) request gets the same questions and counts nothing twice
+    assert utils.assign_late_tag_questions("p", "late", seed=3) == late_questions
+    late_coverage = {
+        question["QuestionID"]: question.get("LateTagCoverage", 0)
+        for question in get_question_db().get_questions_by_panel("p")
+    }
+    assert sum(late_coverage.values()) == 10
+    assert all(late_coverage[question_id] == 1 for question_id in late_questions)
+    assert get_panel_file("p", utils.TAG_QUESTIONS_COVERAGE_FILE_NAME) == coverage
+    metric = get_metric_db().get_metric("late", "p")
+    assert metric["LateTagQuestions"] == list(late_questions)
+    # Stored with the claim, the request does not read the new metric back
+    assert "TagStageInTime" in metric
+
+
+def test_memory_backend_never_creates_an_s3_client(memory_db, monkeypatch):
+    def get_client(service_name):
+        raise AssertionError(f"{service_name} client created")
+
+    monkeypatch.setattr(utils, "get_client", get_client)
+    add_panel("p", {"s0": ["First question", "Second question"], "s1": ["A", "B"]})
+
+    assert "error" not in utils.distribute_tag_questions("p", seed=1)
+    assert utils.assign_late_tag_questions("p", "late") is not None
+    data, error = utils.get_s3_objects(utils.PANELS_BUCKET_NAME, "p/missing.json")
+    assert data is None and utils.is_missing_s3_object(error)
+
+
+def test_assign_late_tag_questions_before_the_distribution(memory_db):
+    add_panel("p", {"s0": ["First question", "Second question"]})
+
+    assert utils.assign_late_tag_questions("p", "late") is None
+
+
+def test_assign_late_tag_questions_keeps_the_metric_of_the_student(memory_db):
+    add_panel("p", {"s0": ["First question", "Second question"], "s1": ["A", "B"]})
+    assert "error" not in utils.distribute_tag_questions("p", seed=1)
+    get_metric_db().add_metric({"UserID": "late", "PanelID": "p", "CreatedAt": "t"})
+
+    late_questions = utils.assign_late_tag_questions("p", "late")
+
+    metric = get_metric_db().get_metric("late", "p")
+    assert metric["CreatedAt"] == "t"
+    assert "TagStageInTime" in metric
+    assert metric["LateTagQuestions"] == list(late_questions)
+
+
+def test_group_similar_questions_breaks_like_ties_by_question_id(memory_db):
+    add_panel("p", {"s0": ["Tabs or spaces?"], "s1": ["Spaces or tabs?"]}, 1)
+    for question_id in ("s0-q0", "s1-q0"):
+        like_question(question_id, "s2")
+    utils.get_submission_db().link_similar([["s1-q0", "s0-q0"]])
+
+    clusters = utils.group_similar_questions("p")
+
+    assert [cluster["rep_id"] for cluster in clusters] == ["s0-q0"]
+    assert clusters[0]["cluster"] == ["s0-q0", "s1-q0"]
+    assert clusters[0]["cluster_likes"] == 2
+
+
+def test_near_duplicates_are_left_out_of_the_distribution_and_grouped(memory_db):
+    texts_by_student = {
+        f"s{student}": [
+            "What is your favorite programming language?",
+            f"Question {student} about topic {student * 7}",
+        ]
+        for student in range(5)
+    }
+    add_panel("p", texts_by_student, 1)
+    # Questions submitted before the lists were created with them
+    for student in range(5):
+        get_question_db()._table.update(
+            (f"s{student}-q0",),
+            lambda question: [
+                question.pop(name) for name in ("LikedBy", "DislikedBy", "FlaggedBy")
+            ],
+        )
+
+    distributed = utils.distribute_tag_questions("p", seed=1)
+    for student_id, question_id_text_map in distributed.items():
+        for question_id in question_id_text_map:
+            like_question(question_id, student_id)
+    clusters = utils.group_similar_questions("p")
+
+    handed_out = {
+        question_id for questions in distributed.values() for question_id in questions
+    }
+    assert handed_out.isdisjoint({f"s{student}-q0" for student in range(1, 5)})
+    assert isinstance(clusters, list)
+    duplicates = [cluster for cluster in clusters if len(cluster["cluster"]) > 1]
+    assert [cluster["cluster"] for cluster in duplicates] == [
+        [f"s{student}-q0" for student in range(5)]
+    ]
+    assert len(clusters) == 6
+
+
+def test_distribute_tag_questions_when_linking_near_duplicates_fails(
+    memory_db, monkeypatch
+):
+    add_panel(
+        "p",
+        {
+            f"s{student}": ["What is your favorite programming language?"]
+            for student in range(4)
+        },
+        1,
+    )
+
+    def fail(similar_sets):
+        raise RuntimeError("Transaction cancelled")
+
+    monkeypatch.setattr(utils.get_submission_db(), "link_similar", fail)
+
+    distributed = utils.distribute_tag_questions("p", seed=1)
+
+    assert "error" not in distributed
+    assert all(
+        len(question_id_text_map) == 3 for question_id_text_map in distributed.values()
+    )
+
+
+def test_parse_uin_normalises_numbers_and_rejects_blank_cells():
+    assert utils.parse_uin(123456789) == "123456789"
+    assert utils.parse_uin(" 123456789 ") == "123456789"
+    # pandas reads a UIN column with empty cells as floats
+    assert utils.parse_uin(123456789.0) == "123456789"
+    for value in ("", None, float("nan"), "abc", 0):
+        with pytest.raises(ValueError):
+            utils.parse_uin(value)
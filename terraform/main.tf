@@ -140,6 +140,10 @@ resource "aws_dynamodb_table" "question-table" {
     name = "PanelID"
     type = "S"
   }
+  attribute {
+    name = "UserID"
+    type = "S"
+  }
   global_secondary_index {
     name            = "PanelIDIndex"
     hash_key        = "PanelID"
@@ -147,6 +151,14 @@ resource "aws_dynamodb_table" "question-table" {
     read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
     write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
   }
+  global_secondary_index {
+    name            = "UserIDIndex"
+    hash_key        = "UserID"
+    range_key       = "PanelID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 #panel table
@@ -187,6 +199,18 @@ resource "aws_dynamodb_table" "user-table" {
     name = "Role"
     type = "S"
   }
+  attribute {
+    name = "EmailID"
+    type = "S"
+  }
+  attribute {
+    name = "UIN"
+    type = "S"
+  }
+  attribute {
+    name = "GoogleID"
+    type = "S"
+  }
   global_secondary_index {
     name            = "RoleIndex"
     hash_key        = "Role"
@@ -194,6 +218,28 @@ resource "aws_dynamodb_table" "user-table" {
     read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
     write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
   }
+  global_secondary_index {
+    name            = "EmailIndex"
+    hash_key        = "EmailID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+  # UINs are strings, run the backfill_uins function before creating this index (see app.py)
+  global_secondary_index {
+    name            = "UINIndex"
+    hash_key        = "UIN"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+  global_secondary_index {
+    name            = "GoogleIDIndex"
+    hash_key        = "GoogleID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 #metric table
@@ -249,6 +295,49 @@ resource "aws_dynamodb_table" "log-table" {
     name = "LogID"
     type = "S"
   }
+  attribute {
+    name = "LogDate"
+    type = "S"
+  }
+  attribute {
+    name = "CreatedAt"
+    type = "S"
+  }
+  attribute {
+    name = "UserID"
+    type = "S"
+  }
+  attribute {
+    name = "PanelID"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = "LogDateIndex"
+    hash_key        = "LogDate"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+
+  global_secondary_index {
+    name            = "UserIDIndex"
+    hash_key        = "UserID"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+
+  global_secondary_index {
+    name            = "PanelIDIndex"
+    hash_key        = "PanelID"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 ### local ###
@@ -273,6 +362,10 @@ resource "aws_dynamodb_table" "local-question-table" {
     name = "PanelID"
     type = "S"
   }
+  attribute {
+    name = "UserID"
+    type = "S"
+  }
   global_secondary_index {
     name            = "PanelIDIndex"
     hash_key        = "PanelID"
@@ -280,6 +373,14 @@ resource "aws_dynamodb_table" "local-question-table" {
     read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
     write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
   }
+  global_secondary_index {
+    name            = "UserIDIndex"
+    hash_key        = "UserID"
+    range_key       = "PanelID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 #panel table
@@ -323,6 +424,18 @@ resource "aws_dynamodb_table" "local-user-table" {
     name = "Role"
     type = "S"
   }
+  attribute {
+    name = "EmailID"
+    type = "S"
+  }
+  attribute {
+    name = "UIN"
+    type = "S"
+  }
+  attribute {
+    name = "GoogleID"
+    type = "S"
+  }
   global_secondary_index {
     name            = "RoleIndex"
     hash_key        = "Role"
@@ -330,6 +443,28 @@ resource "aws_dynamodb_table" "local-user-table" {
     read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
     write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
   }
+  global_secondary_index {
+    name            = "EmailIndex"
+    hash_key        = "EmailID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+  # UINs are strings, run the backfill_uins function before creating this index (see app.py)
+  global_secondary_index {
+    name            = "UINIndex"
+    hash_key        = "UIN"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+  global_secondary_index {
+    name            = "GoogleIDIndex"
+    hash_key        = "GoogleID"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 #metric table
@@ -391,6 +526,49 @@ resource "aws_dynamodb_table" "local-log-table" {
     name = "LogID"
     type = "S"
   }
+  attribute {
+    name = "LogDate"
+    type = "S"
+  }
+  attribute {
+    name = "CreatedAt"
+    type = "S"
+  }
+  attribute {
+    name = "UserID"
+    type = "S"
+  }
+  attribute {
+    name = "PanelID"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = "LogDateIndex"
+    hash_key        = "LogDate"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+
+  global_secondary_index {
+    name            = "UserIDIndex"
+    hash_key        = "UserID"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
+
+  global_secondary_index {
+    name            = "PanelIDIndex"
+    hash_key        = "PanelID"
+    range_key       = "CreatedAt"
+    projection_type = "ALL"
+    read_capacity   = var.dynamodb_global_secondary_idx_read_capacity[terraform.workspace]
+    write_capacity  = var.dynamodb_global_secondary_idx_write_capacity[terraform.workspace]
+  }
 }
 
 resource "aws_sesv2_email_identity" "ses-email-identity" {